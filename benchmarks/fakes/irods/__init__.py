@@ -0,0 +1,27 @@
+"""
+Local stand-in for the python-irodsclient, used by the benchmarks. The iRODS zone is the
+folder BENCH_IRODS_ROOT: collections are folders and data objects are files. Every call to
+the catalog waits BENCH_CATALOG_LATENCY seconds.
+"""
+import os
+import time
+
+
+def local_path(irodspath: str) -> str:
+    return os.environ["BENCH_IRODS_ROOT"] + irodspath
+
+
+def catalog_call() -> None:
+    latency = float(os.environ.get("BENCH_CATALOG_LATENCY", 0))
+    if latency:
+        time.sleep(latency)
+
+
+def data_transfer(size: int) -> None:
+    """
+    Waits for the latency and the transfer time of size bytes, like the fake icommands.
+    """
+    bandwidth = float(os.environ.get("BENCH_BANDWIDTH", 0))
+    delay = float(os.environ.get("BENCH_LATENCY", 0)) + (size / bandwidth if bandwidth else 0)
+    if delay:
+        time.sleep(delay)
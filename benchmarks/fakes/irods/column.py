@@ -0,0 +1,27 @@
+class Criterion:
+    def __init__(self, op, column, value):
+        self.op = op
+        self.column = column
+        self.value = value
+
+
+class Column:
+    def __init__(self, name):
+        self.name = name
+
+    def __eq__(self, other):
+        return Criterion("=", self, other)
+
+    def __hash__(self):
+        return hash(self.name)
+
+    def __repr__(self):
+        return self.name
+
+
+def Like(column, value):
+    return Criterion("like", column, value)
+
+
+def In(column, values):
+    return Criterion("in", column, list(values))
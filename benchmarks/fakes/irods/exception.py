@@ -0,0 +1,18 @@
+class iRODSException(Exception):
+    pass
+
+
+class CATALOG_ALREADY_HAS_ITEM_BY_THAT_NAME(iRODSException):
+    pass
+
+
+class CAT_NO_ACCESS_PERMISSION(iRODSException):
+    pass
+
+
+class CollectionDoesNotExist(iRODSException):
+    pass
+
+
+class DataObjectDoesNotExist(iRODSException):
+    pass
@@ -0,0 +1,3 @@
+FORCE_FLAG_KW = "forceFlag"
+REG_CHKSUM_KW = "regChksum"
+VERIFY_CHKSUM_KW = "verifyChksum"
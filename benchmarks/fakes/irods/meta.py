@@ -0,0 +1,11 @@
+class iRODSMeta:
+    def __init__(self, name, value, units=None):
+        self.name = name
+        self.value = value
+        self.units = units
+
+
+class AVUOperation:
+    def __init__(self, operation, avu):
+        self.operation = operation
+        self.avu = avu
@@ -0,0 +1,15 @@
+from irods.column import Column
+
+
+class Collection:
+    id = Column("COLL_ID")
+    name = Column("COLL_NAME")
+
+
+class DataObject:
+    id = Column("DATA_ID")
+    name = Column("DATA_NAME")
+    size = Column("DATA_SIZE")
+    checksum = Column("DATA_CHECKSUM")
+    replica_number = Column("DATA_REPL_NUM")
+    modify_time = Column("D_MODIFY_TIME")
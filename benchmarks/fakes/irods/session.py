@@ -0,0 +1,227 @@
+import base64
+import datetime
+import hashlib
+import os
+import shutil
+import threading
+
+from irods import catalog_call, data_transfer, local_path
+from irods.exception import CollectionDoesNotExist, DataObjectDoesNotExist
+from irods.models import Collection, DataObject
+
+# Registered checksums: local path --> (size, mtime, "sha2:<base64>")
+_CHECKSUMS = {}
+_CHECKSUMS_LOCK = threading.Lock()
+
+
+def registered_checksum(path: str) -> str:
+    """
+    Returns the checksum of a file in the format of iRODS, calculated once per version.
+    """
+    stat = os.stat(path)
+    with _CHECKSUMS_LOCK:
+        known = _CHECKSUMS.get(path)
+    if known and known[:2] == (stat.st_size, stat.st_mtime_ns):
+        return known[2]
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(4 * 1024 * 1024), b""):
+            digest.update(block)
+    checksum = "sha2:" + base64.b64encode(digest.digest()).decode()
+    with _CHECKSUMS_LOCK:
+        _CHECKSUMS[path] = (stat.st_size, stat.st_mtime_ns, checksum)
+    return checksum
+
+
+class iRODSCollection:
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.basename(path)
+
+
+class iRODSDataObject:
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.basename(path)
+        self.size = os.path.getsize(local_path(path))
+        self.modify_time = datetime.datetime.utcfromtimestamp(
+                os.path.getmtime(local_path(path)))
+
+    @property
+    def checksum(self):
+        return registered_checksum(local_path(self.path))
+
+    def chksum(self, **options):
+        catalog_call()
+        return self.checksum
+
+
+class CollectionManager:
+    def exists(self, path):
+        catalog_call()
+        return os.path.isdir(local_path(path))
+
+    def get(self, path):
+        catalog_call()
+        if not os.path.isdir(local_path(path)):
+            raise CollectionDoesNotExist(path)
+        return iRODSCollection(path)
+
+    def create(self, path):
+        catalog_call()
+        os.makedirs(local_path(path), exist_ok=True)
+        return iRODSCollection(path)
+
+
+class DataObjectManager:
+    def exists(self, path):
+        catalog_call()
+        return os.path.isfile(local_path(path))
+
+    def get(self, path, local_file=None, num_threads=0, **options):
+        catalog_call()
+        if not os.path.isfile(local_path(path)):
+            raise DataObjectDoesNotExist(path)
+        if local_file:
+            shutil.copyfile(local_path(path), local_file)
+            data_transfer(os.path.getsize(local_file))
+        return iRODSDataObject(path)
+
+    def put(self, local_file, path, num_threads=0, **options):
+        catalog_call()
+        if not os.path.isdir(os.path.dirname(local_path(path))):
+            raise CollectionDoesNotExist(os.path.dirname(path))
+        shutil.copyfile(local_file, local_path(path))
+        data_transfer(os.path.getsize(local_file))
+
+    def open(self, path, mode="r", *args, **kwargs):
+        catalog_call()
+        if mode == "r" and os.path.isfile(local_path(path)):
+            data_transfer(os.path.getsize(local_path(path)))
+        return open(local_path(path), "rb" if mode == "r" else "wb")
+
+
+class MetadataManager:
+    def add(self, model, path, meta):
+        catalog_call()
+
+    def apply_atomic_operations(self, model, path, *operations):
+        catalog_call()
+
+
+class Query:
+    """
+    GenQuery on the folder tree. Supports the conditions that the workflow uses: =, In and
+    Like "<path>/%" on Collection.name, = and In on DataObject.name, and sum(), max() and
+    count() grouped by the selected columns. A query of only Collection columns lists collections.
+    """
+    def __init__(self, *columns):
+        self.columns = list(columns)
+        self.criteria = []
+        self.aggregates = {}
+
+    def filter(self, *criteria):
+        self.criteria.extend(criteria)
+        return self
+
+    def sum(self, column):
+        self.aggregates[column] = "sum"
+        return self
+
+    def max(self, column):
+        self.aggregates[column] = "max"
+        return self
+
+    def count(self, column):
+        self.aggregates[column] = "count"
+        return self
+
+    def limit(self, number):
+        return self
+
+    def _collections(self):
+        for criterion in self.criteria:
+            if criterion.column is not Collection.name:
+                continue
+            if criterion.op == "=":
+                return [criterion.value]
+            if criterion.op == "in":
+                return sorted(set(criterion.value))
+            if criterion.op == "like" and criterion.value.endswith("/%"):
+                parent = criterion.value[:-2]
+                return sorted(parent + folder[len(local_path(parent)):]
+                              for folder, _, _ in os.walk(local_path(parent))
+                              if folder != local_path(parent))
+        raise NotImplementedError("Query without condition on Collection.name")
+
+    def _names(self):
+        for criterion in self.criteria:
+            if criterion.column is DataObject.name:
+                return {criterion.value} if criterion.op == "=" else set(criterion.value)
+        return None
+
+    def _rows(self):
+        names = self._names()
+        collections_only = all(column is Collection.name for column in self.columns)
+        for collection in self._collections():
+            folder = local_path(collection)
+            if not os.path.isdir(folder):
+                continue
+            if collections_only and not self.aggregates:
+                yield {Collection.name: collection}
+                continue
+            for entry in sorted(os.scandir(folder), key=lambda entry: entry.name):
+                if not entry.is_file() or (names is not None and entry.name not in names):
+                    continue
+                row = {Collection.name: collection, DataObject.name: entry.name,
+                       DataObject.size: entry.stat().st_size, DataObject.replica_number: 0,
+                       DataObject.modify_time: datetime.datetime.utcfromtimestamp(
+                           entry.stat().st_mtime)}
+                if DataObject.checksum in self.columns:
+                    row[DataObject.checksum] = registered_checksum(entry.path)
+                yield row
+
+    def __iter__(self):
+        catalog_call()
+        if not self.aggregates:
+            for row in self._rows():
+                yield {column: row.get(column) for column in self.columns}
+            return
+        groups = {}
+        for row in self._rows():
+            key = tuple(row.get(column) for column in self.columns)
+            group = groups.setdefault(key, {column: 0 for column in self.aggregates})
+            for column, aggregate in self.aggregates.items():
+                if aggregate == "max":
+                    group[column] = max(group[column], row[column])
+                else:
+                    group[column] += row[column] if aggregate == "sum" else 1
+        for key, group in groups.items():
+            result = dict(zip(self.columns, key))
+            result.update(group)
+            yield result
+
+    def get_results(self):
+        return iter(self)
+
+    def execute(self):
+        return list(self)
+
+
+class iRODSSession:
+    def __init__(self, **kwargs):
+        self.collections = CollectionManager()
+        self.data_objects = DataObjectManager()
+        self.metadata = MetadataManager()
+
+    def query(self, *columns):
+        return Query(*columns)
+
+    def cleanup(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.cleanup()
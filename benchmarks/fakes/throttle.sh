@@ -0,0 +1,15 @@
+# Sourced by the fake tools in bin/. Simulates the latency of a call and the time to
+# transfer the data. BENCH_LATENCY in seconds, BENCH_BANDWIDTH in bytes per second (0: off).
+
+# throttle <paths>: sleeps for the latency plus the transfer time of the paths
+throttle() {
+    bytes=0
+    if [ "${BENCH_BANDWIDTH:-0}" != 0 ]; then
+        bytes=$(du -sb "$@" 2>/dev/null | awk '{ total += $1 } END { print total + 0 }')
+    fi
+    if [ "${BENCH_LATENCY:-0}" != 0 ] || [ "$bytes" != 0 ]; then
+        sleep "$(awk -v bytes="$bytes" -v latency="${BENCH_LATENCY:-0}" \
+                     -v bandwidth="${BENCH_BANDWIDTH:-0}" \
+                     'BEGIN { printf "%.6f", latency + (bandwidth > 0 ? bytes / bandwidth : 0) }')"
+    fi
+}
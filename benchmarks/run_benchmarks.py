@@ -0,0 +1,232 @@
+#!python3
+"""
+Offline benchmarks of the transfer workflow.
+
+Runs the real transfer_workflow.py on synthetic data, with local stand-ins for iRODS
+(python-irodsclient, irsync, iput, ils), ssh and rsync from benchmarks/fakes. The iRODS zone
+and the destination server are folders in the work directory, no network is used.
+Latency and bandwidth of the stand-ins can be set, see --help.
+
+Reported per scenario and operation:
+    wall time, peak memory (RSS of the workflow process), wall time per item and
+    orchestration overhead per item: the wall time that is not spent in any timed stage
+    (irsync, rsync, mkdir, ...), according to the events the workflow writes.
+"""
+import argparse
+import csv
+import glob
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FAKES = os.path.join(REPO, "benchmarks", "fakes")
+ZONE = "/benchZone/home/bench"
+
+# name: (description, rows, files per row, file size in bytes)
+SCENARIOS = {
+    "rows-10": ("10 data objects of 1 MB", 10, 1, 1024 * 1024),
+    "rows-10k": ("10,000 data objects of 1 KB", 10000, 1, 1024),
+    "rows-1m": ("1,000,000 data objects of 1 KB", 1000000, 1, 1024),
+    "large-files": ("5 data objects of 100 MB", 5, 1, 100 * 1024 * 1024),
+    "tiny-files": ("1 collection of 10,000 files of 1 KB", 1, 10000, 1024),
+}
+# rows-1m takes hours and needs 1M inodes, it only runs when asked for
+DEFAULT_SCENARIOS = ["rows-10", "rows-10k", "large-files", "tiny-files"]
+
+
+def item_path(name: str, index: int) -> str:
+    """
+    iRODS path of the item on a row of a scenario, at most 1000 items per collection.
+    """
+    return f"{ZONE}/{name}/{index // 1000:04d}/item{index}"
+
+
+def generate(name: str, irods_root: str) -> None:
+    """
+    Creates the data of a scenario in the fake iRODS zone, once per work directory.
+    """
+    marker = os.path.join(irods_root, f".{name}")
+    if os.path.exists(marker):
+        return
+    _, rows, files, size = SCENARIOS[name]
+    print(f"Generating {name}: {SCENARIOS[name][0]}", flush=True)
+    for index in range(rows):
+        path = irods_root + item_path(name, index)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if files == 1:
+            targets = [path]
+        else:
+            os.makedirs(path, exist_ok=True)
+            targets = [os.path.join(path, f"file{number}") for number in range(files)]
+        for target in targets:
+            with open(target, "wb") as file:
+                file.write(os.urandom(size))
+    open(marker, "w").close()
+
+
+def write_setup(workdir: str, name: str, operation: str, args) -> dict:
+    """
+    Writes the CSV, the transfer config and the iRODS environment for one run.
+    Returns the paths of the run.
+    """
+    irods_root = os.path.join(workdir, "irods")
+    run = {
+        "home": os.path.join(workdir, "home"),
+        "remote": os.path.join(workdir, "remote"),
+        "output": os.path.join(workdir, "output", f"{name}-{operation}"),
+        "csv": os.path.join(workdir, f"{name}-{operation}.csv"),
+        "log": os.path.join(workdir, f"{name}-{operation}.log"),
+    }
+    shutil.rmtree(run["output"], ignore_errors=True)
+    shutil.rmtree(run["remote"], ignore_errors=True)
+    shutil.rmtree(irods_root + f"{ZONE}/import", ignore_errors=True)
+    for folder in [run["output"], run["remote"], os.path.join(run["home"], ".irods")]:
+        os.makedirs(folder, exist_ok=True)
+
+    with open(run["csv"], "w") as file:
+        writer = csv.writer(file)
+        for index in range(SCENARIOS[name][1]):
+            if operation == "export":
+                writer.writerow([item_path(name, index), run["remote"]])
+            else:
+                writer.writerow([irods_root + item_path(name, index),
+                                 f"{ZONE}/import/{index // 1000:04d}"])
+
+    run["config"] = os.path.join(run["home"], ".irods", "transfer.config")
+    with open(run["config"], "w") as file:
+        file.write("[remote]\ndatauser = bench\nserverip = localhost\nsudo = False\n")
+        file.write(f"[local_cache]\nlimit = {args.cache_limit}\n")
+        file.write("[transfer]\n")
+        for option in args.option:
+            key, _, value = option.partition("=")
+            file.write(f"{key.strip()} = {value.strip()}\n")
+
+    run["env"] = os.path.join(run["home"], ".irods", "irods_environment.json")
+    with open(run["env"], "w") as file:
+        json.dump({"irods_host": "localhost", "irods_zone_name": "benchZone"}, file)
+    return run
+
+
+def run_workflow(workdir: str, name: str, operation: str, args) -> dict:
+    """
+    Runs transfer_workflow.py on a scenario and measures it.
+    """
+    run = write_setup(workdir, name, operation, args)
+    env = dict(os.environ)
+    env.update({
+        "HOME": run["home"],
+        "PATH": os.path.join(FAKES, "bin") + os.pathsep + env.get("PATH", ""),
+        "PYTHONPATH": FAKES + os.pathsep + REPO,
+        "BENCH_IRODS_ROOT": os.path.join(workdir, "irods"),
+        "BENCH_LATENCY": str(args.latency),
+        "BENCH_BANDWIDTH": str(int(args.bandwidth * 1e6)),
+        "BENCH_CATALOG_LATENCY": str(args.catalog_latency),
+    })
+    command = [sys.executable, os.path.join(REPO, "transfer_workflow.py"),
+               "-i", run["csv"], "-o", run["output"], "-c", run["config"],
+               "-e", run["env"], "-p", operation]
+    with open(run["log"], "w") as log:
+        start = time.perf_counter()
+        process = subprocess.Popen(command, cwd=REPO, env=env, stdout=log,
+                                   stderr=subprocess.STDOUT)
+        # wait4 reports the resource usage of the workflow process itself
+        _, status, usage = os.wait4(process.pid, 0)
+        wall = time.perf_counter() - start
+        process.returncode = status
+
+    stages = {}
+    for path in glob.glob(os.path.join(run["output"], "transfer_events_*.jsonl")):
+        with open(path) as file:
+            for line in file:
+                event = json.loads(line)
+                stages[event["stage"]] = stages.get(event["stage"], 0) + event["seconds"]
+    # Annotation runs in the background, next to the other stages
+    staged = sum(seconds for stage, seconds in stages.items() if stage != "annotate")
+    failed = 0
+    for path in glob.glob(os.path.join(run["output"], "error_*.csv")):
+        with open(path) as file:
+            failed += sum(1 for _ in file) - 1
+
+    _, rows, files, size = SCENARIOS[name]
+    return {
+        "scenario": name,
+        "operation": operation,
+        "rows": rows,
+        "bytes": rows * files * size,
+        "exit_status": status,
+        "wall_seconds": round(wall, 3),
+        "peak_rss_mb": round(usage.ru_maxrss / 1024, 1),  # ru_maxrss is in KB on Linux
+        "ms_per_item": round(wall / rows * 1000, 3),
+        "overhead_ms_per_item": round(max(0.0, wall - staged) / rows * 1000, 3),
+        "stage_seconds": {stage: round(seconds, 3) for stage, seconds in stages.items()},
+        "failed": failed,
+        "log": run["log"],
+    }
+
+
+def print_results(results: list) -> None:
+    print(f"{'scenario':<12} {'operation':<9} {'rows':>8} {'MB':>8} {'wall s':>9} "
+          f"{'peak MB':>8} {'ms/item':>9} {'overhead':>9} {'failed':>7}")
+    for result in results:
+        print(f"{result['scenario']:<12} {result['operation']:<9} {result['rows']:>8} "
+              f"{result['bytes'] / 1e6:>8.1f} {result['wall_seconds']:>9.2f} "
+              f"{result['peak_rss_mb']:>8.1f} {result['ms_per_item']:>9.2f} "
+              f"{result['overhead_ms_per_item']:>9.2f} {result['failed']:>7}")
+    print("overhead: ms per item outside of the timed stages, only meaningful with one worker "
+          "and without pipeline")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        prog="python benchmarks/run_benchmarks.py",
+        description="Runs the transfer workflow offline on synthetic data and reports wall "
+                    "time, peak memory and overhead per item.",
+        epilog="Scenarios: " + "; ".join(f"{name}: {description}" for name, (description, *_)
+                                         in SCENARIOS.items()))
+    parser.add_argument("--scenario", "-s", action="append", choices=sorted(SCENARIOS),
+                        help="scenario to run, can be repeated "
+                             f"(default: {', '.join(DEFAULT_SCENARIOS)})")
+    parser.add_argument("--operation", "-p", choices=["export", "import", "both"],
+                        default="both")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="seconds added to every ssh, rsync, irsync and iput call")
+    parser.add_argument("--bandwidth", type=float, default=0.0,
+                        help="MB/s of rsync, irsync and iput, 0 is unlimited")
+    parser.add_argument("--catalog-latency", type=float, default=0.0,
+                        help="seconds added to every python-irodsclient call")
+    parser.add_argument("--option", "-o", action="append", default=[],
+                        help="option of the [transfer] section as key=value, can be repeated")
+    parser.add_argument("--cache-limit", type=float, default=10,
+                        help="cache limit in GB (default: 10)")
+    parser.add_argument("--workdir", "-w", type=str,
+                        help="folder for the data, kept and reused between runs "
+                             "(default: a temporary folder that is removed afterwards)")
+    parser.add_argument("--json", type=str, help="also write the results to this file")
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="ibridges-bench-")
+    operations = ["export", "import"] if args.operation == "both" else [args.operation]
+    results = []
+    try:
+        for name in args.scenario or DEFAULT_SCENARIOS:
+            generate(name, os.path.join(workdir, "irods"))
+            for operation in operations:
+                print(f"Running {name} {operation}", flush=True)
+                results.append(run_workflow(workdir, name, operation, args))
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print_results(results)
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
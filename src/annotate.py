@@ -0,0 +1,98 @@
+import queue
+import threading
+import time
+from datetime import datetime
+
+import irods.session
+
+import src.irods_functions
+from src.utils import print_error, print_message
+
+_DONE = object()
+
+
+class Annotator:
+    """
+    Adds the provenance metadata "data_copy_on_server" to transferred data objects in the
+    background, while the transfer continues. One thread lists the data objects of the
+    submitted items, several threads send the metadata requests. Every data object gets its
+    metadata in one atomic request, the iRODS atomic metadata API works per data object.
+    """
+    def __init__(self, session: irods.session.iRODSSession, serverip: str,
+                 threads: int = 4) -> None:
+        self.session = session
+        self.serverip = serverip
+        self.timestamp = datetime.now()
+        self.started = time.time()
+        self.annotated = 0
+        self.failed = []
+        self._lock = threading.Lock()
+        self._items = queue.Queue()
+        # Bounded, listing a large collection does not fill the memory
+        self._objects = queue.Queue(maxsize=1000)
+        self._lister = threading.Thread(target=self._list, daemon=True)
+        self._workers = [threading.Thread(target=self._annotate, daemon=True)
+                         for _ in range(max(1, threads))]
+        self._lister.start()
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self, irodspath: str, localpath: str, members: list = None,
+               serverip: str = None) -> None:
+        """
+        Queues a transferred data object or collection for annotation.
+        members: paths relative to irodspath, only these data objects are annotated
+        serverip: server the data was copied to, if it is not the server of the config
+        """
+        self._items.put((irodspath, localpath, members, serverip or self.serverip))
+
+    def close(self) -> list:
+        """
+        Waits until all submitted items are annotated.
+        Returns: list of data objects that could not be annotated
+        """
+        self._items.put(_DONE)
+        self._lister.join()
+        for worker in self._workers:
+            worker.join()
+        if self.failed:
+            print_error(f"ERROR: Metadata could not be added to {len(self.failed)} data objects")
+        return self.failed
+
+    def _list(self) -> None:
+        while True:
+            item = self._items.get()
+            if item is _DONE:
+                break
+            irodspath, localpath, members, serverip = item
+            avu = src.irods_functions.provenance_avu(serverip, localpath, self.timestamp)
+            try:
+                if members is not None:
+                    objpaths = (f"{irodspath}/{member}" for member in members)
+                elif self.session.collections.exists(irodspath):
+                    objpaths = (path for path, _, _
+                                in src.irods_functions.iter_irods_objects(self.session,
+                                                                          irodspath))
+                else:
+                    objpaths = [irodspath]
+                for objpath in objpaths:
+                    self._objects.put((objpath, avu))
+            except Exception as error:
+                print_error(f"ERROR: Listing {irodspath} for annotation failed: {error}")
+                self.failed.append(irodspath)
+            print_message(f"STATUS: Queued {irodspath} for annotation")
+        for _ in self._workers:
+            self._objects.put(_DONE)
+
+    def _annotate(self) -> None:
+        while True:
+            item = self._objects.get()
+            if item is _DONE:
+                break
+            objpath, avu = item
+            success = src.irods_functions.annotate_object(self.session, objpath, [avu])
+            with self._lock:
+                if success:
+                    self.annotated += 1
+                else:
+                    self.failed.append(objpath)
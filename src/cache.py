@@ -0,0 +1,358 @@
+import functools
+import os
+import queue
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+
+
+# Seconds between two looks at the free space of the volumes while a reservation waits
+POLL_INTERVAL = 5.0
+# Folders that are renamed aside to be deleted in the background start with this name
+TRASH_PREFIX = ".trash-"
+
+
+class CacheVolume:
+    """
+    One folder of the local cache, e.g. on NVMe scratch or on a bulk volume. The space a
+    volume offers is the live free space of its filesystem minus a safety margin, so data
+    that other users write to the same disk is taken into account.
+    """
+    def __init__(self, path: str, margin: int = 0) -> None:
+        """
+        margin: bytes that are always left free on the filesystem
+        """
+        self.path = path
+        self.margin = margin
+        # Space reserved by transfers and kept cache entries, the part of it that is not
+        # written yet, and space that is being deleted in the background
+        self.reserved = 0
+        self.unwritten = 0
+        self.deleting = 0
+        # Kept cache entries on this volume, see ItemCache
+        self.items = None
+
+    def __repr__(self) -> str:
+        return f"CacheVolume({self.path})"
+
+    def headroom(self) -> int:
+        """
+        Returns the space in bytes that can be reserved on the volume now.
+        """
+        free = shutil.disk_usage(self.path).free
+        return free + self.deleting - self.unwritten - self.margin
+
+    def capacity(self) -> int:
+        """
+        Returns the space in bytes the volume offers when the cache on it is empty.
+        """
+        return self.headroom() + self.reserved
+
+
+class Cleaner:
+    """
+    Deletes folders of the cache in a background thread, so that the next transfer does not
+    wait for the cleanup of the previous one. A folder is renamed aside first: it is gone
+    at once, the deletion takes as long as it takes.
+    """
+    def __init__(self) -> None:
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="cleaner", daemon=True)
+        self._thread.start()
+
+    def remove(self, folder: str, done=None) -> None:
+        """
+        Renames a folder aside and deletes it in the background.
+        done: optional callable(), called when the folder is deleted
+        """
+        trash = os.path.join(os.path.dirname(folder), f"{TRASH_PREFIX}{uuid.uuid4().hex}")
+        try:
+            os.rename(folder, trash)
+        except OSError:
+            trash = folder
+        self.delete(trash, done)
+
+    def delete(self, folder: str, done=None) -> None:
+        """
+        Deletes a folder that nobody uses anymore in the background.
+        """
+        self._queue.put((folder, done))
+
+    def sweep(self, folder: str) -> None:
+        """
+        Deletes what an earlier run that crashed left in the cache: folders that were renamed
+        aside but not deleted, and the job folders, named after the index of their job.
+        A new job with the same index would otherwise reuse the stale files. The kept items
+        in store/ and the checksum cache stay.
+        """
+        for name in os.listdir(folder):
+            if name.startswith(TRASH_PREFIX):
+                self.delete(os.path.join(folder, name))
+            elif name.isdigit() and os.path.isdir(os.path.join(folder, name)):
+                self.remove(os.path.join(folder, name))
+
+    def close(self) -> None:
+        """
+        Waits until all folders are deleted.
+        """
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            folder, done = item
+            shutil.rmtree(folder, ignore_errors=True)
+            if done is not None:
+                done()
+
+
+class CacheBudget:
+    """
+    Shared bookkeeping of the space used in the local cache on the stepping stone.
+    The cache can span several volumes, see CacheVolume. Every transfer reserves the size
+    of its item on the volume with the most headroom before it is fetched into the cache,
+    and releases the reservation when its cache folder is removed. When no volume has
+    enough space, a reservation blocks until other transfers release space or the free
+    space of a volume grows.
+    """
+    def __init__(self, volumes: list, limit: float = float('inf'), cleaner=None) -> None:
+        """
+        volumes: list of CacheVolume, empty when no data passes through the cache
+        limit: optional upper bound of the space used by the whole cache, in bytes
+        cleaner: Cleaner that deletes released folders, they are deleted at once without
+        """
+        self.volumes = volumes
+        self.limit = limit
+        self.cleaner = cleaner
+        self._lock = threading.Condition()
+
+    @property
+    def reserved(self) -> int:
+        return sum(volume.reserved for volume in self.volumes)
+
+    def capacity(self) -> float:
+        """
+        Returns the size in bytes of the largest item that fits in the empty cache.
+        """
+        with self._lock:
+            return self._capacity()
+
+    def _capacity(self) -> float:
+        if not self.volumes:
+            return self.limit
+        return min(self.limit, max(volume.capacity() for volume in self.volumes))
+
+    def fits(self, size: int) -> bool:
+        """
+        Returns True if an item of that size fits in the empty cache.
+        """
+        return size <= self.capacity()
+
+    def reserve(self, size: int):
+        """
+        Reserves size bytes on the volume with the most headroom, waits until the space is
+        available. When no volume has enough space, kept cache entries are removed.
+        Returns: the CacheVolume, None if the item can never fit in the cache
+        """
+        with self._lock:
+            while True:
+                # Space reserved by other transfers is counted as used until it is written,
+                # so the capacity is only final when nothing is being written
+                if size > self._capacity() and not self._writing():
+                    return None
+                rooms = sorted(((volume.headroom(), volume) for volume in self.volumes),
+                               key=lambda room: room[0], reverse=True)
+                headroom, volume = rooms[0]
+                if headroom >= size and self.reserved + size <= self.limit:
+                    volume.reserved += size
+                    volume.unwritten += size
+                    return volume
+                if not self._evict(size, rooms):
+                    self._lock.wait(POLL_INTERVAL)
+
+    def _writing(self) -> bool:
+        """
+        Returns True if reserved space on any volume is not written yet.
+        """
+        return any(volume.unwritten > 0 for volume in self.volumes)
+
+    def _evict(self, size: int, rooms: list) -> bool:
+        """
+        Removes kept cache entries to make space for a reservation, from the volume with
+        the most headroom that has entries.
+        Returns: True if space was freed
+        """
+        over_limit = self.reserved + size - self.limit
+        for headroom, volume in rooms:
+            if volume.items is None:
+                continue
+            evicted = volume.items.evict(max(size - headroom, over_limit))
+            for trash, trash_size in evicted:
+                volume.reserved -= trash_size
+                self._delete(volume, trash, trash_size, rename=False)
+            if evicted:
+                return True
+        return False
+
+    def written(self, volume, size: int) -> None:
+        """
+        Marks reserved space as written: the data is in the cache and counted by the
+        free space of the volume.
+        """
+        with self._lock:
+            if volume is not None:
+                volume.unwritten -= size
+
+    def free(self) -> float:
+        """
+        Returns the space in bytes that can be reserved without waiting.
+        """
+        with self._lock:
+            if not self.volumes:
+                return self.limit - self.reserved
+            return min(self.limit - self.reserved,
+                       max(volume.headroom() for volume in self.volumes))
+
+    def release(self, volume, size: int, unwritten: int = 0, folder: str = None) -> None:
+        """
+        Gives back space reserved by a transfer and removes its cache folder.
+        unwritten: part of the reservation that was not written, see written
+        """
+        with self._lock:
+            if volume is not None:
+                volume.reserved -= size
+                volume.unwritten -= unwritten
+            if folder:
+                self._delete(volume, folder, size - unwritten)
+            self._lock.notify_all()
+
+    def _delete(self, volume, folder: str, size: int, rename: bool = True) -> None:
+        """
+        Deletes a folder, in the background when there is a cleaner. Until it is deleted,
+        its size counts as free space of the volume.
+        """
+        if volume is not None:
+            volume.deleting += size
+        done = functools.partial(self._deleted, volume, size)
+        if self.cleaner is None:
+            shutil.rmtree(folder, ignore_errors=True)
+            done()
+        elif rename:
+            self.cleaner.remove(folder, done)
+        else:
+            self.cleaner.delete(folder, done)
+
+    def _deleted(self, volume, size: int) -> None:
+        with self._lock:
+            if volume is not None:
+                volume.deleting -= size
+            self._lock.notify_all()
+
+
+class ItemCache:
+    """
+    Keeps transferred items in the cache after a transfer, so that exporting the same data
+    again does not fetch it from iRODS again. Entries are keyed by their iRODS path and the
+    checksums registered in iRODS, a changed item gets a new key. When space is needed,
+    the least recently used entries that are not in use are removed.
+    The entries are stored in <cache>/store/<key>/<item name>, with an SQLite index.
+    """
+    def __init__(self, localcache: str) -> None:
+        self.store = os.path.join(localcache, "store")
+        os.makedirs(self.store, exist_ok=True)
+        self._lock = threading.Lock()
+        self._pinned = {}
+        self._db = sqlite3.connect(os.path.join(self.store, "index.sqlite"),
+                                   check_same_thread=False)
+        with self._db:
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS entries (
+                    key TEXT PRIMARY KEY, path TEXT, size INTEGER, last_used REAL)
+                """)
+        # Forget entries that are not on disk, and remove folders that are not in the index
+        keys = {key for (key, ) in self._db.execute("SELECT key FROM entries")}
+        for key in keys - set(os.listdir(self.store)):
+            with self._db:
+                self._db.execute("DELETE FROM entries WHERE key = ?", (key, ))
+        for name in set(os.listdir(self.store)) - keys - {"index.sqlite"}:
+            shutil.rmtree(os.path.join(self.store, name), ignore_errors=True)
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+    def size(self) -> int:
+        """
+        Returns the total size of all entries in bytes.
+        """
+        with self._lock:
+            return self._db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+
+    def entry_dir(self, key: str) -> str:
+        return os.path.join(self.store, key)
+
+    def acquire(self, key: str) -> bool:
+        """
+        Looks up an entry and protects it against eviction until it is released.
+        Returns: True if the entry is in the cache
+        """
+        with self._lock:
+            found = self._db.execute("SELECT key FROM entries WHERE key = ?",
+                                     (key, )).fetchone()
+            if not found:
+                return False
+            self._pinned[key] = self._pinned.get(key, 0) + 1
+            with self._db:
+                self._db.execute("UPDATE entries SET last_used = ? WHERE key = ?",
+                                 (time.time(), key))
+            return True
+
+    def release(self, key: str) -> None:
+        with self._lock:
+            self._pinned[key] -= 1
+            if self._pinned[key] == 0:
+                del self._pinned[key]
+
+    def add(self, key: str, folder: str, path: str, size: int) -> bool:
+        """
+        Moves a folder with a transferred item into the cache.
+        Returns: False if the entry already exists, the folder is then left untouched
+        """
+        with self._lock:
+            if os.path.exists(self.entry_dir(key)):
+                return False
+            os.rename(folder, self.entry_dir(key))
+            with self._db:
+                self._db.execute("INSERT INTO entries VALUES (?, ?, ?, ?)",
+                                 (key, path, size, time.time()))
+            return True
+
+    def evict(self, needed: int) -> list:
+        """
+        Removes least recently used entries that are not in use, until at least needed
+        bytes are freed or no entry can be removed. The entries are renamed aside, the
+        caller deletes them.
+        Returns: list of (renamed folder, size) of the removed entries
+        """
+        evicted, freed = [], 0
+        with self._lock:
+            entries = self._db.execute(
+                "SELECT key, size FROM entries ORDER BY last_used").fetchall()
+            for key, size in entries:
+                if freed >= needed:
+                    break
+                if key in self._pinned:
+                    continue
+                # Rename first, the entry is gone for everyone even if deleting is slow
+                trash = os.path.join(self.store, f"{TRASH_PREFIX}{uuid.uuid4().hex}")
+                os.rename(self.entry_dir(key), trash)
+                with self._db:
+                    self._db.execute("DELETE FROM entries WHERE key = ?", (key, ))
+                evicted.append((trash, size))
+                freed += size
+        return evicted
@@ -0,0 +1,121 @@
+import base64
+import binascii
+import hashlib
+import os
+import sqlite3
+import threading
+from typing import Union
+
+from src.utils import print_error
+
+
+def irods_to_hex(checksum: str) -> Union[tuple, None]:
+    """
+    Converts a checksum registered in iRODS to the format of the coreutils tools.
+    iRODS stores sha256 checksums as "sha2:<base64>" and md5 checksums as hex digest.
+    Returns: (algorithm, hex digest), None if no checksum is registered
+    """
+    if not checksum:
+        return None
+    if checksum.startswith("sha2:"):
+        return "sha256", binascii.hexlify(base64.b64decode(checksum[5:])).decode()
+    return "md5", checksum
+
+
+def file_checksum(path: str, algorithm: str = "sha256") -> str:
+    """
+    Calculates the checksum of a local file.
+    Returns: hex digest
+    """
+    digest = hashlib.new(algorithm)
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(4 * 1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class HashingReader:
+    """
+    Wraps a file object and calculates the checksum of everything that is read from it.
+    """
+    def __init__(self, fileobj, algorithm: str = "sha256") -> None:
+        self.fileobj = fileobj
+        self.digest = hashlib.new(algorithm)
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.fileobj.read(size)
+        self.digest.update(data)
+        return data
+
+    def hexdigest(self) -> str:
+        return self.digest.hexdigest()
+
+
+def compare_manifests(expected: dict, actual: dict) -> list:
+    """
+    Compares two manifests: relative path --> hex digest.
+    Returns: list of paths that are missing or differ in actual
+    """
+    return [path for path, checksum in expected.items() if actual.get(path) != checksum]
+
+
+def unchanged_members(source: dict, copies: list) -> set:
+    """
+    Compares the listing of a source with the listings of its copies.
+    source, copies: relative path --> (size, modification time in unix seconds)
+    A member is unchanged when every copy has it with the same size and a modification time
+    that is not older than that of the source: the copy was made after the last change.
+    Returns: set of unchanged paths, empty without copies
+    """
+    unchanged = set()
+    if not copies:
+        return unchanged
+    for path, (size, mtime) in source.items():
+        if all(path in copy and copy[path][0] == size and copy[path][1] >= mtime
+               for copy in copies):
+            unchanged.add(path)
+    return unchanged
+
+
+class ChecksumCache:
+    """
+    Checksums of local files, stored in an SQLite database and keyed by path, size and
+    modification time. Files that did not change are not hashed again.
+    """
+    def __init__(self, path: str) -> None:
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS checksums (
+                    path TEXT, size INTEGER, mtime INTEGER, algorithm TEXT, checksum TEXT,
+                    PRIMARY KEY (path, size, mtime, algorithm))
+                """)
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+    def checksum(self, path: str, algorithm: str = "sha256") -> Union[str, None]:
+        """
+        Returns the checksum of a local file, from the cache if the file did not change.
+        Returns None if the file cannot be read.
+        """
+        try:
+            stat = os.stat(path)
+        except OSError as error:
+            print_error(f"ERROR: Cannot read {path}: {error}")
+            return None
+        key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns, algorithm)
+        with self._lock:
+            row = self._db.execute(
+                "SELECT checksum FROM checksums "
+                "WHERE path = ? AND size = ? AND mtime = ? AND algorithm = ?", key).fetchone()
+        if row:
+            return row[0]
+
+        checksum = file_checksum(path, algorithm)
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM checksums WHERE path = ?", (key[0], ))
+            self._db.execute("INSERT INTO checksums VALUES (?, ?, ?, ?, ?)", key + (checksum, ))
+        return checksum
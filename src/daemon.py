@@ -0,0 +1,385 @@
+import glob
+import json
+import os
+import socket
+import socketserver
+import sqlite3
+import threading
+import time
+
+import src.irods_functions
+import src.rsync
+from src.utils import print_error, print_message, print_warning
+
+# States of a job of the daemon
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+OPERATIONS = ('export', 'import')
+# Seconds between two looks at the spool folder
+SPOOL_INTERVAL = 1.0
+
+
+class JobQueue:
+    """
+    Persistent queue of the transfer jobs of the daemon, stored in an SQLite database.
+    A job is one or more CSV files of one operation. Jobs are run by priority, higher first,
+    and in order of submission. Jobs that were running when the daemon stopped are queued
+    again and resumed from their journal.
+    """
+    COLUMNS = ('id', 'operation', 'input', 'output', 'priority', 'resume', 'state',
+               'submitted', 'started', 'finished', 'message')
+
+    def __init__(self, path: str) -> None:
+        self._lock = threading.Condition()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT, operation TEXT, input TEXT,
+                    output TEXT, priority INTEGER, resume INTEGER, state TEXT,
+                    submitted REAL, started REAL, finished REAL, message TEXT)
+                """)
+            self._db.execute("UPDATE jobs SET state = ?, resume = 1 WHERE state = ?",
+                             (QUEUED, RUNNING))
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+    def submit(self, operation: str, input_csv: list, output: str = None, priority: int = 0,
+               resume: bool = False) -> int:
+        """
+        Adds a job to the queue.
+        Returns: id of the job
+        """
+        with self._lock:
+            with self._db:
+                cursor = self._db.execute(
+                    "INSERT INTO jobs (operation, input, output, priority, resume, state, "
+                    "submitted) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (operation, json.dumps(input_csv), output, priority, int(resume), QUEUED,
+                     time.time()))
+            self._lock.notify_all()
+            return cursor.lastrowid
+
+    def take(self, timeout: float = None) -> dict:
+        """
+        Marks the next queued job as running, waits up to timeout seconds for one.
+        Returns: the job, None if no job was queued
+        """
+        with self._lock:
+            deadline = None if timeout is None else time.monotonic() + timeout
+            while True:
+                row = self._db.execute(
+                    "SELECT id FROM jobs WHERE state = ? ORDER BY priority DESC, id LIMIT 1",
+                    (QUEUED, )).fetchone()
+                if row:
+                    with self._db:
+                        self._db.execute("UPDATE jobs SET state = ?, started = ? WHERE id = ?",
+                                         (RUNNING, time.time(), row[0]))
+                    return self._get(row[0])
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self._lock.wait(remaining)
+
+    def finish(self, job_id: int, state: str, message: str) -> dict:
+        """
+        Records the outcome of a job. Returns: the job
+        """
+        with self._lock:
+            with self._db:
+                self._db.execute(
+                    "UPDATE jobs SET state = ?, finished = ?, message = ? WHERE id = ?",
+                    (state, time.time(), message, job_id))
+            return self._get(job_id)
+
+    def cancel(self, job_id: int) -> bool:
+        """
+        Cancels a job that did not start yet.
+        Returns: True if the job was cancelled
+        """
+        with self._lock:
+            with self._db:
+                cursor = self._db.execute(
+                    "UPDATE jobs SET state = ?, finished = ? WHERE id = ? AND state = ?",
+                    (CANCELLED, time.time(), job_id, QUEUED))
+            return cursor.rowcount == 1
+
+    def get(self, job_id: int) -> dict:
+        """
+        Returns a job, None if it is not known.
+        """
+        with self._lock:
+            return self._get(job_id)
+
+    def jobs(self, states: tuple = None) -> list:
+        """
+        Returns all jobs, or the jobs in one of the states, in order of submission.
+        """
+        with self._lock:
+            rows = self._db.execute(
+                f"SELECT {', '.join(self.COLUMNS)} FROM jobs ORDER BY id").fetchall()
+        jobs = [self._job(row) for row in rows]
+        return [job for job in jobs if not states or job['state'] in states]
+
+    def _get(self, job_id: int) -> dict:
+        row = self._db.execute(f"SELECT {', '.join(self.COLUMNS)} FROM jobs WHERE id = ?",
+                               (job_id, )).fetchone()
+        return self._job(row) if row else None
+
+    def _job(self, row: tuple) -> dict:
+        job = dict(zip(self.COLUMNS, row))
+        job['input'] = json.loads(job['input'])
+        job['resume'] = bool(job['resume'])
+        return job
+
+
+def parse_job(request: dict) -> dict:
+    """
+    Checks a submitted job: operation, input (a path or a list of paths), and optionally
+    output, priority and resume.
+    Returns: the arguments of JobQueue.submit, None if the job is not valid
+    """
+    operation = request.get('operation')
+    if operation not in OPERATIONS:
+        print_error(f"ERROR: Job has no valid operation: {operation}")
+        return None
+    input_csv = request.get('input')
+    if isinstance(input_csv, str):
+        input_csv = [input_csv]
+    if not input_csv or not all(isinstance(path, str) for path in input_csv):
+        print_error("ERROR: Job has no input")
+        return None
+    missing = [path for path in input_csv if not os.path.exists(path)]
+    if missing:
+        print_error(f"ERROR: Job input does not exist: {', '.join(missing)}")
+        return None
+    try:
+        priority = int(request.get('priority', 0))
+    except (TypeError, ValueError):
+        print_error(f"ERROR: Job has no valid priority: {request.get('priority')}")
+        return None
+    return {'operation': operation, 'input_csv': [os.path.abspath(path) for path in input_csv],
+            'output': request.get('output'), 'priority': priority,
+            'resume': bool(request.get('resume', False))}
+
+
+class Connections:
+    """
+    Connections that stay open between the jobs of the daemon: the iRODS session with its
+    connection pool, and the ssh master connections to the servers that were reached.
+    """
+    def __init__(self, irods_env_file: str) -> None:
+        self.irods_env_file = irods_env_file
+        self._session = None
+        self._reached = set()
+
+    def session(self):
+        """
+        Returns the iRODS session, a session that stopped working is replaced.
+        None if no connection to iRODS can be made.
+        """
+        if self._session is not None:
+            try:
+                self._session.collections.exists("/")
+                return self._session
+            except Exception as error:
+                print_warning(f"WARNING: iRODS session lost, reconnecting: {error!r}")
+                self.close()
+        irods_conn = src.irods_functions.init_irods_connection(
+                irods_env_file=self.irods_env_file)
+        if irods_conn:
+            self._session, _ = irods_conn
+        return self._session
+
+    def connected(self, user: str, server: str, multiplexing: bool) -> bool:
+        """
+        Returns True if an earlier job reached user@server and, with ssh multiplexing,
+        its master connection is still open.
+        """
+        if (user, server) not in self._reached:
+            return False
+        return not multiplexing or src.rsync.ssh_master_alive(user, server)
+
+    def reached(self, user: str, server: str) -> None:
+        self._reached.add((user, server))
+
+    def close(self) -> None:
+        if self._session is not None:
+            self._session.cleanup()
+            self._session = None
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    """
+    Answers the requests on the socket of the daemon: one JSON object per line, with
+    "command" submit, status, list or cancel. Every request gets one JSON line back.
+    """
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line.decode())
+                reply = self.server.daemon.request(request)
+            except ValueError as error:
+                reply = {'ok': False, 'error': f"Not a JSON request: {error}"}
+            self.wfile.write((json.dumps(reply) + "\n").encode())
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class Daemon:
+    """
+    Long running transfer service. Jobs are submitted by dropping a JSON file into the
+    spool folder, or over a local unix socket, and are run one after the other from the
+    persistent JobQueue. The status of every job is written to <output>/status/<id>.json.
+    run_job: callable(job) -> (state, message), runs one job
+    """
+    def __init__(self, jobs: JobQueue, run_job, output_folder: str, spool: str = None,
+                 socketpath: str = None) -> None:
+        self.jobs = jobs
+        self.run_job = run_job
+        self.statusdir = os.path.join(output_folder, "status")
+        self.spool = spool
+        self.socketpath = socketpath
+        self._stop = threading.Event()
+        self._server = None
+        os.makedirs(self.statusdir, exist_ok=True)
+
+    def serve(self) -> None:
+        """
+        Runs the jobs until stop is called, or the process is interrupted.
+        """
+        threads = []
+        if self.spool:
+            for folder in ("accepted", "rejected"):
+                os.makedirs(os.path.join(self.spool, folder), exist_ok=True)
+            threads.append(threading.Thread(target=self._watch_spool, name="spool",
+                                            daemon=True))
+        if self.socketpath:
+            if os.path.exists(self.socketpath):
+                os.remove(self.socketpath)
+            self._server = _Server(self.socketpath, _Handler)
+            self._server.daemon = self
+            threads.append(threading.Thread(target=self._server.serve_forever, name="socket",
+                                            daemon=True))
+        for thread in threads:
+            thread.start()
+        print_message(f"STATUS: Transfer daemon started, {len(self.jobs.jobs((QUEUED, )))} "
+                      + "jobs queued")
+        try:
+            while not self._stop.is_set():
+                job = self.jobs.take(timeout=1.0)
+                if job is None:
+                    continue
+                self.write_status(job)
+                print_message(f"STATUS: Running job {job['id']}: {job['operation']} "
+                              + f"{', '.join(job['input'])}")
+                try:
+                    state, message = self.run_job(job)
+                except Exception as error:
+                    state, message = FAILED, f"Job raised {error!r}"
+                job = self.jobs.finish(job['id'], state, message)
+                self.write_status(job)
+                print_message(f"STATUS: Job {job['id']} {state}: {message}")
+        finally:
+            if self._server is not None:
+                self._server.shutdown()
+                self._server.server_close()
+                os.remove(self.socketpath)
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def submit(self, request: dict) -> dict:
+        """
+        Queues a submitted job. Returns: the job, None if it is not valid
+        """
+        job = parse_job(request)
+        if job is None:
+            return None
+        job = self.jobs.get(self.jobs.submit(**job))
+        self.write_status(job)
+        print_message(f"STATUS: Job {job['id']} queued with priority {job['priority']}")
+        return job
+
+    def request(self, request: dict) -> dict:
+        """
+        Answers a request of the socket.
+        """
+        command = request.get('command')
+        if command == 'submit':
+            job = self.submit(request)
+            if job is None:
+                return {'ok': False, 'error': "Job is not valid"}
+            return {'ok': True, 'job': job}
+        if command == 'status':
+            job = self.jobs.get(request.get('id'))
+            if job is None:
+                return {'ok': False, 'error': f"Unknown job {request.get('id')}"}
+            return {'ok': True, 'job': job}
+        if command == 'list':
+            return {'ok': True, 'jobs': self.jobs.jobs(request.get('states'))}
+        if command == 'cancel':
+            if not self.jobs.cancel(request.get('id')):
+                return {'ok': False, 'error': f"Job {request.get('id')} is not queued"}
+            self.write_status(self.jobs.get(request.get('id')))
+            return {'ok': True}
+        return {'ok': False, 'error': f"Unknown command {command}"}
+
+    def write_status(self, job: dict) -> None:
+        """
+        Writes the status file of a job, it is replaced at once.
+        """
+        path = os.path.join(self.statusdir, f"{job['id']}.json")
+        with open(path + ".tmp", "w") as file:
+            json.dump(job, file, indent=2)
+        os.replace(path + ".tmp", path)
+
+    def _watch_spool(self) -> None:
+        """
+        Queues the JSON files that appear in the spool folder. A file is moved to accepted/
+        as <job id>.json, or to rejected/ when it is not a valid job. Files should be
+        written under another name and renamed to *.json when complete.
+        """
+        while not self._stop.wait(SPOOL_INTERVAL):
+            for path in sorted(glob.glob(os.path.join(self.spool, "*.json"))):
+                try:
+                    with open(path) as file:
+                        request = json.load(file)
+                except (OSError, ValueError) as error:
+                    print_error(f"ERROR: Cannot read job {path}: {error}")
+                    request = None
+                job = self.submit(request) if isinstance(request, dict) else None
+                if job is None:
+                    os.replace(path, os.path.join(self.spool, "rejected",
+                                                  os.path.basename(path)))
+                else:
+                    os.replace(path, os.path.join(self.spool, "accepted", f"{job['id']}.json"))
+
+
+def request(socketpath: str, message: dict) -> dict:
+    """
+    Sends a request to the socket of a running daemon.
+    Returns: the reply, None if the daemon cannot be reached
+    """
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.connect(socketpath)
+            client.sendall((json.dumps(message) + "\n").encode())
+            reply = b""
+            while not reply.endswith(b"\n"):
+                chunk = client.recv(65536)
+                if not chunk:
+                    break
+                reply += chunk
+    except OSError as error:
+        print_error(f"ERROR: Cannot reach the transfer daemon at {socketpath}: {error}")
+        return None
+    return json.loads(reply.decode())
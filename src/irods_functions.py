@@ -1,12 +1,21 @@
-import subprocess
+import calendar
+import hashlib
 import json
 import os
 from datetime import datetime
 from typing import Union
 import irods.session
+from irods.column import In, Like
 from irods.exception import CATALOG_ALREADY_HAS_ITEM_BY_THAT_NAME, CAT_NO_ACCESS_PERMISSION
+from irods.meta import AVUOperation, iRODSMeta
+from irods.models import Collection, DataObject
+import src.retry
+import src.runner
 from src.utils import print_error, print_warning, print_message
 
+# Largest number of data objects fetched by one irsync, keeps the command line short
+OBJECTS_PER_IRSYNC = 500
+
 
 def read_irods_env(irods_env_file: str) -> dict:
     """
@@ -27,8 +36,7 @@ def init_irods_connection(irods_env_file: str) -> Union[tuple, bool]:
     Returns: irods.session, dictionary
     """
     ienv = read_irods_env(irods_env_file=irods_env_file)
-    res = subprocess.run(["ils"], input="bogus".encode(),
-                         stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=False)
+    res = src.runner.run(["ils"], 'irods', input="bogus".encode())
     if res.returncode == 0:
         print_message(f"Connected to: {ienv.get('irods_host')}")
         print_message(res.stdout.decode())
@@ -44,7 +52,7 @@ def irsync_local_to_irods(session: irods.session.iRODSSession, localpath: str,
                           irodspath: str):
     """
     Transfers data from a local filesystem to iRODS. Checks checksums and registers them in iRODS.
-    Returns: True upon success; False otherwise.
+    Returns: True upon success; False, or a src.retry.Failure when the transfer failed.
     """
     print_message(f"iRODS irsync: {localpath} --> {irodspath}")
     if not session.collections.exists(irodspath):
@@ -52,12 +60,13 @@ def irsync_local_to_irods(session: irods.session.iRODSSession, localpath: str,
         return False
 
     localname = os.path.basename(localpath)
+    progress = src.runner.Progress(f"irsync {localpath}")
     if os.path.isdir(localpath):
-        res = subprocess.run(["irsync", "-Kr", f"{localpath}", f"i:{irodspath}/{localname}"],
-                             stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=False)
+        res = src.runner.run(["irsync", "-Krv", f"{localpath}", f"i:{irodspath}/{localname}"],
+                             'irods', progress=progress, capture=False)
     elif os.path.isfile(localpath):
-        res = subprocess.run(["irsync", "-K", f"{localpath}", f"i:{irodspath}/{localname}"],
-                             stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=False)
+        res = src.runner.run(["irsync", "-Kv", f"{localpath}", f"i:{irodspath}/{localname}"],
+                             'irods', progress=progress, capture=False)
     else:
         print_error(f"ERROR: Transferring {localpath} --> {irodspath} failed")
         print_message("Local path not known.")
@@ -68,8 +77,31 @@ def irsync_local_to_irods(session: irods.session.iRODSSession, localpath: str,
     else:
         print_error(f"ERROR: Transferring {localpath} --> {irodspath} failed")
         print_message(res)
+        return src.retry.command_failure(res)
+
+
+def iput_bulk_local_to_irods(session: irods.session.iRODSSession, localpath: str,
+                             irodspath: str) -> bool:
+    """
+    Uploads a local folder with many small files to iRODS with a bulk upload (iput -b),
+    which registers the files in batches instead of one at a time.
+    Checksums are calculated and verified on the fly.
+    Returns: True upon success; False, or a src.retry.Failure when the transfer failed.
+    """
+    print_message(f"iRODS bulk upload: {localpath} --> {irodspath}")
+    if not session.collections.exists(irodspath):
+        print_error(f"ERROR: Destination {irodspath} does not exist")
         return False
 
+    res = src.runner.run(["iput", "-bfKrv", f"{localpath}", f"{irodspath}"], 'irods',
+                         progress=src.runner.Progress(f"iput {localpath}"), capture=False)
+    if res.returncode == 0:
+        return True
+
+    print_error(f"ERROR: Transferring {localpath} --> {irodspath} failed")
+    print_message(res)
+    return src.retry.command_failure(res)
+
 
 def irsync_irods_to_local(session: irods.session.iRODSSession, irodspath: str,
                           localpath: str) -> bool:
@@ -79,7 +111,7 @@ def irsync_irods_to_local(session: irods.session.iRODSSession, irodspath: str,
     Running time can be reduced by firsuring that checksums are already registered in iRODS
     (running "ichksum irodspath" on commandline).
 
-    Returns: True upon success; False otherwise
+    Returns: True upon success; False, or a src.retry.Failure when the transfer failed
     """
     print_message(f"iRODS irsync: {irodspath} --> {localpath}")
     if not os.path.isdir(localpath):
@@ -88,20 +120,199 @@ def irsync_irods_to_local(session: irods.session.iRODSSession, irodspath: str,
 
     itemname = os.path.basename(irodspath)
     if session.collections.exists(irodspath) or session.data_objects.exists(irodspath):
-        res = subprocess.run(["irsync", "-Kr", f"i:{irodspath}", f"{localpath}/{itemname}"],
-                             stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=False)
+        res = src.runner.run(["irsync", "-Krv", f"i:{irodspath}", f"{localpath}/{itemname}"],
+                             'irods', progress=src.runner.Progress(f"irsync {irodspath}"),
+                             capture=False)
         if res.returncode == 0:
             return True
 
         print_error(f"ERROR: Transferring {irodspath} --> {localpath} failed")
         print_message(res)
-        return False
+        return src.retry.command_failure(res)
 
     print_error(f"ERROR: Transferring {irodspath} --> {localpath} failed")
     print_message("iRODS path not known.")
     return False
 
 
+def irsync_objects_to_local(session: irods.session.iRODSSession, collpath: str,
+                            members: list, localpath: str, parallel: int = 4) -> bool:
+    """
+    Transfers a selection of data objects of a collection from iRODS to a local folder.
+    The data objects are stored in localpath/<collection name>/<relative path>, like
+    irsync_irods_to_local does for the whole collection.
+    members: paths of the data objects relative to collpath
+    parallel: number of irsync processes that run at the same time, each fetches the data
+              objects of one subcollection
+
+    Returns: True upon success; False, or a src.retry.Failure when the transfer failed
+    """
+    print_message(f"iRODS irsync: {len(members)} objects of {collpath} --> {localpath}")
+    if not os.path.isdir(localpath):
+        print_error(f"ERROR: Destination {localpath} does not exist")
+        return False
+
+    itemname = os.path.basename(collpath)
+    # One irsync per subcollection with many data objects, so that not every data object
+    # connects to and authenticates with iRODS on its own
+    groups = {}
+    for member in members:
+        groups.setdefault(os.path.dirname(member), []).append(member)
+    chunk_size = max(1, min(OBJECTS_PER_IRSYNC, -(-len(members) // max(1, parallel))))
+    commands, chunks = [], []
+    for folder, group in groups.items():
+        localdir = os.path.join(localpath, itemname, folder)
+        os.makedirs(localdir, exist_ok=True)
+        for start in range(0, len(group), chunk_size):
+            chunk = [f"{collpath}/{member}" for member in group[start:start + chunk_size]]
+            commands.append(["irsync", "-K"] + [f"i:{path}" for path in chunk] + [localdir])
+            chunks.append(chunk)
+    failures = []
+    for res, chunk in zip(src.runner.run_many(commands, 'irods', limit=parallel), chunks):
+        if res.returncode != 0:
+            print_error(f"ERROR: Transferring {len(chunk)} objects --> {res.args[-1]} failed")
+            print_message(res)
+            failure = src.retry.command_failure(res)
+            # Without error lines per data object, all objects of the irsync count as failed
+            failure.paths = failure.paths or chunk
+            failures.append(failure)
+    if failures:
+        return src.retry.combine(failures)
+    return True
+
+
+def _coll_tree_conditions(collpath: str) -> list:
+    """
+    Query conditions for a collection and for all of its subcollections.
+    A _ or % in collpath is a wildcard of the Like condition, so it also matches other
+    collections: filter the results with in_coll_tree.
+    """
+    return [Collection.name == collpath, Like(Collection.name, f"{collpath}/%")]
+
+
+def in_coll_tree(collpath: str, name: str) -> bool:
+    """
+    Returns True if the collection name is collpath or one of its subcollections.
+    """
+    return name == collpath or name.startswith(collpath + "/")
+
+
+def iter_irods_objects(session: irods.session, collpath: str):
+    """
+    Lists all data objects in a collection and its subcollections with catalog queries.
+    The results are fetched page by page, memory use does not grow with the collection.
+    Replicas of the same data object are reported once.
+    Yields: absolute path, size, checksum (None if no checksum is registered)
+    """
+    for condition in _coll_tree_conditions(collpath):
+        query = session.query(Collection.name, DataObject.name, DataObject.size,
+                              DataObject.checksum).filter(condition)
+        previous = None
+        for row in query:
+            if not in_coll_tree(collpath, row[Collection.name]):
+                continue
+            path = f"{row[Collection.name]}/{row[DataObject.name]}"
+            if previous and previous[0] == path:
+                # Another replica, only take its checksum if we did not have one yet
+                if not previous[2]:
+                    previous = (path, previous[1], row[DataObject.checksum])
+                continue
+            if previous:
+                yield previous
+            previous = (path, int(row[DataObject.size]), row[DataObject.checksum])
+        if previous:
+            yield previous
+
+
+def existing_irods_paths(session: irods.session, paths: list) -> set:
+    """
+    Checks which paths exist as collection or data object, with two catalog queries per
+    100 paths instead of two calls per path.
+    Returns: set of the paths that exist
+    """
+    found = set()
+    for start in range(0, len(paths), 100):
+        chunk = set(paths[start:start + 100])
+        query = session.query(Collection.name).filter(In(Collection.name, list(chunk)))
+        found.update(row[Collection.name] for row in query)
+        query = session.query(Collection.name, DataObject.name).filter(
+            In(Collection.name, list({os.path.dirname(path) for path in chunk}))).filter(
+            In(DataObject.name, list({os.path.basename(path) for path in chunk})))
+        found.update(path for path in (f"{row[Collection.name]}/{row[DataObject.name]}"
+                                       for row in query) if path in chunk)
+    return found
+
+
+def irods_manifest(session: irods.session, path: str) -> dict:
+    """
+    Lists size and modification time of a data object, or of all data objects in a
+    collection and its subcollections, with one catalog query per tree condition.
+    Of several replicas the latest modification time is taken.
+    Returns: path relative to path ("" for a data object) --> (size, modify time in unix
+             seconds), empty if the path does not exist
+    """
+    if session.data_objects.exists(path):
+        obj = session.data_objects.get(path)
+        return {"": (int(obj.size), calendar.timegm(obj.modify_time.timetuple()))}
+    manifest = {}
+    if not session.collections.exists(path):
+        return manifest
+    for condition in _coll_tree_conditions(path):
+        query = session.query(Collection.name, DataObject.name, DataObject.size,
+                              DataObject.modify_time).filter(condition)
+        for row in query:
+            if not in_coll_tree(path, row[Collection.name]):
+                continue
+            name = f"{row[Collection.name]}/{row[DataObject.name]}"[len(path) + 1:]
+            mtime = calendar.timegm(row[DataObject.modify_time].timetuple())
+            known = manifest.get(name)
+            manifest[name] = (int(row[DataObject.size]), max(mtime, known[1]) if known else mtime)
+    return manifest
+
+
+def list_irods_objects(session: irods.session, collpath: str):
+    """
+    Lists all data objects in a collection and its subcollections.
+    Yields: path relative to collpath, size, checksum
+    """
+    for path, size, checksum in iter_irods_objects(session, collpath):
+        yield path[len(collpath) + 1:], size, checksum
+
+
+def irods_fingerprint(session: irods.session, path: str) -> Union[str, None]:
+    """
+    Calculates a key for the current content of a data object or collection from the
+    checksums registered in iRODS. The key changes when any data object changes.
+    Returns: hex digest, None if a data object has no registered checksum
+    """
+    digest = hashlib.sha256(path.encode())
+    if session.collections.exists(path):
+        objects = iter_irods_objects(session, path)
+    else:
+        obj = session.data_objects.get(path)
+        objects = [(path, obj.size, obj.checksum)]
+    for objpath, size, checksum in objects:
+        if not checksum:
+            return None
+        digest.update(f"{objpath}\0{size}\0{checksum}\n".encode())
+    return digest.hexdigest()
+
+
+def get_coll_size(session: irods.session, collpath: str) -> int:
+    """
+    Calculates the size of a collection and all of its subcollections in the iRODS catalog.
+    The catalog returns one row per data object with the size of its largest replica, so
+    replicas are counted once and a missing replica does not make the size too small.
+    """
+    size = 0
+    for condition in _coll_tree_conditions(collpath):
+        query = session.query(Collection.name, DataObject.name).filter(condition).max(
+                DataObject.size)
+        size += sum(int(row[DataObject.size]) for row in query
+                    if in_coll_tree(collpath, row[Collection.name]))
+    return size
+
+
 def get_irods_size(session: irods.session, path_names: list) -> int:
     """
     Calculates the cumulative file size of a list of iRODS paths. Paths can
@@ -116,33 +327,57 @@ def get_irods_size(session: irods.session, path_names: list) -> int:
             obj = session.data_objects.get(path_name)
             irods_sizes.append(obj.size)
         elif session.collections.exists(path_name):
-            coll = session.collections.get(path_name)
-            irods_sizes.append(sum((sum((obj.size for obj in objs)) for _, _, objs in coll.walk())))
+            irods_sizes.append(get_coll_size(session, path_name))
     return sum(irods_sizes)
 
 
 def map_collitems_to_folder(session: irods.session, collpath: str, folder: str,
-                            localpath_to_irods=False) -> list:
+                            localpath_to_irods=False):
     """
     Mapping all members of a collection to their absolute path in a folder on a linux filesystem.
+    The members are listed page by page, memory use does not grow with the collection.
     Params:
     session: iRODS session
     collpath: iRODS collection path
     folder: linux or windows path
     localpath_to_irods: direction of output
+    Yields: (iRODS path, local path), or (local path, iRODS path) if localpath_to_irods
     """
-    coll = session.collections.get(collpath)
-    destination = f"{folder}/{os.path.basename(coll.path)}"
-    objs = [obj for _, _, objs in coll.walk() for obj in objs]
+    destination = f"{folder}/{os.path.basename(collpath)}"
 
-    obj_to_file = []
-
-    for obj in objs:
+    for objpath, _, _ in iter_irods_objects(session, collpath):
         if localpath_to_irods:
-            obj_to_file.append((destination+obj.path.split(coll.path)[1], obj.path))
+            yield (destination+objpath.split(collpath)[1], objpath)
         else:
-            obj_to_file.append((obj.path, destination+obj.path.split(coll.path)[1]))
-    return obj_to_file
+            yield (objpath, destination+objpath.split(collpath)[1])
+
+
+def provenance_avu(serverip: str, localpath: str, timestamp: datetime) -> iRODSMeta:
+    """
+    Returns the metadata triple that records a copy of the data on a server:
+        "data_copy_on_server", serverip:localpath, date
+    """
+    return iRODSMeta("data_copy_on_server", serverip+":"+localpath,
+                     timestamp.strftime("%Y-%m-%d"))
+
+
+def annotate_object(session: irods.session, objpath: str, avus: list) -> bool:
+    """
+    Adds AVUs to a data object in one atomic metadata request.
+    Output: True when metadata is added or already present, False otherwise
+    """
+    try:
+        session.metadata.apply_atomic_operations(
+            DataObject, objpath, *[AVUOperation(operation='add', avu=avu) for avu in avus])
+        return True
+    except CATALOG_ALREADY_HAS_ITEM_BY_THAT_NAME:
+        print_warning(f"INFO: Metadata already exists {objpath}")
+        return True
+    except CAT_NO_ACCESS_PERMISSION:
+        print_error(f"ERROR: No permission to add metadata {objpath}")
+    except Exception:
+        print_error(f"ERROR: Metadata could not be added {objpath}")
+    return False
 
 
 def annotate_data(session: irods.session, irodspath: str,
@@ -156,27 +391,17 @@ def annotate_data(session: irods.session, irodspath: str,
     Output: True when metadata is added or already present, False otherwise
     """
     if session.collections.exists(irodspath):
-        coll = session.collections.get(irodspath)
-        annotate_objs = [obj for _, _, objs in coll.walk() for obj in objs]
+        annotate_objs = (path for path, _, _ in iter_irods_objects(session, irodspath))
     elif session.data_objects.exists(irodspath):
-        annotate_objs = [session.data_objects.get(irodspath)]
+        annotate_objs = [irodspath]
     else:
         print_error(f"ERROR: Annotating {irodspath} failed")
         print_message("Path does not exist.")
         return False
 
-    timestamp = datetime.now()
-    print_message(annotate_objs)
-    for obj in annotate_objs:
-        try:
-            obj.metadata.add("data_copy_on_server", serverip+":"+localpath,
-                             timestamp.strftime("%Y-%m-%d"))
-        except CATALOG_ALREADY_HAS_ITEM_BY_THAT_NAME:
-            print_warning("INFO: Metadata already exists {irodspath}")
-        except CAT_NO_ACCESS_PERMISSION:
-            print_error(f"ERROR: No permission to add metadata {irodspath}")
-        except Exception:
-            print_error(f"ERROR: Metadata could not be added {irodspath}")
+    avu = provenance_avu(serverip, localpath, datetime.now())
+    results = [annotate_object(session, objpath, [avu]) for objpath in annotate_objs]
+    return all(results)
 
 
 def ensure_coll(session: irods.session, irodspath: str):
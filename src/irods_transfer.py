@@ -0,0 +1,231 @@
+import concurrent.futures
+import os
+import shutil
+
+import irods.keywords as kw
+import irods.session
+
+import src.checksums
+import src.irods_functions
+import src.retry
+from src.utils import print_error, print_message, print_warning
+
+# python-irodsclient transfers objects from this size on with several threads
+PARALLEL_THRESHOLD = 32 * 1024 * 1024
+BUFFER_SIZE = 4 * 1024 * 1024
+
+
+class IrsyncBackend:
+    """
+    Transfers data between iRODS and the stepping stone with the icommands irsync and iput.
+    """
+    name = "irsync"
+
+    def __init__(self, session: irods.session.iRODSSession) -> None:
+        self.session = session
+
+    def to_local(self, irodspath: str, localpath: str) -> bool:
+        return src.irods_functions.irsync_irods_to_local(self.session, irodspath, localpath)
+
+    def objects_to_local(self, collpath: str, members: list, localpath: str,
+                         sizes: dict = None, checksums: dict = None) -> bool:
+        return src.irods_functions.irsync_objects_to_local(self.session, collpath, members,
+                                                           localpath)
+
+    def to_irods(self, localpath: str, irodspath: str, bundle: bool = False,
+                 members: list = None) -> bool:
+        """
+        members: ignored, irsync only sends the files that differ from iRODS
+        """
+        if bundle:
+            return src.irods_functions.iput_bulk_local_to_irods(self.session, localpath,
+                                                                irodspath)
+        return src.irods_functions.irsync_local_to_irods(self.session, localpath, irodspath)
+
+
+class NativeBackend:
+    """
+    Transfers data between iRODS and the stepping stone through the python-irodsclient
+    session, without icommands. Several data objects are transferred at the same time and
+    large data objects are transferred with several threads each; the connections come from
+    the connection pool of the session.
+    Every data object is verified against the checksum registered in iRODS: small objects
+    are hashed on the fly, large objects after their parallel transfer. Like irsync -K,
+    a missing checksum is calculated and registered in iRODS.
+    """
+    name = "native"
+
+    def __init__(self, session: irods.session.iRODSSession, threads: int = 4,
+                 objects: int = 4) -> None:
+        """
+        threads: threads per data object
+        objects: data objects that are transferred at the same time
+        """
+        self.session = session
+        self.threads = max(1, threads)
+        self.objects = max(1, objects)
+
+    def to_local(self, irodspath: str, localpath: str) -> bool:
+        """
+        Transfers a collection or data object to localpath/<name>, like irsync -Kr.
+        """
+        print_message(f"iRODS get: {irodspath} --> {localpath}")
+        if not os.path.isdir(localpath):
+            print_error(f"ERROR: Destination {localpath} does not exist")
+            return False
+
+        itemname = os.path.basename(irodspath)
+        if self.session.collections.exists(irodspath):
+            objects = ((path, os.path.join(localpath, itemname, path[len(irodspath) + 1:]),
+                        size, checksum)
+                       for path, size, checksum
+                       in src.irods_functions.iter_irods_objects(self.session, irodspath))
+        elif self.session.data_objects.exists(irodspath):
+            obj = self.session.data_objects.get(irodspath)
+            objects = [(irodspath, os.path.join(localpath, itemname), obj.size, obj.checksum)]
+        else:
+            print_error(f"ERROR: Transferring {irodspath} --> {localpath} failed")
+            print_message("iRODS path not known.")
+            return False
+        return self._run(self._get, objects)
+
+    def objects_to_local(self, collpath: str, members: list, localpath: str,
+                         sizes: dict = None, checksums: dict = None) -> bool:
+        """
+        Transfers a selection of data objects of a collection to localpath/<name>/<member>.
+        sizes, checksums: member --> size, registered checksum; looked up when missing
+        """
+        print_message(f"iRODS get: {len(members)} objects of {collpath} --> {localpath}")
+        if not os.path.isdir(localpath):
+            print_error(f"ERROR: Destination {localpath} does not exist")
+            return False
+
+        def objects():
+            itemname = os.path.basename(collpath)
+            for member in members:
+                path = f"{collpath}/{member}"
+                if sizes and checksums and member in sizes and member in checksums:
+                    size, checksum = sizes[member], checksums[member]
+                else:
+                    obj = self.session.data_objects.get(path)
+                    size, checksum = obj.size, obj.checksum
+                yield path, os.path.join(localpath, itemname, member), size, checksum
+        return self._run(self._get, objects())
+
+    def to_irods(self, localpath: str, irodspath: str, bundle: bool = False,
+                 members: list = None) -> bool:
+        """
+        Transfers a local folder or file to irodspath/<name>, like irsync -Kr.
+        bundle: ignored, the data objects of a folder are always put in parallel
+        members: only transfer these files, paths relative to the folder
+        """
+        print_message(f"iRODS put: {localpath} --> {irodspath}")
+        if not self.session.collections.exists(irodspath):
+            print_error(f"ERROR: Destination {irodspath} does not exist")
+            return False
+
+        target = f"{irodspath}/{os.path.basename(localpath)}"
+        if os.path.isfile(localpath):
+            return self._put(localpath, target)
+        if not os.path.isdir(localpath):
+            print_error(f"ERROR: Transferring {localpath} --> {irodspath} failed")
+            print_message("Local path not known.")
+            return False
+
+        files = []
+        if members is not None:
+            for member in members:
+                collection = os.path.dirname(f"{target}/{member}")
+                self.session.collections.create(collection)
+                files.append((os.path.join(localpath, member), f"{target}/{member}"))
+            return self._run(self._put, files)
+        for folder, _, names in os.walk(localpath):
+            relative = os.path.relpath(folder, localpath)
+            collection = target if relative == "." else f"{target}/{relative}"
+            self.session.collections.create(collection)
+            files.extend((os.path.join(folder, name), f"{collection}/{name}") for name in names)
+        return self._run(self._put, files)
+
+    def _run(self, transfer, items):
+        """
+        Runs transfer(*item) for all items, self.objects at the same time. The items are
+        read as the transfers progress. A failure of the network stops the remaining items,
+        they count as failed.
+        Returns: True if all transfers succeeded, a src.retry.Failure with the paths of the
+                 failed items otherwise
+        """
+        items = iter(items)
+        failures = []
+        with concurrent.futures.ThreadPoolExecutor(self.objects) as pool:
+            running = set()
+            for item in items:
+                running.add(pool.submit(transfer, *item))
+                if len(running) >= 2 * self.objects:
+                    done, running = concurrent.futures.wait(
+                            running, return_when=concurrent.futures.FIRST_COMPLETED)
+                    failures.extend(future.result() for future in done
+                                    if future.result() is not True)
+                    if any(failure.transient for failure in failures):
+                        break
+            failures.extend(future.result() for future in running
+                            if future.result() is not True)
+        if not failures:
+            return True
+        paths = [path for failure in failures for path in failure.paths]
+        if any(failure.transient for failure in failures):
+            paths.extend(item[0] for item in items)
+        return src.retry.combine(failures, paths)
+
+    def _get(self, objpath: str, localfile: str, size: int, checksum: str) -> bool:
+        registered = src.checksums.irods_to_hex(checksum)
+        algorithm = registered[0] if registered else "sha256"
+        try:
+            os.makedirs(os.path.dirname(localfile), exist_ok=True)
+            if size < PARALLEL_THRESHOLD or self.threads == 1:
+                with self.session.data_objects.open(objpath, "r") as source, \
+                        open(localfile, "wb") as target:
+                    reader = src.checksums.HashingReader(source, algorithm)
+                    shutil.copyfileobj(reader, target, BUFFER_SIZE)
+                digest = reader.hexdigest()
+            else:
+                self.session.data_objects.get(objpath, localfile, num_threads=self.threads,
+                                              **{kw.FORCE_FLAG_KW: ""})
+                digest = src.checksums.file_checksum(localfile, algorithm)
+            if registered is None:
+                registered = src.checksums.irods_to_hex(
+                        self.session.data_objects.get(objpath).chksum())
+                if registered[0] != algorithm:
+                    digest = src.checksums.file_checksum(localfile, registered[0])
+        except Exception as error:
+            print_error(f"ERROR: Transferring {objpath} --> {localfile} failed: {error!r}")
+            return src.retry.exception_failure(error, objpath)
+        if digest != registered[1]:
+            print_error(f"ERROR: Checksum differs from iRODS: {objpath}")
+            return src.retry.Failure(src.retry.ERROR, "Checksum differs from iRODS", [objpath])
+        return True
+
+    def _put(self, localfile: str, objpath: str) -> bool:
+        try:
+            self.session.data_objects.put(localfile, objpath, num_threads=self.threads,
+                                          **{kw.FORCE_FLAG_KW: ""})
+            registered = src.checksums.irods_to_hex(
+                    self.session.data_objects.get(objpath).chksum())
+            digest = src.checksums.file_checksum(localfile, registered[0])
+        except Exception as error:
+            print_error(f"ERROR: Transferring {localfile} --> {objpath} failed: {error!r}")
+            return src.retry.exception_failure(error, localfile)
+        if digest != registered[1]:
+            print_error(f"ERROR: Checksum differs from iRODS: {objpath}")
+            return src.retry.Failure(src.retry.ERROR, "Checksum differs from iRODS", [localfile])
+        return True
+
+
+def make_backend(session: irods.session.iRODSSession, options: dict):
+    """
+    Returns the transfer backend of the irods_backend option, irsync by default.
+    """
+    if options['irods_backend'] == "native":
+        return NativeBackend(session, options['irods_threads'], options['irods_objects'])
+    if options['irods_backend'] != "irsync":
+        print_warning(f"WARNING: Unknown irods_backend {options['irods_backend']}, using irsync")
+    return IrsyncBackend(session)
@@ -0,0 +1,84 @@
+import sqlite3
+import threading
+
+# States of a CSV line or a member of a collection, in order of progress
+SIZED = 'sized'
+CACHED = 'cached'
+DELIVERED = 'delivered'
+VERIFIED = 'verified'
+FAILED = 'failed'
+
+
+class Journal:
+    """
+    Durable record of the progress of a transfer, stored in an SQLite database.
+    Every CSV line (source, destination) and, for collections transferred in batches,
+    every member goes through the states sized, cached, delivered and verified, or failed.
+    A transfer that was interrupted can be resumed from the journal.
+    """
+    def __init__(self, path: str, operation: str, resume: bool = False) -> None:
+        self.path = path
+        self.operation = operation
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS rows (
+                operation TEXT, source TEXT, dest TEXT, state TEXT, size INTEGER, reason TEXT,
+                PRIMARY KEY (operation, source, dest));
+            CREATE TABLE IF NOT EXISTS objects (
+                operation TEXT, source TEXT, dest TEXT, member TEXT, state TEXT,
+                PRIMARY KEY (operation, source, dest, member));
+            """)
+        if not resume:
+            with self._lock, self._db:
+                self._db.execute("DELETE FROM rows WHERE operation = ?", (operation,))
+                self._db.execute("DELETE FROM objects WHERE operation = ?", (operation,))
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+    def set_row(self, source: str, dest: str, state: str, size: int = None,
+                reason: str = None) -> None:
+        """
+        Records the state of a CSV line. The size is kept when it is not given.
+        """
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR IGNORE INTO rows (operation, source, dest) VALUES (?, ?, ?)",
+                (self.operation, source, dest))
+            self._db.execute(
+                "UPDATE rows SET state = ?, size = COALESCE(?, size), reason = ? "
+                "WHERE operation = ? AND source = ? AND dest = ?",
+                (state, size, reason, self.operation, source, dest))
+
+    def row_state(self, source: str, dest: str) -> str:
+        """
+        Returns the recorded state of a CSV line, None if it is not in the journal.
+        """
+        with self._lock:
+            row = self._db.execute(
+                "SELECT state FROM rows WHERE operation = ? AND source = ? AND dest = ?",
+                (self.operation, source, dest)).fetchone()
+        return row[0] if row else None
+
+    def set_members(self, source: str, dest: str, members: list, state: str) -> None:
+        """
+        Records the state of members of a collection, members are relative paths.
+        """
+        with self._lock, self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO objects (operation, source, dest, member, state) "
+                "VALUES (?, ?, ?, ?, ?)",
+                ((self.operation, source, dest, member, state) for member in members))
+
+    def members_in_state(self, source: str, dest: str, state: str) -> set:
+        """
+        Returns the members of a collection that reached the given state.
+        """
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT member FROM objects "
+                "WHERE operation = ? AND source = ? AND dest = ? AND state = ?",
+                (self.operation, source, dest, state)).fetchall()
+        return {member for (member, ) in rows}
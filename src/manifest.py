@@ -0,0 +1,78 @@
+import os
+import sqlite3
+
+from src.utils import print_warning, read_source_dest_csv
+
+
+def manifest_files(paths: list) -> list:
+    """
+    Expands folders to the CSV files in them, in order of their names. A large manifest
+    can be split into chunks that are placed in one folder.
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(os.path.join(path, name) for name in sorted(os.listdir(path))
+                         if not name.startswith('.')
+                         and os.path.isfile(os.path.join(path, name)))
+        else:
+            files.append(path)
+    return files
+
+
+class Manifest:
+    """
+    The (source, destination) pairs of one or more transfer CSV files, read lazily.
+    Duplicate pairs are skipped with the help of an index in a temporary SQLite database,
+    which is kept on disk when it grows. The pairs are validated in batches, so that
+    checking millions of paths takes few calls to iRODS or the remote server, and the
+    transfer starts after the first batch.
+    """
+    def __init__(self, paths: list, validate, batch_size: int = 1000,
+                 targets: bool = True) -> None:
+        """
+        paths: CSV files, optionally compressed (.gz, .bz2, .xz), or folders of CSV files
+        validate: callable(list of (source, dest)) -> list of (source, dest, info) of the
+                  pairs that can be transferred, info is passed on to the transfer jobs
+        targets: the destinations can list several targets (exports), see normalize_dest
+        """
+        self.files = manifest_files(paths)
+        self.validate = validate
+        self.batch_size = batch_size
+        self.targets = targets
+        self.read = 0
+        self.duplicates = 0
+
+    def rows(self):
+        """
+        Yields: (source, destination) of all files, without duplicates
+        """
+        # An empty file name creates a temporary database that is deleted on close
+        index = sqlite3.connect("")
+        index.execute("CREATE TABLE seen (source TEXT, dest TEXT, PRIMARY KEY (source, dest))")
+        try:
+            for filename in self.files:
+                for source, dest in read_source_dest_csv(filename, self.targets):
+                    self.read += 1
+                    cursor = index.execute("INSERT OR IGNORE INTO seen VALUES (?, ?)",
+                                           (source, dest))
+                    if cursor.rowcount == 0:
+                        self.duplicates += 1
+                        print_warning(f"WARNING: Duplicate line in csv, skipping: {source}, {dest}")
+                        continue
+                    yield source, dest
+        finally:
+            index.close()
+
+    def __iter__(self):
+        """
+        Yields: (source, destination, info) of the valid pairs
+        """
+        batch = []
+        for row in self.rows():
+            batch.append(row)
+            if len(batch) == self.batch_size:
+                yield from self.validate(batch)
+                batch = []
+        if batch:
+            yield from self.validate(batch)
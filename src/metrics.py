@@ -0,0 +1,126 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from src.utils import print_message, print_warning
+
+
+class Metrics:
+    """
+    Timing of the stages of a transfer (ssh, preflight, size, mkdir, irsync, rsync, verify,
+    cleanup, annotate, ...). Every stage of every item is written as one JSON line to the
+    events file, with start and end time, bytes, number of files and throughput.
+    The totals per stage are printed as a summary and can be written as a textfile in the
+    Prometheus format for the node exporter.
+    """
+    def __init__(self, operation: str, eventspath: str = None, textfile: str = None) -> None:
+        self.operation = operation
+        self.textfile = textfile
+        self.started = time.time()
+        self.totals = {}
+        self._lock = threading.Lock()
+        self._events = None
+        if eventspath:
+            try:
+                self._events = open(eventspath, "a")
+            except OSError as error:
+                print_warning(f"WARNING: Cannot write events to {eventspath}: {error}")
+
+    @contextmanager
+    def stage(self, name: str, item: str = None, size: int = None, files: int = None):
+        """
+        Times the stage in the with block. The yielded event can be updated in the block:
+        set event["ok"] = False when the stage failed, or fill in "bytes" and "files".
+        """
+        event = {"stage": name, "item": item, "bytes": size, "files": files, "ok": True}
+        start = time.time()
+        try:
+            yield event
+        except BaseException:
+            event["ok"] = False
+            raise
+        finally:
+            self.record(event, start, time.time())
+
+    def record(self, event: dict, start: float, end: float) -> None:
+        """
+        Adds an event of a stage that ran from start to end, unix time in seconds.
+        """
+        seconds = end - start
+        event.update(operation=self.operation, start=round(start, 3), end=round(end, 3),
+                     seconds=round(seconds, 3), ok=bool(event.get("ok", True)))
+        size = event.get("bytes")
+        if size and seconds > 0:
+            event["throughput"] = round(size / seconds)
+        with self._lock:
+            total = self.totals.setdefault(event["stage"], {
+                "events": 0, "failures": 0, "seconds": 0.0, "bytes": 0, "files": 0})
+            total["events"] += 1
+            total["failures"] += 0 if event["ok"] else 1
+            total["seconds"] += seconds
+            total["bytes"] += size or 0
+            total["files"] += event.get("files") or 0
+            if self._events:
+                self._events.write(json.dumps(event) + "\n")
+                self._events.flush()
+
+    def close(self) -> None:
+        """
+        Prints the summary, writes the metrics textfile and closes the events file.
+        """
+        with self._lock:
+            if self._events:
+                self._events.close()
+                self._events = None
+        self.print_summary()
+        if self.textfile:
+            self.write_textfile(self.textfile)
+
+    def print_summary(self) -> None:
+        print_message(f"Transfer summary ({self.operation}, {time.time() - self.started:.1f}s):")
+        print_message(f"  {'stage':<10} {'count':>7} {'failed':>7} {'seconds':>10} "
+                      f"{'MB':>12} {'MB/s':>9}")
+        for name, total in self.totals.items():
+            megabytes = total["bytes"] / 1e6
+            rate = megabytes / total["seconds"] if total["seconds"] > 0 else 0
+            print_message(f"  {name:<10} {total['events']:>7} {total['failures']:>7} "
+                          f"{total['seconds']:>10.1f} {megabytes:>12.1f} {rate:>9.1f}")
+        print_message("  Stages of parallel workers overlap, their seconds add up.")
+
+    def write_textfile(self, path: str) -> None:
+        """
+        Writes the totals per stage in the Prometheus text format. The file is replaced
+        atomically, the node exporter never reads a partial file.
+        """
+        metrics = [
+            ("events", "events", "Number of times the stage ran in the last transfer"),
+            ("failures", "failures", "Number of times the stage failed in the last transfer"),
+            ("seconds", "duration_seconds", "Time spent in the stage in the last transfer"),
+            ("bytes", "bytes", "Bytes handled by the stage in the last transfer"),
+            ("files", "files", "Files handled by the stage in the last transfer"),
+        ]
+        lines = []
+        for key, name, help_text in metrics:
+            lines.append(f"# HELP ibridges_stage_{name} {help_text}")
+            lines.append(f"# TYPE ibridges_stage_{name} gauge")
+            for stage, total in self.totals.items():
+                lines.append(f'ibridges_stage_{name}{{operation="{self.operation}",'
+                             f'stage="{stage}"}} {total[key]}')
+        lines.append("# HELP ibridges_last_run_timestamp_seconds End time of the last transfer")
+        lines.append("# TYPE ibridges_last_run_timestamp_seconds gauge")
+        lines.append(f'ibridges_last_run_timestamp_seconds{{operation="{self.operation}"}} '
+                     f'{time.time():.3f}')
+        lines.append("# HELP ibridges_last_run_duration_seconds Duration of the last transfer")
+        lines.append("# TYPE ibridges_last_run_duration_seconds gauge")
+        lines.append(f'ibridges_last_run_duration_seconds{{operation="{self.operation}"}} '
+                     f'{time.time() - self.started:.3f}')
+
+        temp = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(temp, "w") as file:
+                file.write("\n".join(lines) + "\n")
+            os.replace(temp, path)
+        except OSError as error:
+            print_warning(f"WARNING: Cannot write metrics to {path}: {error}")
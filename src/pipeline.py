@@ -0,0 +1,376 @@
+import queue
+import threading
+from contextlib import contextmanager
+from typing import Callable, Iterable
+from src.utils import print_error
+
+# Marks the end of the stream of staged jobs
+_DONE = object()
+
+
+class TransferJob:
+    """
+    One line of the transfer CSV on its way through the stepping stone.
+
+    index: position in the CSV, used to name the cache folder of the job
+    source: iRODS path (export) or remote path (import)
+    dest: remote folder (export) or iRODS collection (import)
+    cachedir: folder on the stepping stone the job is staged in
+    volume: cache volume of the cachedir, see src.cache.CacheVolume
+    """
+    def __init__(self, index: int, source: str, dest: str) -> None:
+        self.index = index
+        self.source = source
+        self.dest = dest
+        self.size = 0
+        # Cache space reserved for the job, and the part of it that is not fetched yet
+        self.reserved = 0
+        self.unwritten = 0
+        self.cachedir = None
+        self.volume = None
+        # What the check of the csv line found out about the source, e.g. the preflight
+        self.info = None
+        # Targets of an export the job is pushed to, and (target, reason) of failed targets
+        self.targets = []
+        self.failed_targets = []
+        # Members that failed on their own: destination --> {member: reason}
+        self.failed_members = {}
+        # Servers of the host pool the job was assigned to, a batch leaves them to its row
+        self.hosts = []
+        # Set when the job is one batch of a collection that does not fit in the cache
+        self.row = None
+        self.batch = None
+        self.members = None
+        self.sizes = None
+        self.checksums = None
+        # Set when the item is kept in the cache after the transfer
+        self.cache_key = None
+        self.cache_hit = False
+
+    def __repr__(self) -> str:
+        return f"TransferJob({self.index}, {self.source}, {self.dest})"
+
+
+class TransferRow:
+    """
+    Bookkeeping of one line of the transfer CSV that is transferred in several batches.
+    The line is complete when all batches are planned and finished.
+    """
+    def __init__(self, source: str, dest: str) -> None:
+        self.source = source
+        self.dest = dest
+        self.batches = 0
+        self.finished = 0
+        self.failed = False
+        self.planned = False
+        # Targets of an export, all batches go to the same servers, and the servers of the
+        # host pool the line was assigned to until its last batch is done
+        self.targets = None
+        self.hosts = []
+        self._lock = threading.Lock()
+
+    def add_batch(self) -> int:
+        """
+        Registers a new batch, returns its number.
+        """
+        with self._lock:
+            self.batches += 1
+            return self.batches
+
+    def _complete(self) -> bool:
+        return self.planned and self.finished == self.batches
+
+    def finish_planning(self) -> bool:
+        """
+        Marks that all batches are created. Returns True if the line is complete.
+        """
+        with self._lock:
+            self.planned = True
+            return self._complete()
+
+    def get_targets(self, make: Callable) -> list:
+        """
+        Returns the targets of the line, make() creates them for the first batch.
+        """
+        with self._lock:
+            if self.targets is None:
+                self.targets = make()
+            return self.targets
+
+    def batch_done(self, success: bool) -> bool:
+        """
+        Marks one batch as finished. Returns True if the line is complete.
+        """
+        with self._lock:
+            self.finished += 1
+            self.failed = self.failed or not success
+            return self._complete()
+
+
+class HostPool:
+    """
+    Spreads the transfers over the destination servers of the transfer config. A new job
+    goes to the server with the fewest assigned jobs relative to its max_transfers, and
+    every server runs at most max_transfers transfers at the same time.
+    """
+    def __init__(self, hosts: list) -> None:
+        """
+        hosts: list of src.utils.RemoteHost
+        """
+        self.hosts = hosts
+        self._assigned = {host.name: 0 for host in hosts}
+        self._active = {host.name: 0 for host in hosts}
+        self._lock = threading.Condition()
+
+    def assign(self):
+        """
+        Returns the least busy server for a new job, see release.
+        """
+        with self._lock:
+            host = min(self.hosts,
+                       key=lambda host: self._assigned[host.name] / max(1, host.max_transfers))
+            self._assigned[host.name] += 1
+            return host
+
+    def release(self, host) -> None:
+        """
+        Gives back a server that was assigned to a finished job.
+        """
+        with self._lock:
+            self._assigned[host.name] -= 1
+
+    def find(self, user: str, server: str):
+        """
+        Returns the server of the pool for user@server, None if it is not in the pool.
+        """
+        for host in self.hosts:
+            if (host.datauser, host.serverip) == (user, server):
+                return host
+        return None
+
+    @contextmanager
+    def slot(self, user: str, server: str):
+        """
+        Runs the with block as one transfer to user@server, waits while the server runs
+        max_transfers transfers. Servers that are not in the pool have no limit.
+        """
+        host = self.find(user, server)
+        if host is None or host.max_transfers <= 0:
+            yield
+            return
+        with self._lock:
+            while self._active[host.name] >= host.max_transfers:
+                self._lock.wait()
+            self._active[host.name] += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._active[host.name] -= 1
+                self._lock.notify_all()
+
+
+def split_batches(members: Iterable, limit: float):
+    """
+    Groups members into batches with a total size of at most limit. Members are tuples
+    that start with (name, size).
+    Members that are larger than limit on their own are returned as a batch of one.
+    Yields: list of members, total size
+    """
+    batch = []
+    batch_size = 0
+    for member in members:
+        size = member[1]
+        if batch and batch_size + size > limit:
+            yield batch, batch_size
+            batch = []
+            batch_size = 0
+        batch.append(member)
+        batch_size += size
+    if batch:
+        yield batch, batch_size
+
+
+class SharedJobs:
+    """
+    Hands out the jobs of an iterable to several worker threads, every job exactly once.
+    """
+    def __init__(self, jobs: Iterable) -> None:
+        self._jobs = iter(jobs)
+        self._lock = threading.Lock()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        with self._lock:
+            return next(self._jobs)
+
+
+class JobScheduler:
+    """
+    Hands out the jobs of the plan to the workers in the order of a scheduling policy.
+    The policy chooses from the next `window` jobs of the plan, the plan is read while
+    the transfer runs:
+        shortest: smallest job first, quick wins are transferred early
+        largest: largest job first, the long transfers start early
+        fair: job of the destination that received the fewest bytes so far,
+              csv order per destination
+    When a budget is given, jobs that fit in the free space of the cache are preferred
+    over jobs that would wait for space, so the cache is packed with what fits.
+    """
+    POLICIES = ('fifo', 'shortest', 'largest', 'fair')
+
+    def __init__(self, jobs: Iterable, policy: str, window: int = 1000, budget=None) -> None:
+        self._jobs = iter(jobs)
+        self.policy = policy
+        self.window = max(1, window)
+        self.budget = budget
+        self._pending = []
+        self._served = {}
+        self._lock = threading.Lock()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        with self._lock:
+            while len(self._pending) < self.window:
+                job = next(self._jobs, None)
+                if job is None:
+                    break
+                self._pending.append(job)
+            if not self._pending:
+                raise StopIteration
+            job = self._choose()
+            self._pending.remove(job)
+            self._served[job.dest] = self._served.get(job.dest, 0) + job.size
+            return job
+
+    def _choose(self):
+        candidates = self._pending
+        if self.budget is not None:
+            free = self.budget.free()
+            candidates = [job for job in self._pending if job.size <= free] or self._pending
+        if self.policy == 'shortest':
+            return min(candidates, key=lambda job: job.size)
+        if self.policy == 'largest':
+            return max(candidates, key=lambda job: job.size)
+        if self.policy == 'fair':
+            # min returns the first of equal jobs, which keeps the csv order
+            return min(candidates, key=lambda job: self._served.get(job.dest, 0))
+        return candidates[0]
+
+
+class Worker(threading.Thread):
+    """
+    A worker thread that keeps the exception that stopped it, so that the main thread can
+    raise it again, see join_workers.
+    """
+    def __init__(self, target: Callable, args: tuple = (), name: str = None) -> None:
+        super().__init__(name=name, daemon=True)
+        self._work = target
+        self._args = args
+        self.error = None
+
+    def run(self) -> None:
+        try:
+            self._work(*self._args)
+        except BaseException as error:
+            print_error(f"ERROR: {self.name} stopped: {error!r}")
+            self.error = error
+
+
+def join_workers(threads: list) -> None:
+    """
+    Waits for the workers and raises the first exception that stopped one of them.
+    """
+    for thread in threads:
+        thread.join()
+    for thread in threads:
+        if thread.error is not None:
+            raise thread.error
+
+
+def run_leg(leg: Callable, job, failed: Callable = None) -> bool:
+    """
+    Runs one leg of a job. An unexpected error only fails this job, not the whole worker.
+    failed: callable(job, reason), called when the leg raised an exception
+    """
+    try:
+        return leg(job)
+    except Exception as error:
+        print_error(f"ERROR: {leg.__name__} failed for {job.source}: {error!r}")
+        if failed:
+            failed(job, f"{leg.__name__} raised {error!r}")
+        return False
+
+
+def run_sequential(jobs: Iterable, fetch: Callable, push: Callable,
+                   failed: Callable = None) -> None:
+    """
+    Runs the two transfer legs one job at a time: fetch job N, push job N, fetch job N+1, ...
+    fetch: callable(job) -> bool, stages the job in the cache
+    push: callable(job), moves the job from the cache to its destination and cleans up
+    failed: callable(job, reason), called when a leg raised an exception
+    """
+    for job in jobs:
+        if run_leg(fetch, job, failed):
+            run_leg(push, job, failed)
+
+
+def run_parallel(jobs: Iterable, fetch: Callable, push: Callable, workers: int = 1,
+                 failed: Callable = None) -> None:
+    """
+    Runs several workers at the same time, every worker fetches and pushes one job
+    after the other.
+    """
+    if workers <= 1:
+        run_sequential(jobs, fetch, push, failed)
+        return
+
+    jobs = SharedJobs(jobs)
+    threads = [Worker(run_sequential, (jobs, fetch, push, failed), f"worker-{number}")
+               for number in range(workers)]
+    for thread in threads:
+        thread.start()
+    join_workers(threads)
+
+
+def run_pipelined(jobs: Iterable, fetch: Callable, push: Callable, queue_size: int = 1,
+                  workers: int = 1, failed: Callable = None) -> None:
+    """
+    Runs the two transfer legs in parallel: while job N is pushed to its destination,
+    job N+1 is fetched into the cache. Both legs are linked by a bounded queue, at most
+    queue_size staged jobs wait for the push leg.
+    With several workers, each leg is run by that many threads.
+    fetch: callable(job) -> bool, stages the job in the cache
+    push: callable(job), moves the job from the cache to its destination and cleans up
+    failed: callable(job, reason), called when a leg raised an exception
+    """
+    jobs = SharedJobs(jobs)
+    workers = max(1, workers)
+    staged = queue.Queue(maxsize=max(1, queue_size))
+
+    def fetch_all():
+        for job in jobs:
+            if run_leg(fetch, job, failed):
+                staged.put(job)
+
+    def push_all():
+        while True:
+            job = staged.get()
+            if job is _DONE:
+                break
+            run_leg(push, job, failed)
+
+    fetchers = [Worker(fetch_all, name=f"fetch-{number}") for number in range(workers)]
+    pushers = [Worker(push_all, name=f"push-{number}") for number in range(workers)]
+    for thread in fetchers + pushers:
+        thread.start()
+    for thread in fetchers:
+        thread.join()
+    # The staged jobs are still pushed when a fetcher stopped
+    for _ in pushers:
+        staged.put(_DONE)
+    join_workers(fetchers + pushers)
@@ -0,0 +1,208 @@
+import os
+import random
+import re
+import time
+
+from src.utils import print_warning
+
+# Kinds of failures: the network is transient and retried, the others are not
+NETWORK = 'network'
+PERMISSION = 'permission'
+ERROR = 'error'
+CANCELLED = 'cancelled'
+
+NETWORK_PATTERN = re.compile(
+    r"connection (reset|refused|closed|timed out|unexpectedly closed|lost)|broken pipe|"
+    r"timed out|timeout|network is unreachable|no route to host|could not resolve|"
+    r"host is down|error in rsync protocol data stream|SYS_SOCK_|SYS_HEADER_READ_LEN_ERR|"
+    r"SYS_HEADER_WRITE_LEN_ERR|NetworkException|kex_exchange_identification",
+    re.IGNORECASE)
+PERMISSION_PATTERN = re.compile(
+    r"permission denied|operation not permitted|read-only file system|"
+    r"CAT_NO_ACCESS_PERMISSION|SYS_NO_API_PRIV|CAT_INSUFFICIENT_PRIVILEGE_LEVEL",
+    re.IGNORECASE)
+# Exit codes of rsync and ssh that stand for a broken connection: socket I/O, protocol
+# stream, timeouts and ssh itself
+NETWORK_CODES = (10, 12, 30, 35, 255)
+
+# Paths in the error lines of rsync, e.g. send_files failed to open "/path": ...,
+# and of the icommands, e.g. rsyncUtil: put error for /path status = ...
+RSYNC_PATH = re.compile(r'^rsync(?:: \[\w+\])?:? .*?"([^"]+)"')
+IRODS_PATH = re.compile(r"error for (\S+)")
+# Temporary file of the rsync receiver, .<name>.<random>
+RSYNC_TEMP = re.compile(r"^\.(.+)\.[A-Za-z0-9]{6}$")
+
+
+def classify(message: str, returncode: int = None) -> str:
+    """
+    Tells a failure caused by the network apart from one caused by permissions.
+    Returns: NETWORK, PERMISSION or ERROR
+    """
+    if "Permission denied (publickey" in message:
+        return PERMISSION
+    if NETWORK_PATTERN.search(message):
+        return NETWORK
+    if PERMISSION_PATTERN.search(message):
+        return PERMISSION
+    if returncode in NETWORK_CODES:
+        return NETWORK
+    return ERROR
+
+
+class Failure:
+    """
+    A failed transfer. It is false, like the False that the transfer functions return
+    upon failure, and tells what kind of failure it was.
+    kind: NETWORK, PERMISSION, ERROR or CANCELLED
+    paths: paths of the files or data objects that failed, None when that is not known
+    members: the paths relative to the transferred item, see resolve
+    """
+    def __init__(self, kind: str, message: str, paths: list = None) -> None:
+        self.kind = kind
+        self.message = message
+        self.paths = paths
+        self.members = None
+
+    def __bool__(self) -> bool:
+        return False
+
+    def __repr__(self) -> str:
+        return f"Failure({self.kind}, {self.message!r})"
+
+    @property
+    def transient(self) -> bool:
+        return self.kind == NETWORK
+
+    @property
+    def reason(self) -> str:
+        """
+        Short description for the log of failed transfers.
+        """
+        if self.kind == PERMISSION:
+            return "permission denied"
+        if self.kind == NETWORK:
+            return "network error"
+        return self.kind
+
+    def resolve(self, roots: list) -> None:
+        """
+        Sets members from paths: the paths relative to one of the roots, the paths of the
+        transferred item on both sides. Members stay None when a path is not in the item.
+        """
+        if not self.paths:
+            return
+        members = set()
+        for path in self.paths:
+            folder, name = os.path.split(path)
+            temp = RSYNC_TEMP.match(name)
+            if temp:
+                path = os.path.join(folder, temp.group(1))
+            for root in roots:
+                root = root.rstrip("/")
+                if path.startswith(root + "/"):
+                    members.add(path[len(root) + 1:])
+                    break
+            else:
+                return
+        self.members = sorted(members)
+
+
+def command_failure(result, roots: list = None) -> Failure:
+    """
+    Returns the Failure of a command that failed, see src.runner.CommandResult.
+    The failed files are read from the error lines of rsync and the icommands, unless
+    the connection broke.
+    roots: paths of the transferred item, see Failure.resolve
+    """
+    if result.cancelled:
+        return Failure(CANCELLED, "Cancelled")
+    message = result.stderr.decode(errors="replace").strip()
+    if result.timed_out:
+        kind = NETWORK
+    else:
+        kind = classify(message, result.returncode)
+    paths = []
+    # When the connection broke, the files that were not reached are not listed
+    for line in message.splitlines() if kind != NETWORK else []:
+        match = RSYNC_PATH.match(line) or IRODS_PATH.search(line)
+        if match:
+            paths.append(match.group(1))
+    failure = Failure(kind, message.splitlines()[-1] if message else
+                      f"Exit code {result.returncode}", paths or None)
+    if roots:
+        failure.resolve(roots)
+    return failure
+
+
+def exception_failure(error: Exception, path: str = None) -> Failure:
+    """
+    Returns the Failure of an exception raised by a transfer of path.
+    """
+    message = f"{type(error).__name__}: {error}"
+    if isinstance(error, PermissionError):
+        kind = PERMISSION
+    elif isinstance(error, (ConnectionError, TimeoutError)):
+        kind = NETWORK
+    else:
+        kind = classify(message)
+    return Failure(kind, message, [path] if path else None)
+
+
+def combine(failures: list, paths: list = None) -> Failure:
+    """
+    Returns one Failure for the failures of several files. A transient failure makes the
+    whole transfer transient.
+    paths: paths of the failed files, by default the paths of the failures
+    """
+    kinds = [failure.kind for failure in failures]
+    kind = next((kind for kind in (CANCELLED, NETWORK, PERMISSION) if kind in kinds), ERROR)
+    if paths is None and all(failure.paths for failure in failures):
+        paths = [path for failure in failures for path in failure.paths]
+    return Failure(kind, failures[0].message, paths)
+
+
+class RetryPolicy:
+    """
+    Exponential backoff: the n-th retry waits delay * 2^(n-1) seconds, at most max_delay,
+    with some jitter so that parallel workers do not retry at the same moment.
+    """
+    def __init__(self, retries: int = 3, delay: float = 5.0, max_delay: float = 300.0) -> None:
+        self.retries = max(0, retries)
+        self.delay = delay
+        self.max_delay = max_delay
+
+    def backoff(self, attempt: int) -> float:
+        """
+        Returns the seconds to wait before retry number attempt, counted from 1.
+        """
+        return min(self.max_delay, self.delay * 2 ** (attempt - 1)) * random.uniform(0.8, 1.0)
+
+
+def retry(transfer, policy: RetryPolicy, label: str, roots: list):
+    """
+    Runs a transfer and retries it with exponential backoff while it fails with a
+    transient failure. A retry only sends the members that failed, when they are known.
+    transfer: callable(members) -> True or a Failure, members None is the whole item
+    roots: paths of the item on both sides, to find the failed members, see Failure.resolve
+    Returns: True, or the Failure of the last attempt
+    """
+    members = None
+    for attempt in range(policy.retries + 1):
+        result = transfer(members)
+        if not isinstance(result, Failure):
+            return result
+        if result.members is None:
+            result.resolve(roots)
+        if not result.transient or attempt == policy.retries:
+            if result.members is None:
+                # Only the members of the last attempt were left
+                result.members = members
+            return result
+        if result.members is not None:
+            members = result.members
+        wait = policy.backoff(attempt + 1)
+        print_warning(f"WARNING: {label} failed ({result.reason}: {result.message}), "
+                      + f"retry {attempt + 1} of {policy.retries} in {wait:.1f}s"
+                      + (f" for {len(members)} files" if members else ""))
+        time.sleep(wait)
+    return result
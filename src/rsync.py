@@ -1,15 +1,168 @@
+import os
+import shlex
 import subprocess
+import tempfile
+import threading
+from collections import namedtuple
 from pathlib import Path
 from shutil import rmtree
+import src.retry
+import src.runner
 from src.utils import print_error, print_warning, print_message, print_success
 
+# Control socket per (user, server) of the master connections opened by open_ssh_master
+SSH_MASTERS = {}
+_MASTERS_TRIED = set()
+_MASTERS_LOCK = threading.Lock()
+
+# One destination of an export: remote user and server, folder on the server, the
+# destination as written to the logs, and whether the server was given in the csv
+Target = namedtuple('Target', ['user', 'server', 'path', 'label', 'pinned'])
+
+
+def make_target(user: str, server: str, path: str, default: tuple, pinned: bool = False):
+    """
+    Returns the Target of path on user@server. On the default (user, server) of the transfer
+    config the label is the bare path, otherwise user@server:path.
+    """
+    label = path if (user, server) == default else f"{user}@{server}:{path}"
+    return Target(user, server, path, label, pinned)
+
+
+def parse_targets(dest: str, user: str, server: str, hosts: dict = None) -> list:
+    """
+    Splits a destination into its targets. Targets are separated by ";" and written as
+    [user@]server:/path, as name:/path with the name of a server of the transfer config,
+    or as /path on any server of the transfer config.
+    user, server: remote user and server of the [remote] section of the transfer config
+    hosts: name --> (user, server) of the named servers of the transfer config
+    Returns: list of Target, pinned if a server was given
+    """
+    hosts = hosts or {}
+    targets = []
+    for part in dest.split(";"):
+        part = part.strip()
+        target_user, target_server, path, pinned = user, server, part, False
+        if ":" in part and not part.startswith("/"):
+            host, path = part.split(":", 1)
+            target_user, _, target_server = host.rpartition("@")
+            if not target_user and target_server in hosts:
+                target_user, target_server = hosts[target_server]
+            target_user = target_user or user
+            pinned = True
+        path = "/" + path.strip().strip("/")
+        targets.append(make_target(target_user, target_server, path, (user, server), pinned))
+    return targets
+
+
+def ensure_ssh_master(user: str, server: str) -> bool:
+    """
+    Opens a master connection to user@server, unless that was done or tried before.
+    Returns: True if a master connection is open
+    """
+    with _MASTERS_LOCK:
+        if (user, server) not in _MASTERS_TRIED:
+            _MASTERS_TRIED.add((user, server))
+            open_ssh_master(user, server)
+        return (user, server) in SSH_MASTERS
+
+
+def ssh_options(user: str, server: str) -> list:
+    """
+    Returns the ssh options to reuse the master connection to user@server, if one is open.
+    """
+    if (user, server) in SSH_MASTERS:
+        return ["-o", f"ControlPath={SSH_MASTERS[(user, server)]}", "-o", "ControlMaster=no"]
+    return []
+
+
+def ssh_command(user: str, server: str) -> list:
+    """
+    Returns the ssh command line to run a command on user@server. When a master connection
+    is open, the command is multiplexed over that connection instead of opening a new one.
+    """
+    return ["ssh"] + ssh_options(user, server) + [f"{user}@{server}"]
+
+
+def rsync_command(user: str, server: str, sudo: bool, checksum: bool = True) -> list:
+    """
+    Returns the rsync command line for transfers from or to user@server, using the
+    master connection when one is open.
+    checksum: compare files by checksum (-c) instead of size and modification time
+    """
+    args = ["rsync"]
+    if (user, server) in SSH_MASTERS:
+        args += ["-e", " ".join(shlex.quote(arg) for arg in ["ssh"] + ssh_options(user, server))]
+    if sudo:
+        args.append("--rsync-path=sudo rsync")
+    if src.runner.PROGRESS_INTERVAL:
+        args.append("--info=progress2")
+    return args + ["-rc" if checksum else "-r"]
+
+
+def open_ssh_master(user: str, server: str) -> bool:
+    """
+    Opens one persistent ssh connection to user@server that is shared by all following
+    ssh and rsync calls to that server. Key exchange and authentication are done only once.
+    Returns: True upon success
+    """
+    socketdir = tempfile.mkdtemp(prefix="ibridges-ssh-")
+    with tempfile.TemporaryFile() as errors:
+        # The master keeps running in the background, it must not hold on to our pipes
+        master = subprocess.run(["ssh", "-o", "ConnectTimeout=30", "-o", "ControlMaster=yes",
+                                 "-o", f"ControlPath={socketdir}/master",
+                                 "-o", "ControlPersist=yes", "-M", "-N", "-f",
+                                 f"{user}@{server}"],
+                                stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                                stderr=errors, check=False)
+        if master.returncode != 0:
+            errors.seek(0)
+            print_warning(f"WARNING: Cannot open shared ssh connection to {user}@{server}")
+            print_message(errors.read().decode())
+            rmtree(socketdir, ignore_errors=True)
+            return False
+
+    SSH_MASTERS[(user, server)] = f"{socketdir}/master"
+    return True
+
+
+def ssh_master_alive(user: str, server: str) -> bool:
+    """
+    Checks whether the master connection to user@server is still open. A master that is
+    gone is forgotten, so that ensure_ssh_master opens a new one.
+    """
+    with _MASTERS_LOCK:
+        controlpath = SSH_MASTERS.get((user, server))
+        if controlpath is not None:
+            check = subprocess.run(["ssh", "-o", f"ControlPath={controlpath}", "-O", "check",
+                                    f"{user}@{server}"],
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=False)
+            if check.returncode == 0:
+                return True
+            rmtree(os.path.dirname(controlpath), ignore_errors=True)
+            del SSH_MASTERS[(user, server)]
+        _MASTERS_TRIED.discard((user, server))
+        return False
+
+
+def close_ssh_masters() -> None:
+    """
+    Closes all master connections opened by open_ssh_master.
+    """
+    for (user, server), controlpath in list(SSH_MASTERS.items()):
+        subprocess.run(["ssh", "-o", f"ControlPath={controlpath}", "-O", "exit",
+                        f"{user}@{server}"],
+                       stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=False)
+        rmtree(os.path.dirname(controlpath), ignore_errors=True)
+        del SSH_MASTERS[(user, server)]
+
 
 def ssh_check_connection(datauser: str, serverip: str) -> bool:
     """
     Check ssh datauser@serverip and execute uname -a.
     """
-    ssh = subprocess.run(["ssh", "-o ConnectTimeout=30", f"{datauser}@{serverip}", "uname -a"],
-                         stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=False)
+    ssh = src.runner.run(["ssh", "-o ConnectTimeout=30"] + ssh_options(datauser, serverip)
+                         + [f"{datauser}@{serverip}", "uname -a"], 'ssh')
     if ssh.stderr:
         print_error(f"Connection failed: {datauser}@{serverip}")
         print_message(ssh.stderr.decode())
@@ -26,8 +179,7 @@ def create_remote_dir(datauser: str, serverip: str, sudo: bool, dirpath: str) ->
     Returns: True upon success
     """
     print(f"Ensure directory: {serverip}:{dirpath}")
-    mkdir = subprocess.run(["ssh", f"{datauser}@{serverip}", "mkdir -p", dirpath],
-                           stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=False)
+    mkdir = src.runner.run(ssh_command(datauser, serverip) + ["mkdir -p", dirpath], 'ssh')
     if mkdir.stderr:
         print_error(f"mkdir failed: {datauser} {serverip} {dirpath}")
         print_message(mkdir.stderr.decode())
@@ -45,8 +197,7 @@ def empty_dir(directory: str):
 
 
 def remote_path_exists(user: str, server: str, path: str) -> bool:
-    res = subprocess.run(["ssh", f"{user}@{server}", f"ls {path}"],
-                         stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=False)
+    res = src.runner.run(ssh_command(user, server) + [f"ls {path}"], 'ssh')
     if res.stderr:
         return False
     else:
@@ -54,9 +205,9 @@ def remote_path_exists(user: str, server: str, path: str) -> bool:
 
 
 def is_remote_dir(user: str, server: str, path: str) -> bool:
-    res = subprocess.run(["ssh", f"{user}@{server}", f"test -d { path } && echo 'Directory Exists'"],
-                         stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=False)
-    if res.stdout == "Directory Exists":
+    res = src.runner.run(ssh_command(user, server) + [f"test -d { path } && echo 'Directory Exists'"],
+                         'ssh')
+    if res.stdout.decode().strip() == "Directory Exists":
         return True
     elif res.stderr:
         return False
@@ -65,7 +216,8 @@ def is_remote_dir(user: str, server: str, path: str) -> bool:
 
 
 def rsync_local_to_remote(datauser: str, serverip: str, sudo: bool,
-                          sourcepath: str, destpath: str) -> bool:
+                          sourcepath: str, destpath: str, checksum: bool = True,
+                          min_size: int = 0) -> bool:
     """
     Transfers data from a local server to a remote linux server through rsync.
     Assumes that an ssh keypair was installed for that user beforehand (local priv/pub key
@@ -77,72 +229,218 @@ def rsync_local_to_remote(datauser: str, serverip: str, sudo: bool,
           sudo is needed to overrule that (not recommended)
     sourcepath: local data path, can be file or folder
     destpath: destination folder on remote server
+    checksum: let rsync compare all files by checksum, switch off when the transfer is
+              verified with remote_checksums afterwards
+    min_size: skip files smaller than min_size bytes, e.g. because they are sent as a bundle
 
-    Returns: True (success), False (failure)
+    Returns: True (success), src.retry.Failure (failure)
     """
 
     print_message(f"Uploading data: {sourcepath} --> {datauser}@{serverip}:{destpath}")
-    if sudo:
-        res = subprocess.run(['rsync', '--rsync-path="sudo rsync"', '-rc --relative', sourcepath,
-                             f"{datauser}@{serverip}:{destpath}"],
-                             stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=False)
-    else:
-        res = subprocess.run(['rsync', '-rc', sourcepath,
-                             f"{datauser}@{serverip}:{destpath}"],
-                             stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=False)
+    res = src.runner.run(rsync_command(datauser, serverip, sudo, checksum)
+                         + ([f"--min-size={min_size}"] if min_size else [])
+                         + [sourcepath, f"{datauser}@{serverip}:{destpath}"], 'rsync',
+                         progress=src.runner.Progress(f"rsync {sourcepath}"), capture=False)
 
     if res.stderr:
         print_error(f"rsync failed: {str(res.stderr)}")
-        return False
+        return src.retry.command_failure(res)
+
+    return True
+
+
+def rsync_files_local_to_remote(datauser: str, serverip: str, sudo: bool,
+                                sourcepath: str, files: list, destpath: str,
+                                checksum: bool = True) -> bool:
+    """
+    Transfers a selection of files in a local folder to a remote server through rsync.
+    The files are stored in destpath/<folder name>/<relative path>, like
+    rsync_local_to_remote does for the whole folder.
+    files: paths of the files relative to sourcepath
+    Returns: True (success), src.retry.Failure (failure)
+    """
+    dest = f"{destpath}/{os.path.basename(sourcepath)}"
+    print_message(f"Uploading data: {len(files)} files of {sourcepath} --> "
+                  + f"{datauser}@{serverip}:{dest}")
+    res = src.runner.run(rsync_command(datauser, serverip, sudo, checksum)
+                         + ['--files-from=-', f"{sourcepath}/", f"{datauser}@{serverip}:{dest}"],
+                         'rsync', input="\n".join(files).encode(),
+                         progress=src.runner.Progress(f"rsync {sourcepath}"), capture=False)
+
+    if res.stderr:
+        print_error(f"rsync failed: {str(res.stderr)}")
+        return src.retry.command_failure(res)
 
     return True
 
 
 def rsync_remote_to_local(datauser: str, serverip: str, sudo: bool,
-                          sourcepath: str, destpath: str) -> bool:
+                          sourcepath: str, destpath: str, checksum: bool = True,
+                          min_size: int = 0) -> bool:
     """
     Transfers data from a remote server to a local server through rsync.
     Assumes that an ssh keypair was installed for that user beforehand (local priv/pub key
     and remote authorized_keys files are setup).
-    Returns: True (success), False (failure)
+    min_size: skip files smaller than min_size bytes, e.g. because they are fetched as a bundle
+    Returns: True (success), src.retry.Failure (failure)
     """
 
     print_message(f"Downloading data: {datauser}@{serverip}:{sourcepath} --> {destpath}")
-    if sudo:
-        res = subprocess.run(['rsync', '--rsync-path="sudo rsync"', '-rc --relative',
-                             f"{datauser}@{serverip}:{sourcepath}", destpath],
-                             stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=False)
-    else:
-        res = subprocess.run(['rsync', '-rc',
-                             f"{datauser}@{serverip}:{sourcepath}", destpath],
-                             stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=False)
+    res = src.runner.run(rsync_command(datauser, serverip, sudo, checksum)
+                         + ([f"--min-size={min_size}"] if min_size else [])
+                         + [f"{datauser}@{serverip}:{sourcepath}", destpath], 'rsync',
+                         progress=src.runner.Progress(f"rsync {sourcepath}"), capture=False)
 
     if res.stderr:
         print_error(f"rsync failed: {str(res.stderr)}")
-        return False
+        return src.retry.command_failure(res)
 
     return True
 
 
-def get_remote_size(user: str, server: str, path_names: list) -> int:
+def rsync_files_remote_to_local(datauser: str, serverip: str, sudo: bool,
+                                sourcepath: str, files: list, destpath: str,
+                                checksum: bool = True) -> bool:
+    """
+    Transfers a selection of files in a remote folder to a local server through rsync.
+    The files are stored in destpath/<folder name>/<relative path>, like
+    rsync_remote_to_local does for the whole folder.
+    files: paths of the files relative to sourcepath
+    Returns: True (success), src.retry.Failure (failure)
+    """
+    dest = f"{destpath}/{os.path.basename(sourcepath)}"
+    print_message(f"Downloading data: {len(files)} files of {datauser}@{serverip}:{sourcepath} "
+                  + f"--> {dest}")
+    res = src.runner.run(rsync_command(datauser, serverip, sudo, checksum)
+                         + ['--files-from=-', f"{datauser}@{serverip}:{sourcepath}/", dest],
+                         'rsync', input="\n".join(files).encode(),
+                         progress=src.runner.Progress(f"rsync {sourcepath}"), capture=False)
+
+    if res.stderr:
+        print_error(f"rsync failed: {str(res.stderr)}")
+        return src.retry.command_failure(res)
+
+    return True
+
+
+class RemoteCommandError(RuntimeError):
+    """
+    A command on the remote server failed, its output is incomplete.
+    """
+
+
+def list_remote_files(user: str, server: str, path: str):
+    """
+    Lists all files in a folder on the remote server and its subfolders.
+    Yields: path relative to path, size
+    Raises: RemoteCommandError when the folder cannot be listed completely
+    """
+    res = src.runner.run(ssh_command(user, server) + ['find', shlex.quote(path), '-type', 'f',
+                                                      '-printf', "'%s %P\\n'"], 'ssh')
+    if res.returncode != 0 or res.stderr:
+        print_error(f"Cannot list files: {path}")
+        print_error(f"{res.stderr}")
+        raise RemoteCommandError(f"Cannot list files: {path}")
+    for line in res.stdout.decode().splitlines():
+        size, name = line.split(' ', 1)
+        yield name, int(size)
+
+
+def remote_manifest(user: str, server: str, path: str) -> dict:
+    """
+    Lists size and modification time of a file, or of all files in a folder and its
+    subfolders, on the remote server in one remote call.
+    Returns: path relative to path ("" for a file) --> (size, modification time in unix
+             seconds), empty if the path does not exist
+    """
+    res = src.runner.run(ssh_command(user, server) + ['find', shlex.quote(path), '-type', 'f',
+                                                      '-printf', "'%s %T@ %P\\n'"], 'ssh')
+    manifest = {}
+    for line in res.stdout.decode().splitlines():
+        size, mtime, name = line.split(' ', 2)
+        manifest[name] = (int(size), float(mtime))
+    return manifest
+
+
+# Reads one path per line from stdin and prints: type, total size, number of files, path
+PREFLIGHT_SCRIPT = r"""
+while IFS= read -r path; do
+    if [ -d "$path" ]; then
+        set -- $(find "$path" -type f -printf '%s\n' | awk '{s+=$1; n++} END {printf "%.0f %d", s, n}')
+        printf 'dir\t%s\t%s\t%s\n' "$1" "$2" "$path"
+    elif [ -e "$path" ]; then
+        printf 'file\t%s\t1\t%s\n' "$(stat -c %s "$path")" "$path"
+    else
+        printf 'missing\t0\t0\t%s\n' "$path"
+    fi
+done
+"""
+
+
+def remote_preflight(user: str, server: str, path_names: list) -> dict:
     """
-    Checks cumulative file size of all files in the list path_names on the remote servere.
-    The list can also contain directories.
+    Checks existence, type, size and number of files of all paths on the remote server
+    in one remote call.
     Params:
         user: remote user name
         server: FQDN or IP address
         path_names: list of absolute paths on the remote server
-    Returns: cumulative file size
-    """
-    size = 0
-    for path in path_names:
-        res = subprocess.run(['ssh', f'{user}@{server}', 'du', '-bs', f'{path}'],
-                             stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=False)
-        if res.stdout:
-            path_size = int(res.stdout.split()[0].decode())
-            size = size + path_size
-        else:
-            print_error(f"Cannot determine size: {path}")
-            print_error(f"{res.stderr}")
-
-    return size
+    Returns: dictionary path --> {'exists': bool, 'type': 'dir'|'file'|None,
+                                  'size': cumulative file size, 'count': number of files}
+    Raises: RemoteCommandError when the remote command failed, the paths are not checked
+    """
+    res = src.runner.run(ssh_command(user, server) + ['sh', '-c', shlex.quote(PREFLIGHT_SCRIPT)],
+                         'ssh', input="\n".join(path_names).encode() + b"\n")
+    if res.returncode != 0:
+        print_error(f"Preflight on remote server failed: {user}@{server}")
+        print_error(f"{res.stderr}")
+        raise RemoteCommandError(f"Preflight on {user}@{server} failed")
+
+    preflight = {}
+    for line in res.stdout.decode().splitlines():
+        pathtype, size, count, path = line.split('\t', 3)
+        preflight[path] = {
+            'exists': pathtype != 'missing',
+            'type': None if pathtype == 'missing' else pathtype,
+            'size': int(size),
+            'count': int(count),
+        }
+    return preflight
+
+
+# Runs in folder $1 and prints the checksums of the files on stdin with $2 parallel processes
+CHECKSUM_SCRIPT = r"""
+cd "$1" && xargs -r -d '\n' -P "$2" -n 64 "$3" --
+"""
+
+
+def remote_checksums(user: str, server: str, basepath: str, files: list,
+                     algorithm: str = "sha256", threads: int = 4) -> dict:
+    """
+    Calculates the checksums of files on the remote server in one remote call, with several
+    processes in parallel.
+    Params:
+        basepath: folder on the remote server
+        files: paths relative to basepath
+        algorithm: sha256 or md5
+    Returns: dictionary relative path --> hex digest, files that cannot be read are missing
+    """
+    # Reads all delivered data, it gets the timeout of the transfer itself
+    res = src.runner.run(ssh_command(user, server)
+                         + ['sh', '-c', shlex.quote(CHECKSUM_SCRIPT), 'checksums',
+                            shlex.quote(basepath), str(threads), f'{algorithm}sum'],
+                         'rsync', input="\n".join(files).encode() + b"\n")
+    if res.stderr:
+        print_error(f"Checksums on remote server failed: {basepath}")
+        print_error(f"{res.stderr}")
+
+    checksums = {}
+    for line in res.stdout.decode().splitlines():
+        checksum, path = line.split("  ", 1)
+        if checksum.startswith("\\"):
+            # coreutils escapes file names with a backslash or newline
+            checksum = checksum[1:]
+            path = path.replace("\\n", "\n").replace("\\\\", "\\")
+        checksums[path] = checksum
+    return checksums
+
@@ -0,0 +1,330 @@
+import asyncio
+import concurrent.futures
+import re
+import subprocess
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+from src.utils import print_message
+
+# Seconds a kind of command may run before it is killed, 0 is no limit, see configure
+TIMEOUTS = {'ssh': 0, 'rsync': 0, 'irods': 0}
+# Seconds between two progress messages of a running transfer, 0 switches them off
+PROGRESS_INTERVAL = 30.0
+# At most this many bytes of stderr are kept per command, the end of the output
+STDERR_LIMIT = 1024 * 1024
+
+_ENGINE = None
+_ENGINE_LOCK = threading.Lock()
+# Processes started with popen, they are killed by cancel
+_CHANNELS = set()
+_CHANNELS_LOCK = threading.Lock()
+
+
+def configure(options: dict) -> None:
+    """
+    Sets the timeouts and the progress interval from the transfer options.
+    """
+    global PROGRESS_INTERVAL
+    TIMEOUTS['ssh'] = options['ssh_timeout']
+    TIMEOUTS['rsync'] = options['rsync_timeout']
+    TIMEOUTS['irods'] = options['irods_timeout']
+    PROGRESS_INTERVAL = options['progress_interval']
+
+
+class CommandResult:
+    """
+    Outcome of a command, with the attributes of subprocess.CompletedProcess.
+    A command that timed out or was cancelled has a negative returncode and says so
+    at the end of stderr.
+    """
+    def __init__(self, args: list, returncode: int, stdout: bytes, stderr: bytes,
+                 timed_out: bool = False, cancelled: bool = False) -> None:
+        self.args = args
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+        self.timed_out = timed_out
+        self.cancelled = cancelled
+
+    def __repr__(self) -> str:
+        return (f"CommandResult(args={self.args!r}, returncode={self.returncode!r}, "
+                f"stdout={self.stdout!r}, stderr={self.stderr!r})")
+
+
+class Progress:
+    """
+    Parses the progress output of rsync (--info=progress2) and irsync (-v) line by line
+    and prints a status message at most every PROGRESS_INTERVAL seconds.
+    """
+    RSYNC = re.compile(r"^\s*([\d,]+)\s+(\d+)%\s+(\S+/s)")
+    IRSYNC = re.compile(r"^\s*(\S.*?)\s+([\d.]+) MB \|")
+
+    def __init__(self, label: str) -> None:
+        self.label = label
+        self.bytes = 0
+        self.percent = None
+        self.rate = None
+        self.files = 0
+        self._printed = time.monotonic()
+
+    def __call__(self, line: str) -> None:
+        match = self.RSYNC.match(line)
+        if match:
+            self.bytes = int(match.group(1).replace(",", ""))
+            self.percent = int(match.group(2))
+            self.rate = match.group(3)
+        else:
+            match = self.IRSYNC.match(line)
+            if not match:
+                return
+            self.files += 1
+            self.bytes += int(float(match.group(2)) * 1e6)
+        if PROGRESS_INTERVAL and time.monotonic() - self._printed >= PROGRESS_INTERVAL:
+            self._printed = time.monotonic()
+            print_message(f"STATUS: {self}")
+
+    def __str__(self) -> str:
+        if self.percent is not None:
+            return f"{self.label}: {self.bytes / 1e6:.1f} MB, {self.percent}%, {self.rate}"
+        return f"{self.label}: {self.files} files, {self.bytes / 1e6:.1f} MB"
+
+
+class Engine:
+    """
+    Runs external commands as asyncio subprocesses on one event loop in a background
+    thread. The worker threads submit commands and wait for their result, the loop runs
+    all of them at the same time. The output is read while a command runs: progress lines
+    go to a parser, stdout is only kept when it is needed. Commands are killed when they
+    exceed their timeout or when the engine is cancelled.
+    """
+    def __init__(self) -> None:
+        self._loop = asyncio.new_event_loop()
+        if sys.version_info < (3, 8):
+            # Before 3.8 the child watcher has to be attached from the main thread
+            asyncio.get_child_watcher().attach_loop(self._loop)
+        self._futures = set()
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="commands",
+                                        daemon=True)
+        self._thread.start()
+
+    def run(self, args: list, timeout: float = 0, input: bytes = None, progress=None,
+            capture: bool = True) -> CommandResult:
+        """
+        Runs a command and waits for it to end.
+        timeout: seconds after which the command is killed, 0 is no limit
+        input: bytes written to stdin
+        progress: callable(line), called with every line of stdout, in the loop thread
+        capture: keep stdout in the result
+        """
+        future = asyncio.run_coroutine_threadsafe(
+                self._run(args, timeout, input, progress, capture), self._loop)
+        with self._lock:
+            self._futures.add(future)
+        try:
+            return future.result()
+        except concurrent.futures.CancelledError:
+            return CommandResult(args, -1, b"", b"Cancelled", cancelled=True)
+        finally:
+            with self._lock:
+                self._futures.discard(future)
+
+    def run_many(self, commands: list, timeout: float = 0, limit: int = 0) -> list:
+        """
+        Runs several commands at the same time, at most limit at once if limit is given.
+        commands: list of argument lists
+        Returns: list of CommandResult, in the order of commands
+        """
+        async def run_all():
+            semaphore = asyncio.Semaphore(limit) if limit > 0 else None
+
+            async def run_one(args):
+                if semaphore is None:
+                    return await self._run(args, timeout, None, None, True)
+                async with semaphore:
+                    return await self._run(args, timeout, None, None, True)
+            return await asyncio.gather(*[run_one(args) for args in commands])
+
+        future = asyncio.run_coroutine_threadsafe(run_all(), self._loop)
+        with self._lock:
+            self._futures.add(future)
+        try:
+            return future.result()
+        except concurrent.futures.CancelledError:
+            return [CommandResult(args, -1, b"", b"Cancelled", cancelled=True)
+                    for args in commands]
+        finally:
+            with self._lock:
+                self._futures.discard(future)
+
+    def cancel(self) -> None:
+        """
+        Cancels all running commands, their processes are killed.
+        """
+        with self._lock:
+            futures = list(self._futures)
+        for future in futures:
+            future.cancel()
+
+    def close(self) -> None:
+        self.cancel()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+    async def _run(self, args, timeout, input, progress, capture) -> CommandResult:
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                    *args, stdin=subprocess.PIPE if input is not None else subprocess.DEVNULL,
+                    stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except OSError as error:
+            return CommandResult(args, 127, b"", str(error).encode())
+        stdout, stderr = bytearray(), bytearray()
+
+        async def feed():
+            if input is not None:
+                try:
+                    proc.stdin.write(input)
+                    await proc.stdin.drain()
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+                proc.stdin.close()
+
+        async def read_stdout():
+            pending = b""
+            while True:
+                chunk = await proc.stdout.read(65536)
+                if not chunk:
+                    break
+                if capture:
+                    stdout.extend(chunk)
+                if progress is not None:
+                    # rsync rewrites its progress line with carriage returns
+                    lines = re.split(rb"[\r\n]", pending + chunk)
+                    pending = lines.pop()
+                    for line in lines:
+                        progress(line.decode(errors="replace"))
+
+        async def read_stderr():
+            while True:
+                chunk = await proc.stderr.read(65536)
+                if not chunk:
+                    break
+                stderr.extend(chunk)
+                del stderr[:-STDERR_LIMIT]
+
+        timed_out = False
+        try:
+            await asyncio.wait_for(asyncio.gather(feed(), read_stdout(), read_stderr(),
+                                                  proc.wait()),
+                                   timeout if timeout and timeout > 0 else None)
+        except asyncio.TimeoutError:
+            timed_out = True
+            await self._kill(proc)
+            stderr.extend(f"\nTimed out after {timeout}s".encode())
+        except asyncio.CancelledError:
+            await self._kill(proc)
+            raise
+        return CommandResult(args, proc.returncode, bytes(stdout), bytes(stderr), timed_out)
+
+    @staticmethod
+    async def _kill(proc) -> None:
+        if proc.returncode is None:
+            try:
+                proc.kill()
+            except ProcessLookupError:
+                pass
+            await proc.wait()
+
+
+def engine() -> Engine:
+    """
+    Returns the engine of this process, it is started on first use.
+    """
+    global _ENGINE
+    with _ENGINE_LOCK:
+        if _ENGINE is None:
+            _ENGINE = Engine()
+        return _ENGINE
+
+
+def run(args: list, kind: str, input: bytes = None, progress=None,
+        capture: bool = True) -> CommandResult:
+    """
+    Runs a command on the engine with the timeout of its kind: ssh, rsync or irods.
+    """
+    return engine().run(args, TIMEOUTS.get(kind, 0), input, progress, capture)
+
+
+def run_many(commands: list, kind: str, limit: int = 0) -> list:
+    """
+    Runs several commands of one kind at the same time, see Engine.run_many.
+    """
+    return engine().run_many(commands, TIMEOUTS.get(kind, 0), limit)
+
+
+@contextmanager
+def popen(args: list, kind: str, **kwargs):
+    """
+    Starts a command that the caller feeds or reads through its pipes, e.g. a tar stream
+    over ssh, instead of on the engine. The command is killed when it exceeds the timeout
+    of its kind or when cancel is called, and when the with block is left early.
+    kwargs: passed on to subprocess.Popen
+    Yields: subprocess.Popen, its timed_out and cancelled tell why it was killed
+    """
+    proc = subprocess.Popen(args, **kwargs)
+    proc.timed_out = proc.cancelled = False
+    timer = None
+    if TIMEOUTS.get(kind, 0):
+        def expire():
+            proc.timed_out = True
+            _kill_channel(proc)
+        timer = threading.Timer(TIMEOUTS[kind], expire)
+        timer.daemon = True
+        timer.start()
+    with _CHANNELS_LOCK:
+        _CHANNELS.add(proc)
+    try:
+        yield proc
+    finally:
+        if timer is not None:
+            timer.cancel()
+        with _CHANNELS_LOCK:
+            _CHANNELS.discard(proc)
+        _kill_channel(proc)
+        proc.wait()
+
+
+def _kill_channel(proc) -> None:
+    if proc.poll() is None:
+        try:
+            proc.kill()
+        except ProcessLookupError:
+            pass
+
+
+def cancel() -> None:
+    """
+    Kills all running commands, e.g. when the transfer is interrupted.
+    """
+    if _ENGINE is not None:
+        _ENGINE.cancel()
+    with _CHANNELS_LOCK:
+        channels = list(_CHANNELS)
+    for proc in channels:
+        proc.cancelled = True
+        _kill_channel(proc)
+
+
+def shutdown() -> None:
+    """
+    Stops the engine, running commands are killed.
+    """
+    global _ENGINE
+    with _ENGINE_LOCK:
+        if _ENGINE is not None:
+            _ENGINE.close()
+            _ENGINE = None
@@ -0,0 +1,161 @@
+import os
+import shlex
+import subprocess
+import tarfile
+import tempfile
+import threading
+import time
+
+import irods.session
+
+import src.checksums
+import src.runner
+from src.rsync import ssh_command
+from src.utils import print_error, print_message
+
+
+def _open_remote_untar(datauser: str, serverip: str, sudo: bool, destpath: str, errors):
+    """
+    Starts tar on the remote server, unpacking a stream from stdin in destpath.
+    Returns: context manager of the process, see src.runner.popen
+    """
+    tar_cmd = f"tar -xf - -C {shlex.quote(destpath)}"
+    remote_cmd = f"mkdir -p {shlex.quote(destpath)} && {'sudo ' if sudo else ''}{tar_cmd}"
+    # The remote tar output goes to a file, a full pipe would block the stream.
+    # A tar stream moves data like rsync does, it gets the rsync timeout.
+    return src.runner.popen(ssh_command(datauser, serverip) + [remote_cmd], 'rsync',
+                            stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=errors)
+
+
+def _print_channel_errors(proc, errors) -> None:
+    """
+    Prints why a tar stream over ssh failed: its timeout, a cancel or the ssh output.
+    """
+    if proc.timed_out:
+        print_message("Stopped after the rsync_timeout")
+    elif proc.cancelled:
+        print_message("Cancelled")
+    else:
+        errors.seek(0)
+        print_message(errors.read().decode())
+
+
+def stream_irods_to_remote(session: irods.session.iRODSSession, objects, datauser: str,
+                           serverip: str, sudo: bool, destpath: str) -> list:
+    """
+    Streams data objects from iRODS to a folder on a remote server without storing them on
+    the stepping stone. The data objects are read through the iRODS session and sent as one
+    tar stream over a single ssh channel, which is unpacked on the remote server.
+    The checksum of every data object is calculated on the fly and compared with the
+    checksum registered in iRODS.
+
+    objects: iterable of (iRODS path, name in the tar stream, size, checksum)
+    destpath: folder on the remote server, the names in the stream are relative to it
+    Returns: list of iRODS paths that failed, None if the stream as a whole failed
+    """
+    print_message(f"Streaming data: iRODS --> {datauser}@{serverip}:{destpath}")
+    failed = []
+    with tempfile.TemporaryFile() as errors, \
+            _open_remote_untar(datauser, serverip, sudo, destpath, errors) as proc:
+        try:
+            with tarfile.open(fileobj=proc.stdin, mode="w|", format=tarfile.PAX_FORMAT) as tar:
+                for irodspath, name, size, checksum in objects:
+                    registered = src.checksums.irods_to_hex(checksum)
+                    info = tarfile.TarInfo(name=name)
+                    info.size = size
+                    info.mtime = time.time()
+                    info.mode = 0o644
+                    with session.data_objects.open(irodspath, "r") as obj:
+                        reader = src.checksums.HashingReader(
+                                obj, registered[0] if registered else "sha256")
+                        tar.addfile(info, reader)
+                    if registered and reader.hexdigest() != registered[1]:
+                        print_error(f"ERROR: Checksum differs from iRODS: {irodspath}")
+                        failed.append(irodspath)
+            proc.stdin.close()
+        except (OSError, tarfile.TarError) as error:
+            print_error(f"ERROR: Streaming to {serverip}:{destpath} failed: {error!r}")
+            proc.kill()
+        returncode = proc.wait()
+        if returncode != 0:
+            print_error(f"ERROR: Unpacking on {serverip}:{destpath} failed")
+            _print_channel_errors(proc, errors)
+            return None
+    return failed
+
+
+def bundle_local_to_remote(localpath: str, files: list, datauser: str, serverip: str,
+                           sudo: bool, destpath: str) -> bool:
+    """
+    Sends many (small) files from a local folder to a remote folder as one tar stream over
+    ssh, instead of one file at a time.
+    files: paths relative to localpath, they keep that path relative to destpath
+    Returns: True upon success, False otherwise
+    """
+    print_message(f"Bundling {len(files)} small files: {localpath} "
+                  + f"--> {datauser}@{serverip}:{destpath}")
+    with tempfile.TemporaryFile() as errors, \
+            _open_remote_untar(datauser, serverip, sudo, destpath, errors) as proc:
+        try:
+            with tarfile.open(fileobj=proc.stdin, mode="w|", format=tarfile.PAX_FORMAT) as tar:
+                for name in files:
+                    tar.add(os.path.join(localpath, name), arcname=name, recursive=False)
+            proc.stdin.close()
+        except (OSError, tarfile.TarError) as error:
+            print_error(f"ERROR: Bundling to {serverip}:{destpath} failed: {error!r}")
+            proc.kill()
+        if proc.wait() != 0:
+            print_error(f"ERROR: Unpacking bundle on {serverip}:{destpath} failed")
+            _print_channel_errors(proc, errors)
+            return False
+    return True
+
+
+def bundle_remote_to_local(datauser: str, serverip: str, sudo: bool, sourcepath: str,
+                           files: list, localpath: str) -> bool:
+    """
+    Fetches many (small) files from a remote folder as one tar stream over ssh, instead of
+    one file at a time.
+    files: paths relative to sourcepath, they keep that path relative to localpath
+    Returns: True upon success, False otherwise
+    """
+    print_message(f"Bundling {len(files)} small files: {datauser}@{serverip}:{sourcepath} "
+                  + f"--> {localpath}")
+    remote_cmd = (f"cd {shlex.quote(sourcepath)} && "
+                  + f"{'sudo ' if sudo else ''}tar --null -cf - -T -")
+    with tempfile.TemporaryFile() as errors, \
+            src.runner.popen(ssh_command(datauser, serverip) + [remote_cmd], 'rsync',
+                             stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                             stderr=errors) as proc:
+
+        def send_names():
+            # tar starts sending data before it read all names, so write them in a thread
+            try:
+                proc.stdin.write(b"".join(name.encode() + b"\0" for name in files))
+                proc.stdin.close()
+            except OSError:
+                pass
+
+        sender = threading.Thread(target=send_names, daemon=True)
+        sender.start()
+        success = True
+        try:
+            os.makedirs(localpath, exist_ok=True)
+            with tarfile.open(fileobj=proc.stdout, mode="r|") as tar:
+                for member in tar:
+                    if os.path.isabs(member.name) or ".." in member.name.split("/") \
+                            or not (member.isfile() or member.isdir()):
+                        print_error(f"ERROR: Refusing to unpack {member.name}")
+                        success = False
+                        continue
+                    tar.extract(member, localpath)
+        except (OSError, tarfile.TarError) as error:
+            print_error(f"ERROR: Bundling from {serverip}:{sourcepath} failed: {error!r}")
+            success = False
+            proc.kill()
+        sender.join()
+        if proc.wait() != 0:
+            print_error(f"ERROR: Creating bundle on {serverip}:{sourcepath} failed")
+            _print_channel_errors(proc, errors)
+            return False
+    return success
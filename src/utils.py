@@ -1,6 +1,12 @@
+import bz2
 import configparser
+import gzip
+import lzma
 import os
 import csv
+import threading
+import time
+from collections import namedtuple
 from typing import Union
 
 def print_message(message: str, level: int=0) -> None:
@@ -29,28 +35,133 @@ def get_config(configfile: str) -> Union[tuple, bool]:
             datauser = config.get('remote', 'datauser')
             serverip = config.get('remote', 'serverip')
             sudo = config.getboolean('remote', 'sudo')
-            cachelimit = (config.getfloat('local_cache', 'limit') * 1073741824) # GB to bytes
+            # GB to bytes, without a limit the cache is only bounded by the free space
+            cachelimit = (config.getfloat('local_cache', 'limit', fallback=0) * 1073741824
+                          or float('inf'))
             return (datauser, serverip, sudo, cachelimit)
 
         print_error("ERROR config section expected: remote")
         return None
 
-def read_source_dest_csv(filename: str) -> dict:
-    source_to_dest = []
-    with open(filename, "r") as csv_file:
+# A destination server of the transfer config, max_transfers 0 means no limit
+RemoteHost = namedtuple('RemoteHost', ['name', 'datauser', 'serverip', 'max_transfers'])
+
+def get_remote_hosts(configfile: str) -> list:
+    """
+    Reads the destination servers of the transfer config: the server of the [remote] section,
+    named "default", and one server per optional [remote:<name>] section. A [remote:<name>]
+    section needs serverip, datauser and max_transfers default to those of [remote].
+    Returns: list of RemoteHost, the server of [remote] first
+    """
+    config = configparser.ConfigParser()
+    with open(configfile) as file:
+        config.read_file(file)
+    if 'remote' not in config:
+        return []
+    datauser = config.get('remote', 'datauser')
+    max_transfers = config.getint('remote', 'max_transfers', fallback=0)
+    hosts = [RemoteHost('default', datauser, config.get('remote', 'serverip'), max_transfers)]
+    for section in config.sections():
+        if not section.startswith('remote:'):
+            continue
+        name = section.split(':', 1)[1].strip()
+        if not config.has_option(section, 'serverip'):
+            print_warning(f"WARNING: No serverip in config section {section}, skipping")
+            continue
+        hosts.append(RemoteHost(name,
+                                config.get(section, 'datauser', fallback=datauser),
+                                config.get(section, 'serverip'),
+                                config.getint(section, 'max_transfers', fallback=max_transfers)))
+    return hosts
+
+def get_transfer_options(configfile: str) -> dict:
+    """
+    Reads the optional [transfer] section of the transfer config.
+    Returns a dictionary with all options, missing options are set to their default.
+    """
+    config = configparser.ConfigParser()
+    with open(configfile) as file:
+        config.read_file(file)
+    return {
+        'mode': config.get('transfer', 'mode', fallback='cache'),
+        'pipeline': config.getboolean('transfer', 'pipeline', fallback=False),
+        'queue_size': config.getint('transfer', 'queue_size', fallback=1),
+        'workers': config.getint('transfer', 'workers', fallback=1),
+        'sync': config.getboolean('transfer', 'sync', fallback=False),
+        'schedule': config.get('transfer', 'schedule', fallback='fifo'),
+        'schedule_window': config.getint('transfer', 'schedule_window', fallback=1000),
+        'ssh_multiplexing': config.getboolean('transfer', 'ssh_multiplexing', fallback=True),
+        'verify': config.get('transfer', 'verify', fallback='rsync'),
+        # KB to bytes
+        'bundle_threshold': config.getint('transfer', 'bundle_threshold', fallback=0) * 1024,
+        'verify_threads': config.getint('transfer', 'verify_threads', fallback=4),
+        'annotate': config.getboolean('transfer', 'annotate', fallback=False),
+        'annotate_threads': config.getint('transfer', 'annotate_threads', fallback=4),
+        'metrics_textfile': config.get('transfer', 'metrics_textfile', fallback=''),
+        'irods_backend': config.get('transfer', 'irods_backend', fallback='irsync'),
+        'irods_threads': config.getint('transfer', 'irods_threads', fallback=4),
+        'irods_objects': config.getint('transfer', 'irods_objects', fallback=4),
+        # Seconds, 0 is no limit
+        'ssh_timeout': config.getfloat('transfer', 'ssh_timeout', fallback=0),
+        'rsync_timeout': config.getfloat('transfer', 'rsync_timeout', fallback=0),
+        'irods_timeout': config.getfloat('transfer', 'irods_timeout', fallback=0),
+        'progress_interval': config.getfloat('transfer', 'progress_interval', fallback=30),
+        # Retries of transfers that failed because of the network, delays in seconds
+        'retries': config.getint('transfer', 'retries', fallback=3),
+        'retry_delay': config.getfloat('transfer', 'retry_delay', fallback=5),
+        'retry_max_delay': config.getfloat('transfer', 'retry_max_delay', fallback=300),
+        'keep_cache': config.getboolean('local_cache', 'keep', fallback=False),
+        'cache_dirs': [os.path.expanduser(path.strip()) for path
+                       in config.get('local_cache', 'path',
+                                     fallback=os.getenv('HOME') + "/irodscache").split(",")
+                       if path.strip()],
+        # GB to bytes
+        'cache_margin': int(config.getfloat('local_cache', 'margin', fallback=1) * 1073741824),
+    }
+
+def normalize_dest(dest: str, targets: bool = True) -> str:
+    """
+    Normalizes the destination column of the CSV. The destination of an export can list
+    several targets, separated by ";", of the form [user@]server:/path or /path.
+    targets: False for an iRODS collection, which is one path that may contain ";" and ":"
+    """
+    if not targets:
+        return "/" + dest.strip().strip("/")
+    parts = []
+    for target in dest.split(";"):
+        target = target.strip()
+        if not target:
+            continue
+        host = ""
+        if ":" in target and not target.startswith("/"):
+            host, target = target.split(":", 1)
+            host += ":"
+        parts.append(host + "/" + target.strip().strip("/"))
+    return ";".join(parts) or "/"
+
+# Compressed CSV files are recognised by their extension
+CSV_OPENERS = {'.gz': gzip.open, '.bz2': bz2.open, '.xz': lzma.open}
+
+def read_source_dest_csv(filename: str, targets: bool = True):
+    """
+    Reads a CSV file with one "source, destination" pair per line, line by line.
+    The file can be compressed with gzip, bzip2 or xz.
+    targets: the destinations can list several targets, see normalize_dest
+    Yields: (source, destination)
+    """
+    opener = CSV_OPENERS.get(os.path.splitext(filename)[1], open)
+    with opener(filename, "rt", newline='') as csv_file:
         csv_reader = csv.reader(csv_file)
         for line in csv_reader:
             try:
-                source, dest = "/" + line[0].strip().strip("/"), "/" + line[1].strip().strip("/")
+                source, dest = "/" + line[0].strip().strip("/"), normalize_dest(line[1], targets)
                 if source != "/" and dest != '/':
-                    source_to_dest.append((source, dest))
+                    yield (source, dest)
                 else:
                     print_warning(f"WARNING: Cannot read line in csv, skipping: {line}")
             except Exception:
                 print_warning(f"WARNING: Cannot read line in csv, skipping: {line}")
 
-    return source_to_dest
-
 def create_dir(path: str) -> bool:
     """
     Creates a local directory, if it does not exist.
@@ -62,22 +173,61 @@ def create_dir(path: str) -> bool:
     except Exception:
         return False
 
-def write_csv(success: list,
-              failure: list,
-              successpath: str,
-              failurepath: str) -> None:
-    with open(successpath, 'w') as out:
-        csv_out = csv.writer(out)
-        csv_out.writerow(['iRODS', 'local'])
-        for row in success:
-            csv_out.writerow(row)
-
-    print_message(f"Wrote succesful transfers to {successpath}")
-
-    with open(failurepath, 'w') as out:
-        csv_out = csv.writer(out)
-        csv_out.writerow(['iRODS', 'local', 'reason'])
-        for row in failure:
-            csv_out.writerow(row)
-
-    print_message(f"Wrote failed transfers to {failurepath}")
+class CsvLog:
+    """
+    CSV file that rows are written to while the transfer runs, instead of collecting them
+    in memory. A background thread flushes new rows every flush_interval seconds, so that
+    a crash loses at most the rows of that interval.
+    """
+    def __init__(self, path: str, header: list, description: str,
+                 flush_interval: float = 5.0) -> None:
+        self.path = path
+        self.description = description
+        self.flush_interval = flush_interval
+        self.rows = 0
+        self._lock = threading.Lock()
+        self._file = open(path, 'w', newline='')
+        self._writer = csv.writer(self._file)
+        self._writer.writerow(header)
+        self._file.flush()
+        self._flushed = time.monotonic()
+        self._dirty = False
+        self._closing = threading.Event()
+        self._flusher = threading.Thread(target=self._flush_periodically,
+                                         name=f"flush-{os.path.basename(path)}", daemon=True)
+        self._flusher.start()
+
+    def append(self, row: tuple) -> None:
+        with self._lock:
+            self._writer.writerow(row)
+            self.rows += 1
+            self._dirty = True
+            if time.monotonic() - self._flushed >= self.flush_interval:
+                self._flush()
+
+    def _flush(self) -> None:
+        self._file.flush()
+        self._flushed = time.monotonic()
+        self._dirty = False
+
+    def _flush_periodically(self) -> None:
+        while not self._closing.wait(self.flush_interval):
+            with self._lock:
+                if self._dirty and not self._file.closed:
+                    self._flush()
+
+    def extend(self, rows) -> None:
+        """
+        Writes rows, an iterable is written while it is consumed. Other threads can write
+        in between, a long listing does not block them.
+        """
+        for row in rows:
+            self.append(row)
+
+    def close(self) -> None:
+        self._closing.set()
+        with self._lock:
+            if self._file.closed:
+                return
+            self._file.close()
+        print_message(f"Wrote {self.rows} {self.description} to {self.path}")
@@ -0,0 +1,52 @@
+import collections
+import threading
+from unittest import mock
+
+import src.cache
+
+Usage = collections.namedtuple('Usage', ['total', 'used', 'free'])
+
+
+def test_reserve_waits_while_another_reservation_is_written(tmp_path):
+    # The free space of the disk drops while the first batch is written
+    disk = {'free': 100}
+    with mock.patch('src.cache.shutil.disk_usage',
+                    lambda path: Usage(100, 100 - disk['free'], disk['free'])), \
+            mock.patch('src.cache.POLL_INTERVAL', 0.05):
+        budget = src.cache.CacheBudget([src.cache.CacheVolume(str(tmp_path))])
+        first = budget.reserve(90)
+        assert first is not None
+        # 30 of the 90 bytes are fetched, the reservation is not marked as written yet
+        disk['free'] = 70
+
+        reserved = []
+        waiting = threading.Thread(target=lambda: reserved.append(budget.reserve(90)))
+        waiting.start()
+        waiting.join(0.2)
+        assert waiting.is_alive()
+
+        budget.written(first, 90)
+        disk['free'] = 100
+        budget.release(first, 90)
+        waiting.join(5)
+        assert reserved == [first]
+
+
+def test_reserve_gives_up_when_nothing_is_written(tmp_path):
+    with mock.patch('src.cache.shutil.disk_usage', lambda path: Usage(100, 0, 100)):
+        budget = src.cache.CacheBudget([src.cache.CacheVolume(str(tmp_path))])
+        assert budget.reserve(101) is None
+
+
+def test_sweep_removes_job_folders_of_an_earlier_run(tmp_path):
+    for name in ["0", "17", ".trash-0123", "store"]:
+        (tmp_path / name).mkdir()
+        (tmp_path / name / "stale").write_text("stale")
+    (tmp_path / "checksums.sqlite").write_text("")
+
+    cleaner = src.cache.Cleaner()
+    cleaner.sweep(str(tmp_path))
+    cleaner.close()
+
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["checksums.sqlite", "store"]
+    assert (tmp_path / "store" / "stale").exists()
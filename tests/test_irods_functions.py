@@ -0,0 +1,68 @@
+import pytest
+
+pytest.importorskip("irods")
+
+import src.irods_functions
+from irods.models import Collection, DataObject
+
+
+class Catalog:
+    """
+    Answers the catalog queries of get_coll_size from a list of replicas, like GenQuery:
+    a Like condition on the collection name treats _ as a wildcard.
+    """
+    def __init__(self, replicas: list) -> None:
+        # (collection, data object, replica number, size)
+        self.replicas = replicas
+
+    def query(self, *columns):
+        return CatalogQuery(self.replicas)
+
+
+class CatalogQuery:
+    def __init__(self, replicas: list) -> None:
+        self.replicas = replicas
+        self.condition = None
+
+    def filter(self, condition):
+        self.condition = condition
+        return self
+
+    def max(self, column):
+        return self
+
+    def _matches(self, name: str) -> bool:
+        value = self.condition.value
+        if self.condition.op == "=":
+            return name == value
+        prefix = value[:-1]
+        return len(name) > len(prefix) and all(
+            want in ("_", have) for want, have in zip(prefix, name))
+
+    def __iter__(self):
+        sizes = {}
+        for collection, name, _, size in self.replicas:
+            if self._matches(collection):
+                key = (collection, name)
+                sizes[key] = max(sizes.get(key, 0), size)
+        for (collection, name), size in sizes.items():
+            yield {Collection.name: collection, DataObject.name: name, DataObject.size: size}
+
+
+def test_coll_size_counts_every_data_object_once():
+    # After trimming, the data objects have their replicas under different numbers
+    catalog = Catalog([("/zone/a_b", "x", 0, 10), ("/zone/a_b", "x", 1, 10),
+                       ("/zone/a_b", "y", 1, 20), ("/zone/a_b/sub", "z", 2, 30)])
+    assert src.irods_functions.get_coll_size(catalog, "/zone/a_b") == 60
+
+
+def test_coll_size_leaves_out_collections_matched_by_wildcards():
+    catalog = Catalog([("/zone/a_b/sub", "z", 0, 30), ("/zone/aXb/sub", "w", 0, 1000)])
+    assert src.irods_functions.get_coll_size(catalog, "/zone/a_b") == 30
+
+
+def test_in_coll_tree():
+    assert src.irods_functions.in_coll_tree("/zone/a_b", "/zone/a_b")
+    assert src.irods_functions.in_coll_tree("/zone/a_b", "/zone/a_b/sub")
+    assert not src.irods_functions.in_coll_tree("/zone/a_b", "/zone/aXb/sub")
+    assert not src.irods_functions.in_coll_tree("/zone/a_b", "/zone/a_bc")
@@ -0,0 +1,63 @@
+import src.journal
+from src.journal import CACHED, DELIVERED, FAILED, SIZED, VERIFIED, Journal
+
+
+def test_rows_go_through_their_states(tmp_path):
+    journal = Journal(str(tmp_path / "journal.sqlite"), "export")
+    assert journal.row_state("/zone/x", "/data") is None
+    journal.set_row("/zone/x", "/data", SIZED, 100)
+    for state in (CACHED, DELIVERED, VERIFIED):
+        journal.set_row("/zone/x", "/data", state)
+        assert journal.row_state("/zone/x", "/data") == state
+    journal.set_row("/zone/x", "/data", FAILED, reason="rsync failed")
+    assert journal.row_state("/zone/x", "/data") == FAILED
+    journal.close()
+
+
+def test_rows_are_per_destination_and_operation(tmp_path):
+    path = str(tmp_path / "journal.sqlite")
+    exports = Journal(path, "export")
+    exports.set_row("/zone/x", "/data/a", VERIFIED)
+    exports.set_row("/zone/x", "/data/b", FAILED)
+    assert exports.row_state("/zone/x", "/data/a") == VERIFIED
+    assert exports.row_state("/zone/x", "/data/b") == FAILED
+
+    imports = Journal(path, "import")
+    assert imports.row_state("/zone/x", "/data/a") is None
+    exports.close()
+    imports.close()
+
+
+def test_members_keep_their_latest_state(tmp_path):
+    journal = Journal(str(tmp_path / "journal.sqlite"), "export")
+    journal.set_members("/zone/c", "/data", ["a", "b", "c"], CACHED)
+    journal.set_members("/zone/c", "/data", ["a", "b"], VERIFIED)
+    journal.set_members("/zone/c", "/data", ["b"], FAILED)
+    assert journal.members_in_state("/zone/c", "/data", VERIFIED) == {"a"}
+    assert journal.members_in_state("/zone/c", "/data", FAILED) == {"b"}
+    assert journal.members_in_state("/zone/c", "/other", VERIFIED) == set()
+    journal.close()
+
+
+def test_only_resume_keeps_the_journal(tmp_path):
+    path = str(tmp_path / "journal.sqlite")
+    journal = Journal(path, "export")
+    journal.set_row("/zone/x", "/data", VERIFIED)
+    journal.set_members("/zone/c", "/data", ["a"], VERIFIED)
+    journal.close()
+
+    journal = Journal(path, "export", resume=True)
+    assert journal.row_state("/zone/x", "/data") == VERIFIED
+    assert journal.members_in_state("/zone/c", "/data", VERIFIED) == {"a"}
+    journal.close()
+
+    journal = Journal(path, "export")
+    assert journal.row_state("/zone/x", "/data") is None
+    assert journal.members_in_state("/zone/c", "/data", VERIFIED) == set()
+    journal.close()
+
+
+def test_states_are_distinct():
+    states = [src.journal.SIZED, src.journal.CACHED, src.journal.DELIVERED,
+              src.journal.VERIFIED, src.journal.FAILED]
+    assert len(set(states)) == len(states)
@@ -0,0 +1,56 @@
+import gzip
+
+import src.checksums
+from src.manifest import Manifest, manifest_files
+
+
+def keep_all(rows: list) -> list:
+    return [(source, dest, None) for (source, dest) in rows]
+
+
+def test_duplicate_lines_are_skipped_across_files(tmp_path):
+    (tmp_path / "a.csv").write_text("/zone/x,/data/in\n/zone/y,/data/in\n/zone/x,/data/in/\n")
+    with gzip.open(tmp_path / "b.csv.gz", "wt") as file:
+        file.write("/zone/y,/data/in\n/zone/x,/data/other\n")
+    manifest = Manifest([str(tmp_path / "a.csv"), str(tmp_path / "b.csv.gz")], keep_all)
+    assert [(source, dest) for source, dest, _ in manifest] == [
+        ("/zone/x", "/data/in"), ("/zone/y", "/data/in"), ("/zone/x", "/data/other")]
+    assert manifest.read == 5
+    assert manifest.duplicates == 2
+
+
+def test_folders_are_read_in_order_of_names(tmp_path):
+    for name in ["2.csv", "10.csv", ".hidden.csv"]:
+        (tmp_path / name).write_text(f"/zone/{name},/data/in\n")
+    (tmp_path / "sub").mkdir()
+    assert manifest_files([str(tmp_path)]) == [str(tmp_path / "10.csv"), str(tmp_path / "2.csv")]
+
+
+def test_rows_are_validated_in_batches(tmp_path):
+    (tmp_path / "a.csv").write_text("".join(f"/zone/{number},/data/in\n" for number in range(5)))
+    batches = []
+
+    def validate(rows):
+        batches.append(len(rows))
+        # Odd sources do not exist
+        return [(source, dest, None) for (source, dest) in rows if int(source[6:]) % 2 == 0]
+
+    manifest = Manifest([str(tmp_path / "a.csv")], validate, batch_size=2)
+    assert [source for source, _, _ in manifest] == ["/zone/0", "/zone/2", "/zone/4"]
+    assert batches == [2, 2, 1]
+
+
+def test_unchanged_members_need_the_same_size_and_a_newer_copy():
+    source = {"same": (10, 100.0), "newer copy": (10, 100.0), "resized": (10, 100.0),
+              "changed later": (10, 100.0), "missing": (10, 100.0)}
+    copy = {"same": (10, 100.0), "newer copy": (10, 200.0), "resized": (11, 200.0),
+            "changed later": (10, 50.0)}
+    assert src.checksums.unchanged_members(source, [copy]) == {"same", "newer copy"}
+
+
+def test_unchanged_members_must_be_unchanged_at_every_copy():
+    source = {"a": (1, 1.0), "b": (1, 1.0)}
+    copies = [{"a": (1, 1.0), "b": (1, 1.0)}, {"a": (1, 1.0)}]
+    assert src.checksums.unchanged_members(source, copies) == {"a"}
+    assert src.checksums.unchanged_members(source, []) == set()
+    assert src.checksums.unchanged_members({}, copies) == set()
@@ -0,0 +1,134 @@
+import threading
+
+import src.pipeline
+import src.utils
+
+
+def batches(members: list, limit: float) -> list:
+    return [([member[0] for member in batch], size)
+            for batch, size in src.pipeline.split_batches(members, limit)]
+
+
+def test_split_batches_fills_up_to_the_limit():
+    members = [("a", 4), ("b", 6), ("c", 5), ("d", 5), ("e", 1)]
+    assert batches(members, 10) == [(["a", "b"], 10), (["c", "d"], 10), (["e"], 1)]
+
+
+def test_split_batches_keeps_the_order_and_all_members():
+    members = [(f"m{number}", number % 7 + 1) for number in range(100)]
+    split = batches(members, 20)
+    assert [name for names, _ in split for name in names] == [name for name, _ in members]
+    assert all(size <= 20 for _, size in split)
+
+
+def test_split_batches_returns_oversized_members_on_their_own():
+    members = [("a", 3), ("huge", 50), ("b", 3)]
+    assert batches(members, 10) == [(["a"], 3), (["huge"], 50), (["b"], 3)]
+
+
+def test_split_batches_of_nothing():
+    assert batches([], 10) == []
+    assert batches(iter([]), 10) == []
+
+
+def test_split_batches_passes_checksums_on():
+    split = list(src.pipeline.split_batches([("a", 1, "sha2:x"), ("b", 1, "sha2:y")], 10))
+    assert split == [([("a", 1, "sha2:x"), ("b", 1, "sha2:y")], 2)]
+
+
+def make_jobs(sizes: list, dests: list = None) -> list:
+    jobs = []
+    for index, size in enumerate(sizes):
+        job = src.pipeline.TransferJob(index, f"/zone/{index}", dests[index] if dests else "/d")
+        job.size = size
+        jobs.append(job)
+    return jobs
+
+
+def order(policy: str, jobs: list, window: int = 1000, budget=None) -> list:
+    return [job.index for job in src.pipeline.JobScheduler(jobs, policy, window, budget)]
+
+
+class Budget:
+    def __init__(self, free: float) -> None:
+        self.free_space = free
+
+    def free(self) -> float:
+        return self.free_space
+
+
+def test_fifo_keeps_the_csv_order():
+    assert order('fifo', make_jobs([5, 1, 3])) == [0, 1, 2]
+
+
+def test_shortest_and_largest_first():
+    jobs = make_jobs([5, 1, 3, 1])
+    assert order('shortest', jobs) == [1, 3, 2, 0]
+    assert order('largest', make_jobs([5, 1, 3, 1])) == [0, 2, 1, 3]
+
+
+def test_policies_only_look_at_the_window():
+    assert order('shortest', make_jobs([5, 4, 3, 2, 1]), window=2) == [1, 2, 3, 4, 0]
+
+
+def test_fair_share_alternates_destinations():
+    jobs = make_jobs([10, 10, 10, 1, 1], ["/a", "/a", "/a", "/b", "/b"])
+    assert order('fair', jobs) == [0, 3, 4, 1, 2]
+
+
+def test_jobs_that_fit_in_the_free_cache_go_first():
+    jobs = make_jobs([8, 2, 9, 3])
+    assert order('fifo', jobs, budget=Budget(5)) == [1, 3, 0, 2]
+    # Without a job that fits, the policy decides
+    assert order('shortest', make_jobs([8, 9, 7]), budget=Budget(5)) == [2, 0, 1]
+
+
+def test_scheduler_hands_every_job_out_once_to_several_workers():
+    scheduler = src.pipeline.JobScheduler(make_jobs(list(range(200))), 'largest', 10)
+    taken = []
+
+    def work():
+        for job in scheduler:
+            taken.append(job.index)
+
+    threads = [threading.Thread(target=work) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(taken) == list(range(200))
+
+
+def make_pool() -> src.pipeline.HostPool:
+    return src.pipeline.HostPool([src.utils.RemoteHost("a", "u", "10.0.0.1", 1),
+                                  src.utils.RemoteHost("b", "u", "10.0.0.2", 2)])
+
+
+def test_host_pool_assigns_relative_to_max_transfers():
+    pool = make_pool()
+    assert [pool.assign().name for _ in range(6)] == ["a", "b", "b", "a", "b", "b"]
+    pool.release(pool.hosts[0])
+    pool.release(pool.hosts[0])
+    assert pool.assign().name == "a"
+
+
+def test_host_slot_waits_while_the_server_runs_max_transfers():
+    pool = make_pool()
+    entered = []
+
+    def transfer():
+        with pool.slot("u", "10.0.0.1"):
+            entered.append(True)
+
+    with pool.slot("u", "10.0.0.1"):
+        waiting = threading.Thread(target=transfer)
+        waiting.start()
+        waiting.join(0.2)
+        assert waiting.is_alive() and not entered
+        # Other servers, and servers that are not in the pool, are not held up
+        with pool.slot("u", "10.0.0.2"), pool.slot("u", "10.0.0.2"):
+            pass
+        with pool.slot("x", "10.9.9.9"):
+            pass
+    waiting.join(5)
+    assert entered == [True]
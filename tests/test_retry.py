@@ -0,0 +1,163 @@
+from unittest import mock
+
+import src.retry
+from src.runner import CommandResult
+
+# Error output of rsync, ssh and the icommands as they print it
+RSYNC_CONNECTION_CLOSED = (
+    b"rsync: connection unexpectedly closed (0 bytes received so far) [Receiver]\n"
+    b"rsync error: error in rsync protocol data stream (code 12) at io.c(231) "
+    b"[Receiver=3.2.7]\n")
+SSH_TIMEOUT = (
+    b"ssh: connect to host 10.0.0.5 port 22: Connection timed out\r\n"
+    b"rsync: connection unexpectedly closed (0 bytes received so far) [sender]\n"
+    b"rsync error: unexplained error (code 255) at io.c(231) [sender=3.2.7]\n")
+SSH_PUBLICKEY = b"alice@10.0.0.5: Permission denied (publickey,password).\r\n"
+RSYNC_SENDER_DENIED = (
+    b'rsync: [sender] send_files failed to open "/cache/3/item/secret.txt": '
+    b"Permission denied (13)\n"
+    b"rsync error: some files/attrs were not transferred (see previous errors) (code 23) "
+    b"at main.c(1338) [sender=3.2.7]\n")
+RSYNC_RECEIVER_DENIED = (
+    b'rsync: [receiver] mkstemp "/data/in/item/sub/.report.csv.Xa91Qz" failed: '
+    b"Permission denied (13)\n"
+    b"rsync error: some files/attrs were not transferred (see previous errors) (code 23) "
+    b"at main.c(1338) [generator=3.2.7]\n")
+RSYNC_OLD_DENIED = (
+    b'rsync: send_files failed to open "/cache/3/item/secret.txt": Permission denied (13)\n'
+    b"rsync error: some files/attrs were not transferred (see previous errors) (code 23) "
+    b"at main.c(1196) [sender=3.1.3]\n")
+RSYNC_VANISHED = (
+    b'rsync: [sender] link_stat "/cache/3/item/gone.txt" failed: No such file or directory '
+    b"(2)\n"
+    b"rsync error: some files/attrs were not transferred (see previous errors) (code 23) "
+    b"at main.c(1338) [sender=3.2.7]\n")
+IRSYNC_NO_ACCESS = (
+    b"remote addresses: 10.0.0.1 ERROR: rsyncUtil: put error for "
+    b"/zone/home/alice/in/item/secret.txt status = -818000 CAT_NO_ACCESS_PERMISSION\n")
+IRSYNC_COPY_ERROR = (
+    b"ERROR: rsyncUtil: get error for /zone/home/alice/item/big.dat status = -27000 "
+    b"SYS_COPY_LEN_ERR\n")
+ICOMMAND_SERVER_DOWN = (
+    b"ERROR: _rcConnect: connectToRhost error, server on irods.example.org:1247 is probably "
+    b"down status = -305111 USER_SOCK_CONNECT_ERR, Connection refused\n")
+IPUT_HEADER_READ = (
+    b"ERROR: putUtil: put error for /zone/home/alice/in/item/a.txt status = -4000 "
+    b"SYS_HEADER_READ_LEN_ERR\n")
+
+ROOTS = ["/cache/3/item", "/data/in/item", "/zone/home/alice/in/item", "/zone/home/alice/item"]
+
+
+def failure(stderr: bytes, returncode: int = 23, **kwargs) -> src.retry.Failure:
+    return src.retry.command_failure(CommandResult(["cmd"], returncode, b"", stderr, **kwargs),
+                                     ROOTS)
+
+
+def test_network_failures_are_transient():
+    for stderr, returncode in [(RSYNC_CONNECTION_CLOSED, 12), (SSH_TIMEOUT, 255),
+                               (ICOMMAND_SERVER_DOWN, 3), (IPUT_HEADER_READ, 4)]:
+        result = failure(stderr, returncode)
+        assert result.kind == src.retry.NETWORK, stderr
+        assert result.transient
+        # The files that were not reached are not listed, the whole item is retried
+        assert result.paths is None and result.members is None
+
+
+def test_network_exit_code_without_message():
+    assert failure(b"", 255).kind == src.retry.NETWORK
+    assert failure(b"", 1).kind == src.retry.ERROR
+
+
+def test_timeout_and_cancel():
+    assert failure(b"Timed out", -9, timed_out=True).kind == src.retry.NETWORK
+    assert failure(b"Cancelled", -1, cancelled=True).kind == src.retry.CANCELLED
+
+
+def test_permission_failures_name_their_members():
+    for stderr, member in [(RSYNC_SENDER_DENIED, "secret.txt"),
+                           (RSYNC_OLD_DENIED, "secret.txt"),
+                           (RSYNC_RECEIVER_DENIED, "sub/report.csv"),
+                           (IRSYNC_NO_ACCESS, "secret.txt")]:
+        result = failure(stderr)
+        assert result.kind == src.retry.PERMISSION, stderr
+        assert not result.transient
+        assert result.reason == "permission denied"
+        assert result.members == [member]
+
+
+def test_ssh_key_refused_is_a_permission_failure():
+    assert failure(SSH_PUBLICKEY, 255).kind == src.retry.PERMISSION
+
+
+def test_other_errors_name_their_members():
+    result = failure(RSYNC_VANISHED)
+    assert result.kind == src.retry.ERROR
+    assert result.paths == ["/cache/3/item/gone.txt"]
+    assert result.members == ["gone.txt"]
+    assert failure(IRSYNC_COPY_ERROR, 3).members == ["big.dat"]
+
+
+def test_resolve_outside_the_roots_leaves_members_unknown():
+    result = src.retry.Failure(src.retry.ERROR, "error",
+                               ["/cache/3/item/a.txt", "/elsewhere/b.txt"])
+    result.resolve(ROOTS)
+    assert result.members is None
+    # A root is not a prefix of a sibling with a longer name
+    result = src.retry.Failure(src.retry.ERROR, "error", ["/cache/3/item2/a.txt"])
+    result.resolve(ROOTS)
+    assert result.members is None
+
+
+def test_combine_prefers_transient_failures():
+    combined = src.retry.combine([failure(RSYNC_SENDER_DENIED),
+                                  failure(RSYNC_CONNECTION_CLOSED, 12)])
+    assert combined.kind == src.retry.NETWORK
+    # The network failure does not know its files
+    assert combined.paths is None
+
+
+def test_retry_narrows_to_the_failed_members():
+    attempts = []
+
+    def transfer(members):
+        attempts.append(members)
+        if len(attempts) == 1:
+            return src.retry.Failure(src.retry.NETWORK, "reset", ["/cache/3/item/b.txt"])
+        return True
+
+    with mock.patch("src.retry.time.sleep"):
+        result = src.retry.retry(transfer, src.retry.RetryPolicy(3, 0, 0), "rsync", ROOTS)
+    assert result is True
+    assert attempts == [None, ["b.txt"]]
+
+
+def test_retry_gives_up_on_permission_failures_and_after_the_retries():
+    attempts = []
+
+    def denied(members):
+        attempts.append(members)
+        return failure(RSYNC_SENDER_DENIED)
+
+    with mock.patch("src.retry.time.sleep"):
+        result = src.retry.retry(denied, src.retry.RetryPolicy(3, 0, 0), "rsync", ROOTS)
+    assert attempts == [None]
+    assert result.members == ["secret.txt"]
+
+    attempts.clear()
+
+    def unreachable(members):
+        attempts.append(members)
+        return failure(SSH_TIMEOUT, 255)
+
+    with mock.patch("src.retry.time.sleep") as sleep:
+        result = src.retry.retry(unreachable, src.retry.RetryPolicy(2, 1, 300), "rsync", ROOTS)
+    assert len(attempts) == 3
+    assert not result and result.transient
+    # Exponential backoff with jitter: 1 s, then 2 s
+    waits = [call.args[0] for call in sleep.call_args_list]
+    assert 0.8 <= waits[0] <= 1.0 and 1.6 <= waits[1] <= 2.0
+
+
+def test_backoff_is_capped():
+    policy = src.retry.RetryPolicy(10, 5, 60)
+    assert policy.backoff(10) <= 60
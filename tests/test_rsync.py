@@ -0,0 +1,26 @@
+from src.rsync import parse_targets
+
+HOSTS = {"node2": ("bob", "10.0.0.2")}
+
+
+def test_parse_targets_of_one_path():
+    [target] = parse_targets("/data/in", "alice", "10.0.0.1", HOSTS)
+    assert target == ("alice", "10.0.0.1", "/data/in", "/data/in", False)
+
+
+def test_parse_targets_of_several_servers():
+    targets = parse_targets("/data/in;carol@10.0.0.9:/scratch/;node2:/in;10.0.0.1:/x",
+                            "alice", "10.0.0.1", HOSTS)
+    assert [(target.user, target.server, target.path, target.pinned) for target in targets] == [
+        ("alice", "10.0.0.1", "/data/in", False),
+        ("carol", "10.0.0.9", "/scratch", True),
+        ("bob", "10.0.0.2", "/in", True),
+        ("alice", "10.0.0.1", "/x", True)]
+    # Targets on the server of the config are logged with their bare path
+    assert [target.label for target in targets] == [
+        "/data/in", "carol@10.0.0.9:/scratch", "bob@10.0.0.2:/in", "/x"]
+
+
+def test_parse_targets_of_an_unknown_server_name():
+    [target] = parse_targets("cluster:/in", "alice", "10.0.0.1", HOSTS)
+    assert (target.user, target.server, target.path) == ("alice", "cluster", "/in")
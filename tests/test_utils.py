@@ -0,0 +1,30 @@
+import src.utils
+from src.utils import normalize_dest
+
+
+def test_normalize_dest_of_one_path():
+    assert normalize_dest(" /data/in/ ") == "/data/in"
+    assert normalize_dest("data/in") == "/data/in"
+    assert normalize_dest("") == "/"
+
+
+def test_normalize_dest_of_several_targets():
+    assert normalize_dest("/data/in; alice@10.0.0.5:/scratch/in/ ;node2:scratch") \
+        == "/data/in;alice@10.0.0.5:/scratch/in;node2:/scratch"
+    assert normalize_dest("/data/in;;") == "/data/in"
+
+
+def test_normalize_dest_of_an_irods_collection_is_not_split():
+    assert normalize_dest("/zone/home/alice/a;b/", targets=False) == "/zone/home/alice/a;b"
+    assert normalize_dest("/zone/home/alice/run:1", targets=False) == "/zone/home/alice/run:1"
+
+
+def test_read_source_dest_csv(tmp_path):
+    path = tmp_path / "transfer.csv"
+    path.write_text("/zone/coll/, /data/in;server:/in\n"
+                    "only one column\n"
+                    "/zone/x,/\n")
+    assert list(src.utils.read_source_dest_csv(str(path))) == [
+        ("/zone/coll", "/data/in;server:/in")]
+    assert list(src.utils.read_source_dest_csv(str(path), targets=False)) == [
+        ("/zone/coll", "/data/in;server:/in")]
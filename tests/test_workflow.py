@@ -0,0 +1,160 @@
+import csv
+
+import pytest
+
+pytest.importorskip("irods")
+
+import src.cache
+import src.journal
+import src.metrics
+import src.rsync
+import src.utils
+from transfer_workflow import iBridgesSteppingStone
+
+
+@pytest.fixture
+def bridge(tmp_path):
+    """
+    A stepping stone with what planning an import needs, and a cache of 10 bytes.
+    """
+    bridge = iBridgesSteppingStone.__new__(iBridgesSteppingStone)
+    bridge.operation = 'import'
+    bridge.resume = False
+    bridge.options = {'sync': False}
+    bridge.metrics = src.metrics.Metrics('import')
+    bridge.journal = src.journal.Journal(str(tmp_path / "journal.sqlite"), 'import')
+    bridge.budget = src.cache.CacheBudget([], 10)
+    bridge.success = src.utils.CsvLog(str(tmp_path / "success.csv"), ['source', 'dest'],
+                                      "succesful transfers")
+    bridge.failure = src.utils.CsvLog(str(tmp_path / "failure.csv"),
+                                      ['source', 'dest', 'reason'], "failed transfers")
+    yield bridge
+    bridge.close_logs()
+    bridge.journal.close()
+
+
+def plan(bridge, rows: list, sizes: dict, listings: dict) -> list:
+    """
+    Plans rows of (source, dest) with the given sizes and listings of the sources.
+    A size or listing that is an exception is raised.
+    """
+    def size_of(source, info):
+        if isinstance(sizes[source], Exception):
+            raise sizes[source]
+        return sizes[source]
+
+    def list_members(source, info):
+        listing = listings.get(source)
+        if isinstance(listing, Exception):
+            raise listing
+        return None if listing is None else iter(listing)
+
+    bridge.source_to_dest = iter([(source, dest, {}) for (source, dest) in rows])
+    return list(bridge.plan_jobs(size_of, list_members))
+
+
+def failures(bridge) -> list:
+    bridge.failure.close()
+    with open(bridge.failure.path) as file:
+        return list(csv.reader(file))[1:]
+
+
+def test_items_that_fit_are_one_job(bridge):
+    jobs = plan(bridge, [("/remote/a", "/zone/in")], {"/remote/a": 8}, {})
+    assert [(job.source, job.size, job.members) for job in jobs] == [("/remote/a", 8, None)]
+    assert bridge.journal.row_state("/remote/a", "/zone/in") == src.journal.SIZED
+
+
+def test_items_larger_than_the_cache_are_batched(bridge):
+    listing = [("x", 6), ("y", 4), ("z", 7)]
+    jobs = plan(bridge, [("/remote/a", "/zone/in")], {"/remote/a": 17}, {"/remote/a": listing})
+    assert [(job.members, job.size, job.batch) for job in jobs] == [
+        (["x", "y"], 10, 1), (["z"], 7, 2)]
+    row = jobs[0].row
+    assert row is jobs[1].row and row.planned and row.batches == 2
+
+    for job in jobs:
+        bridge.job_succeeded(job)
+    assert bridge.journal.row_state("/remote/a", "/zone/in") == src.journal.VERIFIED
+
+
+def test_single_file_larger_than_the_cache_fails(bridge):
+    jobs = plan(bridge, [("/remote/f", "/zone/in")], {"/remote/f": 11}, {})
+    assert jobs == []
+    assert failures(bridge) == [["/remote/f", "/zone/in", "Exceeds cache"]]
+
+
+def test_empty_listing_of_a_large_source_fails_the_row(bridge):
+    jobs = plan(bridge, [("/remote/my data", "/zone/in")], {"/remote/my data": 50},
+                {"/remote/my data": []})
+    assert jobs == []
+    assert bridge.journal.row_state("/remote/my data", "/zone/in") == src.journal.FAILED
+    assert failures(bridge) == [["/remote/my data", "/zone/in", "Sizing failed"]]
+
+
+def test_failed_listing_fails_the_row_and_planning_goes_on(bridge):
+    error = src.rsync.RemoteCommandError("Cannot list files: /remote/a")
+    jobs = plan(bridge, [("/remote/a", "/zone/in"), ("/remote/b", "/zone/in")],
+                {"/remote/a": 50, "/remote/b": 5}, {"/remote/a": error})
+    assert [job.source for job in jobs] == ["/remote/b"]
+    assert bridge.journal.row_state("/remote/a", "/zone/in") == src.journal.FAILED
+    assert failures(bridge) == [["/remote/a", "/zone/in", "Sizing failed"]]
+
+
+def test_listing_that_breaks_off_fails_the_row_after_its_batches(bridge):
+    def listing():
+        yield ("x", 6)
+        yield ("y", 6)
+        raise src.rsync.RemoteCommandError("connection lost")
+
+    jobs = plan(bridge, [("/remote/a", "/zone/in")], {"/remote/a": 50},
+                {"/remote/a": listing()})
+    assert [job.members for job in jobs] == [["x"]]
+    assert jobs[0].row.failed
+    bridge.job_succeeded(jobs[0])
+    assert bridge.journal.row_state("/remote/a", "/zone/in") == src.journal.FAILED
+
+
+def test_sizing_error_only_fails_its_row(bridge):
+    jobs = plan(bridge, [("/remote/a", "/zone/in"), ("/remote/b", "/zone/in")],
+                {"/remote/a": ConnectionError("ssh"), "/remote/b": 5}, {})
+    assert [job.source for job in jobs] == ["/remote/b"]
+    assert failures(bridge) == [["/remote/a", "/zone/in", "Sizing failed"]]
+
+
+def test_failed_check_is_logged(bridge):
+    bridge.source_to_dest = iter([("/remote/a", "/zone/in", src.rsync.RemoteCommandError("x"))])
+    assert list(bridge.plan_jobs(None, None)) == []
+    assert failures(bridge) == [["/remote/a", "/zone/in", "Check failed"]]
+
+
+def test_resume_skips_verified_rows_and_retries_failed_ones(bridge):
+    bridge.resume = True
+    bridge.journal.set_row("/remote/done", "/zone/in", src.journal.VERIFIED)
+    bridge.journal.set_row("/remote/failed", "/zone/in", src.journal.FAILED)
+    bridge.journal.set_row("/remote/cached", "/zone/in", src.journal.CACHED)
+    rows = [("/remote/done", "/zone/in"), ("/remote/failed", "/zone/in"),
+            ("/remote/cached", "/zone/in")]
+    jobs = plan(bridge, rows, {source: 5 for source, _ in rows}, {})
+    assert [job.source for job in jobs] == ["/remote/failed", "/remote/cached"]
+
+
+def test_resume_only_transfers_the_members_that_are_not_verified(bridge):
+    bridge.resume = True
+    bridge.journal.set_members("/remote/a", "/zone/in", ["x", "z"], src.journal.VERIFIED)
+    bridge.journal.set_members("/remote/a", "/zone/in", ["y"], src.journal.FAILED)
+    listing = [("x", 6), ("y", 4), ("z", 7)]
+    # The item fits in the cache, but only its missing members are transferred
+    jobs = plan(bridge, [("/remote/a", "/zone/in")], {"/remote/a": 10}, {"/remote/a": listing})
+    assert [job.members for job in jobs] == [["y"]]
+    bridge.job_succeeded(jobs[0])
+    assert bridge.journal.row_state("/remote/a", "/zone/in") == src.journal.VERIFIED
+
+
+def test_resume_with_all_members_verified_completes_the_row(bridge):
+    bridge.resume = True
+    bridge.journal.set_members("/remote/a", "/zone/in", ["x", "y"], src.journal.VERIFIED)
+    jobs = plan(bridge, [("/remote/a", "/zone/in")], {"/remote/a": 20},
+                {"/remote/a": [("x", 10), ("y", 10)]})
+    assert jobs == []
+    assert bridge.journal.row_state("/remote/a", "/zone/in") == src.journal.VERIFIED
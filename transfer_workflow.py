@@ -1,11 +1,30 @@
 #!python3
 import argparse
+import concurrent.futures
+import functools
+import itertools
+import json
 import os
+import signal
 import sys
+import time
 from datetime import datetime
+from typing import Union
 
+import src.annotate
+import src.cache
+import src.checksums
+import src.daemon
 import src.irods_functions
+import src.irods_transfer
+import src.journal
+import src.manifest
+import src.metrics
+import src.pipeline
+import src.retry
 import src.rsync
+import src.runner
+import src.stream
 import src.utils
 
 from src.utils import print_error, print_warning, print_message
@@ -16,11 +35,16 @@ class iBridgesSteppingStone:
     def __init__(self,
                  transfer_config: str,
                  irods_env_file: str,
-                 input_csv: str,
+                 input_csv: Union[str, list],
                  output_folder: str,
-                 operation: str) -> None:
+                 operation: str,
+                 resume: bool = False,
+                 connections: src.daemon.Connections = None) -> None:
 
-        for file in [irods_env_file, transfer_config, input_csv]:
+        # One or more CSV files, or folders with CSV files
+        if isinstance(input_csv, str):
+            input_csv = [input_csv]
+        for file in [irods_env_file, transfer_config] + input_csv:
             if not os.path.exists(file):
                 print_error(f"ERROR: {file} does not exist")
                 sys.exit(1)
@@ -30,10 +54,15 @@ class iBridgesSteppingStone:
         self.input_csv = input_csv
         self.output_folder = output_folder
         self.operation = operation
+        self.resume = resume
+        # Connections of the daemon that stay open after the transfer, see serve
+        self.connections = connections
 
         config = src.utils.get_config(configfile=self.transfer_config)
         if config:
             self.datauser, self.serverip, self.sudo, self.cachelimit = config
+        self.hosts = src.utils.get_remote_hosts(configfile=self.transfer_config)
+        self.options = src.utils.get_transfer_options(configfile=self.transfer_config)
 
         self.run()
 
@@ -49,9 +78,10 @@ class iBridgesSteppingStone:
         default_xfr_cfg = os.path.join(str(os.getenv('HOME')), '.irods', 'transfer.config')
         default_irods_env = os.path.join(str(os.getenv('HOME')), '.irods', 'irods_environment.json')
 
-        parser.add_argument('--input', '-i', type=str,
-                            help='path to .CSV-file containing one "source, target"-pair per line',
-                            required=True)
+        parser.add_argument('--input', '-i', type=str, action='append',
+                            help='path to .CSV-file containing one "source, target"-pair per line, '
+                                 + 'can be compressed (.gz, .bz2, .xz) or a folder of CSV-files; '
+                                 + 'can be given more than once')
         parser.add_argument('--output', '-o', type=str,
                             help='folder to write data transfer logs to',
                             default="./")
@@ -62,195 +92,1206 @@ class iBridgesSteppingStone:
                             help=f'path to iRods environment config (default: {default_irods_env})',
                             default=default_irods_env)
         parser.add_argument('--operation', '-p', type=str,
-                            help='export (iRODS/YODA to remote server, import (remote server to iRODS/YODA)',
-                            required=True)
+                            help='export (iRODS/YODA to remote server, import (remote server to iRODS/YODA)')
+        parser.add_argument('--resume', action='store_true',
+                            help='continue an interrupted transfer, skip everything that the '
+                                 + 'journal in the output folder records as transferred')
+        parser.add_argument('--daemon', action='store_true',
+                            help='run as a service that takes jobs from --spool and --socket')
+        parser.add_argument('--spool', type=str,
+                            help='folder the daemon takes JSON job files from')
+        parser.add_argument('--socket', type=str,
+                            help='unix socket of the daemon')
+        parser.add_argument('--submit', action='store_true',
+                            help='submit -i and -p as a job to the daemon at --socket')
+        parser.add_argument('--priority', type=int, default=0,
+                            help='priority of a submitted job, higher runs first (default: 0)')
+        parser.add_argument('--status', type=int, nargs='?', const=0,
+                            help='show the status of a job of the daemon at --socket, '
+                                 + 'or of all jobs')
+        parser.add_argument('--cancel', type=int,
+                            help='cancel a queued job of the daemon at --socket')
 
         args = parser.parse_args()
 
+        if args.daemon:
+            if not args.spool and not args.socket:
+                parser.error('--daemon needs --spool or --socket')
+            return cls.serve(transfer_config=args.config, irods_env_file=args.env,
+                             output_folder=args.output, spool=args.spool,
+                             socketpath=args.socket)
+        if args.submit or args.status is not None or args.cancel is not None:
+            if not args.socket:
+                parser.error('--submit, --status and --cancel need --socket')
+            if args.submit:
+                # The daemon resolves paths in its own working directory
+                message = {'command': 'submit', 'operation': args.operation,
+                           'input': [os.path.abspath(path) for path in args.input or []],
+                           'priority': args.priority, 'resume': args.resume}
+                if args.output != "./":
+                    message['output'] = os.path.abspath(args.output)
+            elif args.cancel is not None:
+                message = {'command': 'cancel', 'id': args.cancel}
+            elif args.status:
+                message = {'command': 'status', 'id': args.status}
+            else:
+                message = {'command': 'list'}
+            reply = src.daemon.request(args.socket, message)
+            if reply is None:
+                sys.exit(1)
+            print(json.dumps(reply, indent=2))
+            sys.exit(0 if reply['ok'] else 1)
+        if not args.input or not args.operation:
+            parser.error('the following arguments are required: --input/-i, --operation/-p')
+
         return cls(
             input_csv=args.input,
             output_folder=args.output,
             transfer_config=args.config,
             irods_env_file=args.env,
-            operation=args.operation)
+            operation=args.operation,
+            resume=args.resume)
 
     def run(self):
-        if self.operation == "export":
-            self.exportData()
-        elif self.operation == "import":
-            self.importData()
-        else:
-            print_error(f'Operation not defined: {self.operation}')
+        timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M")
+        self.metrics = src.metrics.Metrics(
+                self.operation,
+                os.path.join(self.output_folder, f'transfer_events_{timestamp}.jsonl'),
+                self.options['metrics_textfile'])
+        # External commands run on one event loop, with the timeouts of the config
+        src.runner.configure(self.options)
+        try:
+            if self.operation == "export":
+                self.exportData()
+            elif self.operation == "import":
+                self.importData()
+            else:
+                print_error(f'Operation not defined: {self.operation}')
+        except KeyboardInterrupt:
+            print_error("ERROR: Interrupted, stopping running commands")
+            src.runner.cancel()
+            raise
+        finally:
+            # The daemon keeps the command engine and the ssh connections for the next job
+            if self.connections is None:
+                src.runner.shutdown()
+                src.rsync.close_ssh_masters()
+            self.metrics.close()
 
-    def setup_transfer(self):
-        # Initial check on csv file
-        csv_list = src.utils.read_source_dest_csv(filename=self.input_csv)
-        if len(csv_list) == 0:
-            print_error("Nothing to transfer")
-            print_message("Empty file, or not a CSV-file")
+    @classmethod
+    def serve(cls, transfer_config: str, irods_env_file: str, output_folder: str,
+              spool: str = None, socketpath: str = None):
+        """
+        Runs the transfer daemon: jobs that are submitted to the spool folder or the socket
+        are queued with their priority and transferred one after the other. The iRODS
+        session, the ssh master connections and the command engine stay open between jobs,
+        so a job starts without connecting again. Every job writes its logs to its own
+        output folder, <output_folder>/<job id> unless the job names one.
+        """
+        for file in [irods_env_file, transfer_config]:
+            if not os.path.exists(file):
+                print_error(f"ERROR: {file} does not exist")
+                sys.exit(1)
+        if not src.utils.create_dir(output_folder):
+            print_error(f"ERROR: Cannot create output folder {output_folder}")
             sys.exit(1)
+        connections = src.daemon.Connections(irods_env_file)
+
+        def run_job(job):
+            output = job['output'] or os.path.join(output_folder, str(job['id']))
+            if not src.utils.create_dir(output):
+                return src.daemon.FAILED, f"Cannot create output folder {output}"
+            try:
+                bridge = cls(transfer_config, irods_env_file, job['input'], output,
+                             job['operation'], job['resume'], connections)
+            except SystemExit:
+                return src.daemon.FAILED, "Transfer could not be started"
+            failed = bridge.failure.rows
+            message = f"{bridge.success.rows} transferred, {failed} failed, logs in {output}"
+            return (src.daemon.FAILED if failed else src.daemon.DONE), message
+
+        def interrupt(signum, frame):
+            raise KeyboardInterrupt
+
+        # Stop on SIGTERM like on Ctrl-C, the running job is resumed at the next start
+        signal.signal(signal.SIGTERM, interrupt)
+        jobs = src.daemon.JobQueue(os.path.join(output_folder, 'daemon_jobs.sqlite'))
+        try:
+            if connections.session() is None:
+                sys.exit(1)
+            src.daemon.Daemon(jobs, run_job, output_folder, spool, socketpath).serve()
+        except KeyboardInterrupt:
+            print_message("STATUS: Transfer daemon stopped")
+        finally:
+            src.runner.shutdown()
+            src.rsync.close_ssh_masters()
+            connections.close()
+            jobs.close()
 
-        # Check ssh connection and auth
-        if not src.rsync.ssh_check_connection(self.datauser, self.serverip):
+    def setup_transfer(self):
+        with self.metrics.stage('ssh', self.serverip) as event:
+            event['ok'] = self.connect(self.datauser, self.serverip)
+        if not event['ok']:
             return None
 
-        # Create iRODS session
-        irods_conn = src.irods_functions.init_irods_connection(irods_env_file=self.irods_env_file)
-        if irods_conn:
-            session, _ = irods_conn
+        # Exports are spread over all servers of the config, unreachable servers are left out
+        hosts = self.hosts[:1]
+        if self.operation == 'export':
+            hosts += [host for host in self.hosts[1:] if self.check_host(host)]
+        self.host_pool = src.pipeline.HostPool(hosts)
+
+        # Create iRODS session, the daemon reuses its session
+        if self.connections is not None:
+            session = self.connections.session()
+            if session is None:
+                return None
         else:
-            return None
+            irods_conn = src.irods_functions.init_irods_connection(
+                    irods_env_file=self.irods_env_file)
+            if irods_conn:
+                session, _ = irods_conn
+            else:
+                return None
         
-        # Create the local folder to cache data
-        localcache = os.getenv('HOME') + "/irodscache"
-        if not src.utils.create_dir(localcache):
-            print_error(f"ERROR: Cannot create local cache {localcache}")
-            return None
+        # Create the local folders to cache data, one per cache volume
+        for localcache in self.options['cache_dirs']:
+            if not src.utils.create_dir(localcache):
+                print_error(f"ERROR: Cannot create local cache {localcache}")
+                return None
+        localcache = self.options['cache_dirs'][0]
 
-        # Check if data sources exist (first column of csv)
-        source_to_dest = csv_list.copy()
-        if self.operation == "import":
-            # Check if remote paths exist
-            for (source, dest) in csv_list:
-                if not src.rsync.remote_path_exists(self.datauser, self.serverip, source):
-                    print_warning(f"WARNING: Remote path does not exist: {source}")
-                    source_to_dest.remove((source, dest))
-        elif self.operation == "export":
-            # Check if iRODS paths exist
-            for (source, dest) in csv_list:
-                if not session.data_objects.exists(source) and not session.collections.exists(source):
-                    print_warning(f"WARNING: iRODS path does not exist: {source}")
-                    source_to_dest.remove((source, dest))
-
-        if len(source_to_dest) == 0:
-            print_error("Nothing to transfer, check CSV-file")
+        # The csv files are read and checked while the transfer runs, one batch at a time.
+        # The first batch is checked now, to stop early when there is nothing to transfer.
+        # Only the destinations of exports can list several targets
+        manifest = src.manifest.Manifest(self.input_csv,
+                                         functools.partial(self.validate_rows, session),
+                                         targets=self.operation == 'export')
+        rows = iter(manifest)
+        first = next(rows, None)
+        if first is None:
+            print_error("Nothing to transfer")
+            if manifest.read == 0:
+                print_message("Empty file, or not a CSV-file")
+                sys.exit(1)
+            print_message("Check CSV-file")
             return None
-        
+        source_to_dest = itertools.chain([first], rows)
+
         return source_to_dest, session, localcache
 
-    def write_log(self, success, failure):
+    def connect(self, user: str, server: str) -> bool:
+        """
+        Opens one shared ssh connection to user@server for all remote commands and rsync
+        calls, and checks the connection and auth. In the daemon, a server that an earlier
+        job reached is not checked again while its shared connection is open.
+        """
+        multiplexing = self.options['ssh_multiplexing']
+        if self.connections is not None and self.connections.connected(user, server,
+                                                                        multiplexing):
+            return True
+        if multiplexing:
+            src.rsync.ensure_ssh_master(user, server)
+        if not src.rsync.ssh_check_connection(user, server):
+            return False
+        if self.connections is not None:
+            self.connections.reached(user, server)
+        return True
+
+    def check_host(self, host) -> bool:
+        """
+        Checks the ssh connection to a further server of the config.
+        """
+        with self.metrics.stage('ssh', host.serverip) as event:
+            event['ok'] = self.connect(host.datauser, host.serverip)
+        if not event['ok']:
+            print_warning(f"WARNING: Cannot connect to {host.datauser}@{host.serverip}, "
+                          + f"server {host.name} is not used")
+        return event['ok']
+
+    def validate_rows(self, session, rows: list) -> list:
+        """
+        Checks if the data sources (first column of csv) of a batch of csv lines exist.
+        Returns: list of (source, dest, info) of the lines that can be transferred,
+                 info is the preflight of the remote path for imports, None for exports,
+                 or the exception when the check of the batch failed
+        """
+        valid = []
+        try:
+            with self.metrics.stage('preflight', files=len(rows)):
+                if self.operation == "import":
+                    # Check existence, type and size of all remote paths in one go
+                    preflight = src.rsync.remote_preflight(self.datauser, self.serverip,
+                                                           [source for (source, _) in rows])
+                    for (source, dest) in rows:
+                        info = preflight.get(source, {})
+                        if not info.get('exists'):
+                            print_warning(f"WARNING: Remote path does not exist: {source}")
+                            continue
+                        valid.append((source, dest, info))
+                elif self.operation == "export":
+                    # Check if iRODS paths exist
+                    existing = src.irods_functions.existing_irods_paths(
+                            session, [source for (source, _) in rows])
+                    for (source, dest) in rows:
+                        if source not in existing:
+                            print_warning(f"WARNING: iRODS path does not exist: {source}")
+                            continue
+                        valid.append((source, dest, None))
+        except Exception as error:
+            # The lines are logged as failed when they are planned, see plan_jobs
+            return [(source, dest, error) for (source, dest) in rows]
+        return valid
+
+    def open_logs(self):
+        """
+        Opens the logs of successful and failed transfers. Rows are written to the logs
+        while the transfer runs.
+        """
         timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M")
         successpath = os.path.join(self.output_folder,
                                    f'output_irods_data_transfer_{timestamp}.csv')
         failurepath = os.path.join(self.output_folder,
                                    f'error_irods_data_transfer_{timestamp}.csv')
-        src.utils.write_csv(success=success,
-                            failure=failure,
-                            successpath=successpath,
-                            failurepath=failurepath)
+        # tuple: source, destination
+        self.success = src.utils.CsvLog(successpath, ['iRODS', 'local'],
+                                        "succesful transfers")
+        # triple: source, destination, fail reason
+        self.failure = src.utils.CsvLog(failurepath, ['iRODS', 'local', 'reason'],
+                                        "failed transfers")
+
+    def close_logs(self):
+        self.success.close()
+        self.failure.close()
+
+    def run_transfers(self, size_of, list_members, fetch, push):
+        """
+        Moves all jobs through the stepping stone. In pipeline mode the fetch leg of the next
+        job overlaps with the push leg of the current job. With several workers, that many
+        jobs are transferred at the same time, as long as they fit in the cache together.
+        """
+        # Cache folders are deleted in the background while the next job starts
+        self.cleaner = src.cache.Cleaner()
+        self.volumes = []
+        if not self.streaming:
+            # Streamed data does not pass through the cache
+            for localcache in self.options['cache_dirs']:
+                self.cleaner.sweep(localcache)
+                self.volumes.append(src.cache.CacheVolume(localcache,
+                                                          self.options['cache_margin']))
+        # Exported items can be kept in the cache for the next transfer of the same data
+        self.keep_items = (self.options['keep_cache'] and self.operation == 'export'
+                           and not self.streaming)
+        if self.keep_items:
+            for volume in self.volumes:
+                volume.items = src.cache.ItemCache(volume.path)
+                volume.reserved = volume.items.size()
+        # The cache limit does not apply to streamed data
+        self.budget = src.cache.CacheBudget(self.volumes,
+                                            float('inf') if self.streaming else self.cachelimit,
+                                            self.cleaner)
+        self.journal = src.journal.Journal(
+                os.path.join(self.output_folder, 'transfer_journal.sqlite'),
+                self.operation, self.resume)
+        self.checksum_cache = src.checksums.ChecksumCache(
+                os.path.join(self.localcache, 'checksums.sqlite'))
+        self.irods = src.irods_transfer.make_backend(self.session, self.options)
+        self.retry_policy = src.retry.RetryPolicy(self.options['retries'],
+                                                  self.options['retry_delay'],
+                                                  self.options['retry_max_delay'])
+        # Provenance metadata is added in the background while the transfer continues
+        self.annotator = None
+        if self.options['annotate'] and self.operation == 'export':
+            self.annotator = src.annotate.Annotator(self.session, self.serverip,
+                                                    self.options['annotate_threads'])
+        jobs = self.schedule(self.plan_jobs(size_of, list_members))
+        try:
+            if self.options['pipeline']:
+                src.pipeline.run_pipelined(jobs, fetch, push, self.options['queue_size'],
+                                           self.options['workers'], self.job_failed)
+            else:
+                src.pipeline.run_parallel(jobs, fetch, push, self.options['workers'],
+                                          self.job_failed)
+        finally:
+            self.journal.close()
+            self.checksum_cache.close()
+            self.cleaner.close()
+            for volume in self.volumes:
+                if volume.items is not None:
+                    volume.items.close()
+            if self.annotator is not None:
+                failed = self.annotator.close()
+                self.metrics.record({'stage': 'annotate', 'files': self.annotator.annotated,
+                                     'ok': not failed}, self.annotator.started, time.time())
+
+    def schedule(self, jobs):
+        """
+        Orders the planned jobs according to the schedule option, csv order with fifo.
+        """
+        policy = self.options['schedule']
+        if policy not in src.pipeline.JobScheduler.POLICIES:
+            print_warning(f"WARNING: Unknown schedule {policy}, using fifo")
+            policy = 'fifo'
+        if policy == 'fifo':
+            return jobs
+        return src.pipeline.JobScheduler(jobs, policy, self.options['schedule_window'],
+                                         None if self.streaming else self.budget)
+
+    def plan_jobs(self, size_of, list_members):
+        """
+        Determines the size of every source and creates the transfer jobs.
+        A source that does not fit in the cache is split into batches of its members that do.
+        size_of: callable(source, info) -> size in bytes
+        list_members: callable(source, info) -> iterable of (relative path, size[, checksum]),
+                      or None when the source cannot be split
+        info: what the check of the csv line found out about the source, see validate_rows
+        """
+        counter = itertools.count()
+        for (key, value, info) in self.source_to_dest:
+            if isinstance(info, Exception):
+                self.planning_failed(key, value, "Check failed", info)
+                continue
+            try:
+                yield from self.plan_row(counter, key, value, info, size_of, list_members)
+            except Exception as error:
+                # An error of iRODS or ssh only fails this line, the rest is still planned
+                self.planning_failed(key, value, "Sizing failed", error)
+
+    def planning_failed(self, source: str, dest: str, reason: str, error: Exception):
+        """
+        Logs a csv line that could not be checked or planned.
+        """
+        print_error(f"ERROR: {reason} for {source}: {error!r}")
+        self.failure.append((source, dest, reason))
+        self.journal.set_row(source, dest, src.journal.FAILED, reason=reason)
+
+    def plan_row(self, counter, key: str, value: str, info, size_of, list_members):
+        """
+        Creates the jobs of one csv line, see plan_jobs.
+        """
+        done = set()
+        if self.resume:
+            if self.journal.row_state(key, value) == src.journal.VERIFIED:
+                print_message(f"STATUS: Already transferred, skipping: {key}")
+                return
+            done = self.journal.members_in_state(key, value, src.journal.VERIFIED)
+
+        if self.options['sync']:
+            with self.metrics.stage('sync', key) as event:
+                unchanged, count = self.unchanged_members(key, value, info)
+                event['files'] = len(unchanged)
+            if unchanged and len(unchanged) == count:
+                print_message(f"STATUS: Unchanged, skipping: {key}")
+                self.journal.set_row(key, value, src.journal.VERIFIED)
+                return
+            done |= unchanged
+
+        with self.metrics.stage('size', key) as event:
+            size = event['bytes'] = size_of(key, info)
+        self.journal.set_row(key, value, src.journal.SIZED, size)
+        if self.budget.fits(size) and not done:
+            job = src.pipeline.TransferJob(next(counter), key, value)
+            job.size = size
+            job.info = info
+            yield job
+            return
+
+        members = list_members(key, info)
+        if members is None:
+            print_warning(f"WARNING: Datasize exceeds cache size: {key}")
+            self.failure.append((key, value, "Exceeds cache"))
+            self.journal.set_row(key, value, src.journal.FAILED, reason="Exceeds cache")
+            return
+
+        if done:
+            print_message(f"STATUS: Skipping {len(done)} objects that are already "
+                          + f"transferred or unchanged: {key}")
+            members = (member for member in members if member[0] not in done)
+        else:
+            print_message(f"STATUS: Datasize exceeds cache size, transfer in batches: {key}")
+        row = src.pipeline.TransferRow(key, value)
+        capacity = self.budget.capacity()
+        try:
+            for batch, batch_size in src.pipeline.split_batches(members, capacity):
+                if not self.budget.fits(batch_size):
+                    print_warning(f"WARNING: Datasize exceeds cache size: {key}/{batch[0][0]}")
+                    self.failure.append((f"{key}/{batch[0][0]}", value, "Exceeds cache"))
+                    row.failed = True
+                    continue
+                job = src.pipeline.TransferJob(next(counter), key, value)
+                job.size = batch_size
+                job.info = info
+                job.row = row
+                job.batch = row.add_batch()
+                job.members = [member[0] for member in batch]
+                job.sizes = {member[0]: member[1] for member in batch}
+                job.checksums = {member[0]: member[2] for member in batch if len(member) > 2}
+                yield job
+            if row.batches == 0 and not row.failed and not done and size > 0:
+                # Without members the line would count as transferred
+                raise ValueError(f"Listing of {key} is empty, expected {size} bytes")
+        except Exception:
+            # The listing broke off, the batches that are planned already still run
+            row.failed = True
+            if row.finish_planning():
+                self.row_done(row)
+            raise
+        if row.finish_planning():
+            self.row_done(row)
+
+    def unchanged_members(self, source: str, dest: str, info) -> tuple:
+        """
+        Compares the listing of a source with the listing of its copy at every destination,
+        by size and modification time, see src.checksums.unchanged_members.
+        Targets that are spread over several servers have no known copy, they are not
+        compared and everything is transferred.
+        Returns: set of unchanged members ("" for a single file), number of members
+        """
+        item_name = os.path.basename(source)
+        if self.operation == 'export':
+            listing = src.irods_functions.irods_manifest(self.session, source)
+            targets = self.targets(dest)
+            if any(not target.pinned for target in targets) and len(self.host_pool.hosts) > 1:
+                return set(), len(listing)
+            copies = [src.rsync.remote_manifest(target.user, target.server,
+                                                f"{target.path}/{item_name}")
+                      for target in targets]
+        else:
+            listing = src.rsync.remote_manifest(self.datauser, self.serverip, source)
+            copies = [src.irods_functions.irods_manifest(self.session, f"{dest}/{item_name}")]
+        return src.checksums.unchanged_members(listing, copies), len(listing)
+
+    def row_done(self, row):
+        """
+        Logs a CSV line that was transferred in batches, after its last batch finished.
+        """
+        self.release_hosts(row)
+        if not row.failed:
+            print_message(f"--> Data transfer complete: all {row.batches} batches of {row.source}")
+            self.success.extend((row.source, f"{dest}/{os.path.basename(row.source)}")
+                                for dest in self.destinations(row))
+            self.journal.set_row(row.source, row.dest, src.journal.VERIFIED)
+        else:
+            self.journal.set_row(row.source, row.dest, src.journal.FAILED,
+                                 reason="Not all batches transferred")
+
+    def record(self, job, state: str, reason: str = None):
+        """
+        Records the progress of a job in the journal, per member for a batch.
+        """
+        if job.members is None:
+            self.journal.set_row(job.source, job.dest, state, reason=reason)
+        else:
+            self.journal.set_members(job.source, job.dest, job.members, state)
+
+    def job_succeeded(self, job):
+        """
+        Logs a transferred job. A batch only logs its members, the line of the CSV is logged
+        when all batches are transferred.
+        """
+        self.record(job, src.journal.VERIFIED)
+        self.log_success(job, self.destinations(job))
+        if job.row is not None and job.row.batch_done(True):
+            self.row_done(job.row)
+
+    def log_success(self, job, destinations: list):
+        """
+        Logs a transferred job for each of the destinations, the members for a batch.
+        """
+        item_name = os.path.basename(job.source)
+        for dest in destinations:
+            if job.row is None:
+                self.success.append((job.source, f"{dest}/{item_name}"))
+            else:
+                self.success.extend((f"{job.source}/{member}", f"{dest}/{item_name}/{member}")
+                                    for member in job.members)
+
+    def targets(self, dest: str) -> list:
+        """
+        Returns the targets of the destination of an export, see src.rsync.parse_targets.
+        """
+        hosts = {host.name: (host.datauser, host.serverip) for host in self.host_pool.hosts}
+        return src.rsync.parse_targets(dest, self.datauser, self.serverip, hosts)
+
+    def place_targets(self, job) -> list:
+        """
+        Returns the targets of a job. A target without a server in the csv goes to the least
+        busy server of the config; all batches of a line go to the same servers, which stay
+        assigned to the line until its last batch is done.
+        """
+        owner = job.row if job.row is not None else job
+
+        def place():
+            targets = []
+            for target in self.targets(job.dest):
+                if not target.pinned and len(self.host_pool.hosts) > 1:
+                    host = self.host_pool.assign()
+                    owner.hosts.append(host)
+                    target = src.rsync.make_target(host.datauser, host.serverip, target.path,
+                                                   (self.datauser, self.serverip))
+                targets.append(target)
+            return targets
+        return job.row.get_targets(place) if job.row is not None else place()
+
+    def destinations(self, item) -> list:
+        """
+        Returns the destinations of a job or csv line as written to the logs, one per target.
+        """
+        if self.operation != 'export':
+            return [item.dest]
+        return [target.label for target in item.targets or self.targets(item.dest)]
+
+    @property
+    def streaming(self) -> bool:
+        """
+        Exports are streamed from iRODS to the remote server instead of staged in the cache.
+        """
+        return self.operation == "export" and self.options['mode'] == 'stream'
+
+    @property
+    def bundling(self) -> bool:
+        """
+        Small files are sent as tar bundles instead of one at a time.
+        """
+        return self.options['bundle_threshold'] > 0
+
+    @property
+    def rsync_checksums(self) -> bool:
+        """
+        rsync compares all files by checksum, unless the transfer is verified with a manifest.
+        """
+        return self.options['verify'] != 'manifest'
+
+    def check_remote(self, job, expected: dict, remote_base: str, target=None) -> bool:
+        """
+        Compares a checksum manifest with the checksums of the files on the remote server.
+        The remote checksums are calculated in one remote call per algorithm.
+        expected: algorithm --> {path relative to remote_base: hex digest}
+        target: remote server of an export, the server of the config if not given
+        """
+        user, server = (target.user, target.server) if target else (self.datauser, self.serverip)
+        failed = []
+        for algorithm, manifest in expected.items():
+            actual = src.rsync.remote_checksums(user, server, remote_base,
+                                                list(manifest), algorithm,
+                                                self.options['verify_threads'])
+            failed.extend(src.checksums.compare_manifests(manifest, actual))
+        if failed:
+            print_error(f"ERROR: Checksums differ for {len(failed)} files of {job.source}, "
+                        + f"e.g. {remote_base}/{failed[0]}")
+            return False
+        return True
+
+    def verified(self, job, verify) -> bool:
+        """
+        Runs verify(job) as a timed stage, when the manifest verification is used.
+        """
+        if self.rsync_checksums:
+            return True
+        with self.metrics.stage('verify', job.source, job.size, self.job_files(job)) as event:
+            event['ok'] = verify(job)
+        return event['ok']
+
+    def verify_export(self, job, target) -> bool:
+        """
+        Verifies the files delivered to a target against the checksums that are
+        registered in iRODS. Data objects without a registered checksum are compared with
+        their copy in the cache, which irsync -K has verified.
+        """
+        if self.rsync_checksums:
+            return True
+
+        item_name = os.path.basename(job.source)
+        local_base = os.path.join(job.cachedir, item_name)
+        remote_base = f"{target.path}/{item_name}"
+        if job.members is not None:
+            registered = job.checksums.items()
+        elif self.session.collections.exists(job.source):
+            registered = ((path[len(job.source) + 1:], checksum) for path, _, checksum
+                          in src.irods_functions.iter_irods_objects(self.session, job.source))
+        else:
+            local_base, remote_base = job.cachedir, target.path
+            registered = [(item_name, self.session.data_objects.get(job.source).checksum)]
+
+        expected = {}
+        for name, checksum in registered:
+            converted = src.checksums.irods_to_hex(checksum)
+            if converted is None:
+                converted = ("sha256", self.checksum_cache.checksum(
+                        os.path.join(local_base, name)))
+            algorithm, digest = converted
+            expected.setdefault(algorithm, {})[name] = digest
+        return self.check_remote(job, expected, remote_base, target)
+
+    def verify_import(self, job) -> bool:
+        """
+        Verifies the files fetched into the cache against the files on the remote server.
+        """
+        if self.rsync_checksums:
+            return True
+
+        item_name = os.path.basename(job.source)
+        local_item = os.path.join(job.cachedir, item_name)
+        if job.members is not None:
+            local_base, remote_base, names = local_item, job.source, job.members
+        elif os.path.isdir(local_item):
+            local_base, remote_base = local_item, job.source
+            names = [os.path.relpath(os.path.join(folder, name), local_item)
+                     for folder, _, files in os.walk(local_item) for name in files]
+        else:
+            local_base, remote_base = job.cachedir, os.path.dirname(job.source)
+            names = [item_name]
+
+        expected = {name: self.checksum_cache.checksum(os.path.join(local_base, name))
+                    for name in names}
+        return self.check_remote(job, {"sha256": expected}, remote_base)
+
+    def job_files(self, job):
+        """
+        Returns the number of files of a job when it is known without a query: batches list
+        their members, imports are counted by the preflight. None otherwise.
+        """
+        if job.members is not None:
+            return len(job.members)
+        if self.operation == 'import':
+            return job.info['count']
+        return None
+
+    def stage_dir(self, job) -> bool:
+        """
+        Reserves the size of the job on the cache volume with the most headroom and creates
+        the cache folder of the job. Blocks until enough cache space is available.
+        """
+        job.volume = self.budget.reserve(job.size)
+        if job.volume is None:
+            print_warning(f"WARNING: Datasize exceeds free cache space: {job.source}")
+            self.job_failed(job, "Exceeds cache")
+            return False
+        job.reserved = job.unwritten = job.size
+
+        job.cachedir = os.path.join(job.volume.path, str(job.index))
+        if not src.utils.create_dir(job.cachedir):
+            print_error(f"ERROR: Cannot create local cache {job.cachedir}")
+            self.job_failed(job, "Creating local cache failed")
+            return False
+        return True
+
+    def release_job(self, job):
+        """
+        Releases the cache reservation of a job, its cache folder is renamed aside and
+        deleted in the background. A kept cache entry the job was served from stays in
+        the cache.
+        """
+        folder = None
+        if job.cache_hit:
+            job.volume.items.release(job.cache_key)
+            job.cache_hit = False
+        else:
+            folder = job.cachedir
+        with self.metrics.stage('cleanup', job.source, job.reserved):
+            self.budget.release(job.volume, job.reserved, job.unwritten, folder)
+        job.cachedir = None
+        job.reserved = job.unwritten = 0
+        self.release_hosts(job)
+
+    def release_hosts(self, owner):
+        """
+        Gives back the servers a job or a csv line transferred in batches was assigned to.
+        """
+        for host in owner.hosts:
+            self.host_pool.release(host)
+        owner.hosts = []
+
+    def job_cached(self, job):
+        """
+        Records that a job is staged in the cache, its data now counts as written.
+        """
+        self.budget.written(job.volume, job.unwritten)
+        job.unwritten = 0
+        self.record(job, src.journal.CACHED)
+
+    def log_failure(self, job, reason: str):
+        """
+        Logs a failed job. For a batch, the batch number is added to the reason.
+        """
+        self.record(job, src.journal.FAILED, reason)
+        for dest, members in job.failed_members.items():
+            self.journal.set_members(job.source, job.dest, list(members), src.journal.FAILED)
+            self.failure.extend((f"{job.source}/{member}", dest, member_reason)
+                                for member, member_reason in members.items())
+        if job.row is not None:
+            reason = f"{reason} (batch {job.batch})"
+            if job.row.batch_done(False):
+                self.row_done(job.row)
+        self.failure.append((job.source, job.dest, reason))
+
+    def record_delivered(self, job):
+        """
+        Records the members of a job that only failed for some of its members as verified,
+        the failed members excepted. --resume then only transfers the failed members.
+        """
+        failed = set()
+        for members in job.failed_members.values():
+            failed.update(members)
+        members = job.members
+        if members is None:
+            localitem = os.path.join(job.cachedir, os.path.basename(job.source))
+            members = [os.path.relpath(os.path.join(folder, name), localitem)
+                       for folder, _, names in os.walk(localitem) for name in names]
+        self.journal.set_members(job.source, job.dest,
+                                 [member for member in members if member not in failed],
+                                 src.journal.VERIFIED)
+
+    def transfer(self, job, transfer, roots: list, dest: str):
+        """
+        Runs one transfer step of a job. A failure caused by the network is retried with
+        exponential backoff; a retry only sends the failed members when they are known.
+        Members that still failed are recorded for dest, see log_failure.
+        transfer: callable(members) -> True or src.retry.Failure, None is the whole item
+        roots: paths of the item on both sides, see src.retry.Failure.resolve
+        Returns: True, or the failure of the last attempt
+        """
+        result = src.retry.retry(transfer, self.retry_policy, job.source, roots)
+        if isinstance(result, src.retry.Failure) and result.members:
+            job.failed_members[dest] = {member: result.reason for member in result.members}
+        return result
+
+    @staticmethod
+    def failure_reason(reason: str, result) -> str:
+        """
+        Adds the kind of failure to the reason of a failed transfer, see src.retry.
+        """
+        if isinstance(result, src.retry.Failure):
+            return f"{reason} ({result.reason})"
+        return reason
+
+    def job_failed(self, job, reason: str):
+        """
+        Logs a failed job and cleans up after it.
+        """
+        self.log_failure(job, reason)
+        self.release_job(job)
 
     def importData(self):
-        success = []  # tuple: source, destination
-        failure = []  # triple: source, destination, fail reason
         setup = self.setup_transfer()
         if setup:
-            source_to_dest, session, localcache = setup
+            self.source_to_dest, self.session, self.localcache = setup
         else:
             sys.exit(1)
 
         # Copy data remote --> localcache --> irods
-        for (key, value) in source_to_dest:
-            print_message(f"STATUS: Fetch data from remote server {key} --> {localcache}")
-            size = src.rsync.get_remote_size(self.datauser, self.serverip, [key])
+        self.open_logs()
+        try:
+            self.run_transfers(self.remote_size, self.list_remote_members,
+                               self.import_fetch, self.import_push)
+        finally:
+            self.close_logs()
 
-            if size > self.cachelimit:
-                print_warning(f"WARNING: Datasize exceeds cache size: {key}")
-                failure.append((key, value, "Exceeds cache"))
-                continue
+    def remote_size(self, path: str, info: dict) -> int:
+        return info['size']
 
-            # Create iRODS collection
-            if not src.irods_functions.ensure_coll(session, value):
-                print_warning(f"WARNING: Skipping: {key, value}")
-                failure.append((key, value, "Destination could not be created"))
-                continue
+    def list_remote_members(self, path: str, info: dict):
+        """
+        Lists the files of a remote folder, None for a single file.
+        """
+        if info['type'] != 'dir':
+            return None
+        return src.rsync.list_remote_files(self.datauser, self.serverip, path)
 
-            # rsync to stepping stone
-            rsync_success = src.rsync.rsync_remote_to_local(self.datauser, self.serverip,
-                                                            self.sudo, key, localcache)
-            if not rsync_success:
-                print_warning(f"WARNING: Remote to cache failed: {key, value}")
-                failure.append((key, value, "rsync remote to local failed"))
-                src.rsync.empty_dir(localcache)
-
-            # irsync to iRODS
-            item_name = os.path.basename(key)
-            irods_success = src.irods_functions.irsync_local_to_irods(
-                    session, localcache + '/' + item_name, value)
-            if irods_success:
-                print_message("--> Data transfer complete")
-                success.append((key, f'{value}/{os.path.basename(key)}'))
-                if session.collections.exists(f'{value}/{os.path.basename(key)}'):
-                    success.extend(src.irods_functions.map_collitems_to_folder(
-                        session, f'{value}/{os.path.basename(key)}', key, True))
-                src.rsync.empty_dir(localcache)
-            else:
-                print_warning(f"WARNING: Local to iRODS failed: {key, value}")
-                failure.append((key, value, "irsync local to iRODS failed"))
-                src.rsync.empty_dir(localcache)
-                continue
+    def import_fetch(self, job) -> bool:
+        """
+        First leg of an import: remote server --> localcache
+        """
+        key, value = job.source, job.dest
+        print_message(f"STATUS: Fetch data from remote server {key} --> {self.localcache}")
+
+        # Create iRODS collection
+        with self.metrics.stage('mkdir', value) as event:
+            event['ok'] = src.irods_functions.ensure_coll(self.session, value)
+        if not event['ok']:
+            print_warning(f"WARNING: Skipping: {key, value}")
+            self.log_failure(job, "Destination could not be created")
+            return False
+
+        if not self.stage_dir(job):
+            return False
+
+        # rsync to stepping stone
+        def fetch(members):
+            if members is None and self.bundling and job.info['type'] == 'dir':
+                return self.fetch_bundled(job)
+            if members is None and job.members is None:
+                return src.rsync.rsync_remote_to_local(self.datauser, self.serverip, self.sudo,
+                                                       key, job.cachedir, self.rsync_checksums)
+            return src.rsync.rsync_files_remote_to_local(
+                    self.datauser, self.serverip, self.sudo, key, members or job.members,
+                    job.cachedir, self.rsync_checksums)
 
-        self.write_log(success, failure)
+        with self.metrics.stage('rsync', key, job.size, self.job_files(job)) as event:
+            rsync_success = event['ok'] = self.transfer(
+                    job, fetch, [key, os.path.join(job.cachedir, os.path.basename(key))],
+                    job.dest)
+        if not rsync_success:
+            print_warning(f"WARNING: Remote to cache failed: {key, value}")
+            self.job_failed(job, self.failure_reason("rsync remote to local failed",
+                                                     rsync_success))
+            return False
+
+        if not self.verified(job, self.verify_import):
+            self.job_failed(job, "Checksum verification remote to local failed")
+            return False
+
+        self.job_cached(job)
+        return True
+
+    def fetch_bundled(self, job) -> bool:
+        """
+        Fetches a remote folder into the cache: the small files as one tar stream,
+        the other files with rsync.
+        """
+        key, threshold = job.source, self.options['bundle_threshold']
+        localitem = os.path.join(job.cachedir, os.path.basename(key))
+        if job.members is None:
+            sizes = src.rsync.list_remote_files(self.datauser, self.serverip, key)
+        else:
+            sizes = job.sizes.items()
+        small, large = [], []
+        for name, size in sizes:
+            (small if size < threshold else large).append(name)
+
+        if small and not src.stream.bundle_remote_to_local(self.datauser, self.serverip,
+                                                           self.sudo, key, small, localitem):
+            return False
+        if job.members is None:
+            return src.rsync.rsync_remote_to_local(self.datauser, self.serverip, self.sudo, key,
+                                                   job.cachedir, self.rsync_checksums, threshold)
+        if large:
+            return src.rsync.rsync_files_remote_to_local(self.datauser, self.serverip,
+                                                         self.sudo, key, large, job.cachedir,
+                                                         self.rsync_checksums)
+        return True
+
+    def import_push(self, job):
+        """
+        Second leg of an import: localcache --> iRODS
+        """
+        try:
+            self.import_item(job)
+        finally:
+            # Delete cache
+            self.release_job(job)
+
+    def import_item(self, job):
+        key, value = job.source, job.dest
+        item_name = os.path.basename(key)
+        localitem = job.cachedir + '/' + item_name
+        def push(members):
+            return self.irods.to_irods(localitem, value,
+                                       members is None and self.bundling
+                                       and os.path.isdir(localitem), members)
+
+        with self.metrics.stage('irsync', key, job.size, self.job_files(job)) as event:
+            irods_success = event['ok'] = self.transfer(
+                    job, push, [localitem, f"{value}/{item_name}"], job.dest)
+        if irods_success:
+            print_message("--> Data transfer complete")
+            # irsync -K and the native backend verify the checksums as part of the transfer
+            self.record(job, src.journal.DELIVERED)
+            self.job_succeeded(job)
+            if job.row is None and self.session.collections.exists(f'{value}/{item_name}'):
+                self.success.extend(src.irods_functions.map_collitems_to_folder(
+                    self.session, f'{value}/{item_name}', key, True))
+        else:
+            print_warning(f"WARNING: Local to iRODS failed: {key, value}")
+            self.log_failure(job, self.failure_reason("irsync local to iRODS failed",
+                                                      irods_success))
+            if job.failed_members:
+                self.record_delivered(job)
 
     def exportData(self):
-        success = []
-        failure = []
         setup = self.setup_transfer()
         if setup:
-            source_to_dest, session, localcache = setup
+            self.source_to_dest, self.session, self.localcache = setup
         else:
             sys.exit(1)
 
-        # Copy data irods --> localcache --> remote
-        for (key, value) in source_to_dest:
-            print_message(f"STATUS: Fetch data from iRODS {key} --> {localcache}")
-            size = src.irods_functions.get_irods_size(session, [key])
+        self.open_logs()
+        try:
+            if self.streaming:
+                # Stream data irods --> remote
+                self.run_transfers(self.irods_size, self.list_irods_members,
+                                   self.stream_prepare, self.stream_push)
+            else:
+                # Copy data irods --> localcache --> remote
+                self.run_transfers(self.irods_size, self.list_irods_members,
+                                   self.export_fetch, self.export_push)
+        finally:
+            self.close_logs()
 
-            # Determine size of source
-            if size > self.cachelimit:
-                print_warning(f"WARNING: Datasize exceeds cache size: {key}")
-                failure.append((key, value, "Exceeds cache"))
-                continue
+    def irods_size(self, path: str, info=None) -> int:
+        return src.irods_functions.get_irods_size(self.session, [path])
 
-            # create destination folder on remote server
-            mkdir_remote = src.rsync.create_remote_dir(self.datauser, self.serverip, 
-                                                       self.sudo, value)
-            if not mkdir_remote:
-                print_error(f"ERROR: mkdir on remote server failed {value}")
-                failure.append((key, value, "Creating remote dir failed"))
-                continue
+    def list_irods_members(self, path: str, info=None):
+        """
+        Lists the data objects of a collection, None for a single data object.
+        """
+        if not self.session.collections.exists(path):
+            return None
+        return src.irods_functions.list_irods_objects(self.session, path)
 
-            # irsync data to stepping stone
-            irods_success = src.irods_functions.irsync_irods_to_local(session, key, localcache)
-            if not irods_success:
-                print_error(f"ERROR iRODS: transfer failed {key} {localcache}")
-                failure.append((key, value, "iRODS transfer (irsync) failed"))
-                src.rsync.empty_dir(localcache)
-                continue
+    def export_fetch(self, job) -> bool:
+        """
+        First leg of an export: iRODS --> localcache
+        """
+        key = job.source
+        print_message(f"STATUS: Fetch data from iRODS {key} --> {self.localcache}")
+
+        # create destination folder on remote server
+        if not self.prepare_targets(job):
+            return False
+
+        if self.keep_items and job.members is None:
+            job.cache_key = src.irods_functions.irods_fingerprint(self.session, key)
+            volume = job.cache_key and next((volume for volume in self.volumes
+                                             if volume.items.acquire(job.cache_key)), None)
+            if volume:
+                print_message(f"STATUS: {key} unchanged in local cache, skip irsync")
+                job.cache_hit = True
+                job.volume = volume
+                job.cachedir = volume.items.entry_dir(job.cache_key)
+                self.record(job, src.journal.CACHED)
+                return True
+
+        if not self.stage_dir(job):
+            return False
+
+        # irsync data to stepping stone
+        def fetch(members):
+            if members is None and job.members is None:
+                return self.irods.to_local(key, job.cachedir)
+            return self.irods.objects_to_local(key, members or job.members, job.cachedir,
+                                               job.sizes, job.checksums)
+
+        with self.metrics.stage('irsync', key, job.size, self.job_files(job)) as event:
+            irods_success = event['ok'] = self.transfer(
+                    job, fetch, [key, os.path.join(job.cachedir, os.path.basename(key))],
+                    job.dest)
+        if not irods_success:
+            print_error(f"ERROR iRODS: transfer failed {key} {job.cachedir}")
+            self.job_failed(job, self.failure_reason("iRODS transfer (irsync) failed",
+                                                     irods_success))
+            return False
+
+        if self.keep_items and job.members is None and not job.cache_key:
+            # The transfer to the cache registered the missing checksums
+            job.cache_key = src.irods_functions.irods_fingerprint(self.session, key)
+        self.job_cached(job)
+        return True
+
+    def export_push(self, job):
+        """
+        Second leg of an export: localcache --> remote server
+        """
+        try:
+            self.export_item(job)
+        finally:
+            # Delete cache
+            self.release_job(job)
+
+    def export_item(self, job):
+        localitem = f"{job.cachedir}/{os.path.basename(job.source)}"
+        small, min_size = [], 0
+        if self.bundling and os.path.isdir(localitem):
+            # Send small files as one tar stream, rsync only the others
+            min_size = self.options['bundle_threshold']
+            small = [os.path.relpath(os.path.join(folder, name), localitem)
+                     for folder, _, files in os.walk(localitem) for name in files
+                     if os.path.getsize(os.path.join(folder, name)) < min_size]
+        push = functools.partial(self.push_target, small=small, min_size=min_size)
+        self.finish_targets(job, self.push_targets(job, push))
+
+    def push_target(self, job, target, small: list, min_size: int):
+        """
+        Sends an item from the local cache to one target and verifies it.
+        small: files that are sent as one tar stream, min_size: rsync skips files below it
+        Returns: None upon success, the reason of the failure otherwise
+        """
+        key = job.source
+        localitem = f"{job.cachedir}/{os.path.basename(key)}"
+        if small:
+            with self.metrics.stage('bundle', key, files=len(small)) as event:
+                event['target'] = target.label
+                event['ok'] = src.stream.bundle_local_to_remote(
+                        localitem, small, target.user, target.server, self.sudo,
+                        f"{target.path}/{os.path.basename(key)}")
+            if not event['ok']:
+                return "Sending bundle of small files to remote failed"
+
+        # rsync data from stepping stone to destination server
+        def push(members):
+            if members is None:
+                return src.rsync.rsync_local_to_remote(target.user, target.server, self.sudo,
+                                                       localitem, target.path,
+                                                       self.rsync_checksums, min_size)
+            return src.rsync.rsync_files_local_to_remote(target.user, target.server, self.sudo,
+                                                         localitem, members, target.path,
+                                                         self.rsync_checksums)
 
-            # rsync data from stepping stone to destination server
-            rsync_success = src.rsync.rsync_local_to_remote(
-                    self.datauser, self.serverip, self.sudo, 
-                    f"{localcache}/{os.path.basename(key)}", value)
-            if rsync_success:
-                print_message("--> Data transfer complete")
-                success.append((key, f"{value}/{os.path.basename(key)}"))
-                if session.collections.exists(key):
-                    success.extend(src.irods_functions.map_collitems_to_folder(session, key, value))
-
-                # Create iRODS metadata entry
-                # print("DEBUG: annotate", key)
-                # src.irods_functions.annotate_data(session, key,
-                #                               f"{destination}/{os.path.basename(key)}", serverip)
-                # Delete cache
-                src.rsync.empty_dir(localcache)
+        with self.metrics.stage('rsync', key, job.size, self.job_files(job)) as event:
+            event['target'] = target.label
+            rsync_success = event['ok'] = self.transfer(
+                    job, push, [localitem, f"{target.path}/{os.path.basename(key)}"],
+                    target.label)
+        if not rsync_success:
+            print_error(f"ERROR rsync: transfer failed {localitem} {target.label}")
+            return self.failure_reason("rsync to remote failed", rsync_success)
+        self.record(job, src.journal.DELIVERED)
+        if not self.verified(job, functools.partial(self.verify_export, target=target)):
+            return "Checksum verification on remote failed"
+        return None
+
+    def prepare_targets(self, job) -> bool:
+        """
+        Creates the destination folder on every target of an export. Targets where that
+        fails are not pushed to.
+        Returns: False if no target is left, the job is then logged as failed
+        """
+        job.targets, job.failed_targets = [], []
+        for target in self.place_targets(job):
+            if self.options['ssh_multiplexing']:
+                src.rsync.ensure_ssh_master(target.user, target.server)
+            with self.metrics.stage('mkdir', target.label) as event:
+                event['ok'] = src.rsync.create_remote_dir(target.user, target.server,
+                                                          self.sudo, target.path)
+            if event['ok']:
+                job.targets.append(target)
             else:
-                print_error(f"ERROR rsync: transfer failed {localcache}/{os.path.basename(key)} "
-                            + f"{os.path.dirname(value)}")
-                failure.append((key, value, "rsync to remote failed"))
-                src.rsync.empty_dir(localcache)
-                continue
+                print_error(f"ERROR: mkdir on remote server failed {target.label}")
+                job.failed_targets.append((target, "Creating remote dir failed"))
+        if not job.targets:
+            self.finish_targets(job, [])
+            self.release_job(job)
+            return False
+        return True
+
+    def push_targets(self, job, push) -> list:
+        """
+        Pushes a job to all its targets, in parallel when there are several. The item is
+        fetched once and stays in the cache until all pushes are done.
+        Every server of the config runs at most its max_transfers pushes at the same time.
+        push: callable(job, target) -> None upon success, the reason of the failure otherwise
+        Returns: list of targets the job was delivered to
+        """
+        def push_one(target):
+            with self.host_pool.slot(target.user, target.server):
+                return push(job, target)
+
+        if len(job.targets) == 1:
+            reasons = [push_one(job.targets[0])]
+        else:
+            with concurrent.futures.ThreadPoolExecutor(len(job.targets)) as pool:
+                reasons = list(pool.map(push_one, job.targets))
+        delivered = []
+        for target, reason in zip(job.targets, reasons):
+            if reason is None:
+                delivered.append(target)
+            else:
+                job.failed_targets.append((target, reason))
+        return delivered
+
+    def finish_targets(self, job, delivered: list):
+        """
+        Logs the outcome of an export for its targets. The job only succeeds when it was
+        delivered to all targets. With several targets, the failure of every target is
+        logged with its reason and the delivered targets are logged as transferred.
+        """
+        failed = job.failed_targets
+        if not failed:
+            self.keep_in_cache(job)
+            self.export_succeeded(job)
+            return
+        if len(failed) + len(delivered) == 1:
+            self.log_failure(job, failed[0][1])
+        else:
+            self.failure.extend((job.source, target.label, reason) for target, reason in failed)
+            if delivered:
+                self.log_success(job, [target.label for target in delivered])
+            self.log_failure(job, f"Transfer failed to {len(failed)} of "
+                                  f"{len(failed) + len(delivered)} targets")
+        if all(target.label in job.failed_members for target, _ in failed):
+            self.record_delivered(job)
+
+    def keep_in_cache(self, job):
+        """
+        Moves the cache folder of a transferred item into the kept cache entries,
+        together with its cache reservation.
+        """
+        if not job.cache_key or job.cache_hit:
+            return
+        if job.volume.items.add(job.cache_key, job.cachedir, job.source, job.size):
+            job.cachedir = None
+            job.reserved = 0
+
+    def export_succeeded(self, job):
+        key = job.source
+        print_message("--> Data transfer complete")
+        self.job_succeeded(job)
+        if job.row is None and self.session.collections.exists(key):
+            for target in job.targets:
+                self.success.extend(src.irods_functions.map_collitems_to_folder(
+                    self.session, key, target.label))
+
+        # Create iRODS metadata entry
+        if self.annotator is not None:
+            for target in job.targets:
+                self.annotator.submit(key, f"{target.path}/{os.path.basename(key)}",
+                                      job.members, target.server)
+
+    def stream_prepare(self, job) -> bool:
+        """
+        First step of a streamed export: create the destination folder on the remote servers
+        """
+        print_message(f"STATUS: Stream data from iRODS {job.source} --> {job.dest}")
+        return self.prepare_targets(job)
+
+    def stream_push(self, job):
+        """
+        Second step of a streamed export: iRODS --> remote servers, without the local cache.
+        """
+        try:
+            self.finish_targets(job, self.push_targets(job, self.stream_target))
+        finally:
+            self.release_job(job)
+
+    def stream_target(self, job, target):
+        """
+        Streams an item from iRODS to one target, the data is read from iRODS per target.
+        Returns: None upon success, the reason of the failure otherwise
+        """
+        key = job.source
+        item_name = os.path.basename(key)
+        if self.session.collections.exists(key):
+            members = set(job.members) if job.members is not None else None
+            objects = ((path, f"{item_name}/{path[len(key) + 1:]}", size, checksum)
+                       for path, size, checksum
+                       in src.irods_functions.iter_irods_objects(self.session, key)
+                       if members is None or path[len(key) + 1:] in members)
+        else:
+            obj = self.session.data_objects.get(key)
+            objects = [(key, item_name, obj.size, obj.checksum)]
 
-        self.write_log(success, failure)
+        with self.metrics.stage('stream', key, job.size, self.job_files(job)) as event:
+            event['target'] = target.label
+            failed = src.stream.stream_irods_to_remote(self.session, objects, target.user,
+                                                       target.server, self.sudo, target.path)
+            event['ok'] = failed == []
+        if failed is None:
+            return "Streaming to remote failed"
+        self.record(job, src.journal.DELIVERED)
+        if failed:
+            self.failure.extend((path, target.label, "Checksum differs from iRODS")
+                                for path in failed)
+            return "Checksum verification on the fly failed"
+        return None
 
 
 if __name__ == "__main__":